@@ -1,6 +1,7 @@
 # special measurement field, if field is not listed timestamp is made at server
 
-from origin.origin_current_time import current_time
+from origin.origin_current_time import current_time, timestamp_ticks
+from origin.origin_config import config_option
 from origin.origin_data_types import data_types
 from origin.origin_registration_validation import registration_validation
 
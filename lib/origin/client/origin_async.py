@@ -0,0 +1,251 @@
+"""
+This module provides event loop based reader and subscriber classes, so one
+process can serve many subscriptions and concurrent reads from a single
+thread.
+
+Both classes run on the pyzmq event loop (zmq.eventloop.ioloop), like the
+server does. Results are handed to callbacks, which can be any callable,
+since nothing crosses a process boundary. Start the loop with
+ioloop.IOLoop.instance().start() once the reads and subscriptions are set up.
+"""
+
+import json
+import itertools
+
+import zmq
+from zmq.eventloop import ioloop
+from zmq.eventloop.zmqstream import ZMQStream
+
+import origin_reciever as reciever
+from origin_reader import Reader
+from origin_subscriber import handle_command, dispatch
+from origin_reciever import REQUEST_ID
+
+
+class AsyncReader(Reader):
+    """!@brief A data stream reader that sends reads without waiting for the
+    replies.
+
+    Reads go out on a DEALER socket, each with its own request id frame in
+    the routing envelope, so any number of them can be in flight at once and
+    their replies are matched up in whatever order they come back.
+    """
+
+    def __init__(self, config, logger, io_loop=None):
+        """!@brief Initialize the reader, the stream definitions are read
+        before it returns.
+
+        @param config is a ConfigParser object
+        @param logger python logging object
+        @param io_loop the event loop to use, the global instance by default
+        """
+        super(AsyncReader, self).__init__(config, logger)
+        self.io_loop = io_loop or ioloop.IOLoop.instance()
+        self.async_sock = self.context.socket(zmq.DEALER)
+        self.sockets.append(self.async_sock)
+        self.connect(self.async_sock, self.read_port)
+        self.async_stream = ZMQStream(self.async_sock, self.io_loop)
+        self.async_stream.on_recv(self.on_reply, copy=False)
+        self.request_ids = itertools.count()
+        # request id : (request, callback, timeout handle)
+        self.pending = {}
+
+    def close(self):
+        """@!brief Prepare to stop, pending reads are dropped."""
+        for request, callback, timeout in self.pending.values():
+            self.io_loop.remove_timeout(timeout)
+        self.pending = {}
+        self.async_stream.close()
+        super(AsyncReader, self).close()
+
+    def get_stream_data(self, stream, callback, start=None, stop=None,
+                        fields=[], raw=False, binary=False, max_points=None,
+                        downsample='minmax'):
+        """!@brief Request stream data in time window from sever.
+
+        See Reader.get_stream_data for the parameters.
+
+        @param callback A function that is called with the data dictionary
+            from the event loop, the dictionary is empty if there was an error
+        @return the request id, None if the request was not sent
+        """
+        request = self.read_request(stream, start, stop, fields, raw, binary)
+        if request is None:
+            callback({})
+            return None
+        if raw and (max_points is not None):
+            request['max_points'] = max_points
+            request['downsample'] = downsample
+        return self.send_async_request(request, callback)
+
+    def get_stream_raw_data(self, stream, callback, start=None, stop=None,
+                            fields=[], binary=False, max_points=None,
+                            downsample='minmax'):
+        """!@brief Request raw stream data in time window from sever.
+
+        See Reader.get_stream_raw_data for the parameters.
+
+        @param callback A function that is called with the data dictionary
+        @return the request id
+        """
+        return self.get_stream_data(
+            stream,
+            callback,
+            start=start,
+            stop=stop,
+            fields=fields,
+            raw=True,
+            binary=binary,
+            max_points=max_points,
+            downsample=downsample
+        )
+
+    def get_stream_stat_data(self, stream, callback, start=None, stop=None,
+                             fields=[]):
+        """!@brief Request stream data statistics in time window from sever.
+
+        See Reader.get_stream_stat_data for the parameters.
+
+        @param callback A function that is called with the data dictionary
+        @return the request id
+        """
+        return self.get_stream_data(
+            stream, callback, start=start, stop=stop, fields=fields, raw=False
+        )
+
+    def send_async_request(self, request, callback):
+        """!@brief Send a read request, the reply is handed to the callback.
+
+        @param request the request dictionary
+        @param callback A function that is called with the data dictionary
+        @return the request id
+        """
+        request_id = REQUEST_ID.pack(next(self.request_ids) & 0xffffffff)
+        timeout = self.io_loop.add_timeout(
+            self.io_loop.time() + self.timeout / 1000.,
+            lambda: self.on_timeout(request_id)
+        )
+        self.pending[request_id] = (request, callback, timeout)
+        # the request id and the empty delimiter frame make up the envelope
+        self.async_stream.send_multipart([request_id, b'', json.dumps(request)])
+        return request_id
+
+    def on_reply(self, frames):
+        '''match a reply to its request and hand the data to the callback'''
+        request_id = frames[0].bytes
+        try:
+            request, callback, timeout = self.pending.pop(request_id)
+        except KeyError:
+            msg = "Got a reply to an unknown request, it may have timed out."
+            self.log.warning(msg)
+            return
+        self.io_loop.remove_timeout(timeout)
+        data, cursor = self.read_reply(request, frames[2:])
+        callback(data)
+
+    def on_timeout(self, request_id):
+        '''give up on a request the server did not answer in time'''
+        try:
+            request, callback, timeout = self.pending.pop(request_id)
+        except KeyError:
+            return
+        msg = "The server did not answer the read request for stream `{}` in time."
+        self.log.error(msg.format(request['stream']))
+        callback({})
+
+
+class AsyncSubscriber(reciever.Reciever):
+    """!@brief A data stream subscription that runs on the event loop.
+
+    Callbacks are called from the event loop thread with the same arguments
+    as the Subscriber callbacks.
+    """
+
+    def __init__(self, config, logger, io_loop=None):
+        """!@brief Initialize the subscriber, the stream definitions are read
+        before it returns.
+
+        @param config configuration object
+        @param logger python logging object
+        @param io_loop the event loop to use, the global instance by default
+        """
+        super(AsyncSubscriber, self).__init__(config, logger)
+        self.io_loop = io_loop or ioloop.IOLoop.instance()
+        # we need the read socket for this class so we can get stream defs
+        self.connect(self.read_sock, self.read_port)
+        self.get_available_streams()
+        self.connect(self.sub_sock, self.sub_port)
+        # the same bookkeeping as the Subscriber poller loop
+        self.subscriptions = {}
+        self.decoders = {}
+        self.active = set()
+        self.sub_stream = ZMQStream(self.sub_sock, self.io_loop)
+        self.sub_stream.on_recv(self.on_message)
+
+    def close(self):
+        """@!brief Prepare to stop."""
+        self.sub_stream.close()
+        super(AsyncSubscriber, self).close()
+
+    def command(self, cmd):
+        '''apply a subscription command right away'''
+        handle_command(
+            cmd, self.sub_sock, self.subscriptions, self.decoders, self.active, self.log
+        )
+
+    def subscribe(self, stream, callback, records=False):
+        """!@brief Subscribe to a data stream and assign a callback.
+
+        See Subscriber.subscribe, but the callback can be any callable.
+
+        @param stream A string holding the stream name
+        @param callback A callback function that expects the stream id, the
+            data and a logging object
+        @param records In the binary publish format, call the callback once
+            per message with a numpy structured array
+        @return success True if the data stream subscription was successful,
+            False otherwise
+        """
+        try:
+            stream_filter = self.get_stream_filter(stream)
+        except KeyError:
+            msg = "No stream matching string: `{}` found."
+            self.log.error(msg.format(stream))
+            return False
+        self.command({
+            'action'        : 'SUBSCRIBE',
+            'stream_filter' : stream_filter,
+            'callback'      : callback,
+            'records'       : records,
+            'dtype'         : self.get_stream_dtype(stream)
+        })
+        return True
+
+    def unsubscribe(self, stream):
+        """!@brief Unsubscribe from stream at the publisher, the callbacks are
+        kept.
+
+        @param stream A string holding the stream name
+        """
+        self.command({
+            'action'        : 'UNSUBSCRIBE',
+            'stream_filter' : self.get_stream_filter(stream)
+        })
+
+    def remove_callbacks(self, stream):
+        """!@brief Unsubscribe from stream and remove all its callbacks.
+
+        @param stream A string holding the stream name
+        """
+        self.command({
+            'action'        : 'REMOVE_ALL_CBS',
+            'stream_filter' : self.get_stream_filter(stream)
+        })
+
+    def on_message(self, msg):
+        '''call the callbacks of a published message'''
+        try:
+            stream_filter, content = msg
+            dispatch(stream_filter, content, self.subscriptions, self.decoders, self.log)
+        except Exception:
+            self.log.exception("error encountered")
@@ -0,0 +1,198 @@
+"""
+This module provides the DiskCache class, an on-disk cache of raw stream data
+for the Reader.
+
+Measurements that are old enough do not change anymore, so the raw data is
+cached in aligned time blocks, one numpy file per field:
+
+    cache_path/`stream`/`version`/`block start`/`field`.npy
+
+A read loads the blocks it has, fetches the missing runs of blocks from the
+server and stores them, and reads the recent part of the window, where
+measurements can still arrive, from the server every time. The least
+recently used blocks are dropped when the cache grows past its size limit.
+"""
+
+import os
+import time
+import shutil
+
+import numpy as np
+
+from origin import config_option, timestamp_ticks, TIMESTAMP
+
+# the default read window, as in Destination.validate_time_range
+DEFAULT_WINDOW = 5 * 60
+# the server replies to reads without data with an error, these blocks are
+# cached as empty
+EMPTY_REPLIES = ("No data in requested time window.", "Stream declared, but no data saved.")
+
+
+class DiskCache(object):
+    """!@brief A size bounded cache of raw stream data blocks on disk.
+
+    The cache directory can be shared by many readers, files are written
+    under a temporary name and renamed, and a block that disappears while it
+    is read is fetched again.
+    """
+
+    def __init__(self, logger, config):
+        """!@brief Read the cache settings and index the cached blocks.
+
+        @param logger pass in a logger object
+        @param config configuration object
+        """
+        self.logger = logger
+        path = config_option(config, 'Reader', 'cache_path', '')
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.block = config_option(config, 'Reader', 'cache_block', 3600, 'getint')
+        self.max_bytes = config_option(config, 'Reader', 'cache_max_bytes', 2**30, 'getint')
+        self.settle = config_option(config, 'Reader', 'cache_settle', 600, 'getint')
+        self.ticks = timestamp_ticks(config)
+        # block directory : (last use, size in bytes)
+        self.blocks = {}
+        self.size = 0
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for directory, subdirs, files in os.walk(self.path):
+            if TIMESTAMP + '.npy' in files:
+                self.touch(directory, os.path.getmtime(directory))
+        msg = "Disk cache at `{}`, {} blocks, {} bytes"
+        self.logger.info(msg.format(self.path, len(self.blocks), self.size))
+
+    def block_dir(self, stream, version, start):
+        '''the directory of a cached block'''
+        return os.path.join(self.path, stream, str(version), str(start))
+
+    def touch(self, directory, when=None):
+        '''record the use of a block and update its size'''
+        size = 0
+        for name in os.listdir(directory):
+            size += os.path.getsize(os.path.join(directory, name))
+        old = self.blocks.get(directory, (0, 0))[1]
+        self.blocks[directory] = (when or time.time(), size)
+        self.size += size - old
+
+    def load(self, directory, fields):
+        '''load the requested fields of a block, None if any is missing'''
+        try:
+            data = {TIMESTAMP: np.load(os.path.join(directory, TIMESTAMP + '.npy'))}
+            for field in fields:
+                data[field] = np.load(os.path.join(directory, field + '.npy'))
+        except (IOError, OSError, ValueError):
+            return None
+        return data
+
+    def store(self, directory, data):
+        '''write the arrays of a block, the timestamps last'''
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        names = [field for field in data if field != TIMESTAMP] + [TIMESTAMP]
+        for field in names:
+            name = os.path.join(directory, field + '.npy')
+            tmp = '{}.{}.tmp'.format(name, os.getpid())
+            with open(tmp, 'wb') as f:
+                np.save(f, np.ascontiguousarray(data[field]))
+            os.rename(tmp, name)
+        self.touch(directory)
+        self.evict()
+
+    def evict(self):
+        '''drop the least recently used blocks while the cache is too big'''
+        if self.size <= self.max_bytes:
+            return
+        for directory in sorted(self.blocks, key=lambda d: self.blocks[d][0]):
+            if self.size <= self.max_bytes:
+                break
+            self.size -= self.blocks.pop(directory)[1]
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def read(self, reader, stream, start, stop, fields):
+        """!@brief Read raw stream data through the cache.
+
+        @param reader the Reader that fetches the missing data
+        @param stream A string holding the stream name
+        @param start 32b Unix timestamp that defines the start of the data
+            window
+        @param stop 32b Unix timestamp that defines the end of the data window
+        @param fields A list of fields from the stream, all if empty
+        @return data A dictionary of numpy arrays for each field, empty if
+            there is no data
+        """
+        stream_obj = reader.known_streams[stream]
+        if not fields:
+            fields = sorted(stream_obj['definition'])
+        fields = [str(field) for field in fields]
+        version = stream_obj['version']
+        now = time.time()
+        last = (long(stop) if stop is not None else long(now))
+        first = (long(start) if start is not None else last - DEFAULT_WINDOW)
+        if first > last:
+            first, last = last, first
+        # blocks that ended before the settle time are cached, the rest of
+        # the window is always read from the server
+        settled = (long(now) - self.settle) // self.block * self.block
+        blocks = range(first // self.block * self.block, min(last + 1, settled), self.block)
+
+        parts = {}
+        missing = []
+        for block in blocks:
+            directory = self.block_dir(stream, version, block)
+            data = self.load(directory, fields)
+            if data is None:
+                missing.append(block)
+            else:
+                parts[block] = data
+                os.utime(directory, None)
+                self.touch(directory)
+
+        # one read per run of missing blocks, and one for the recent part
+        runs = []
+        for block in missing:
+            if runs and runs[-1][1] == block:
+                runs[-1][1] = block + self.block
+            else:
+                runs.append([block, block + self.block])
+        requests = [
+            {'stream': stream, 'start': run[0], 'stop': run[1], 'fields': fields}
+            for run in runs
+        ]
+        tail = blocks[-1] + self.block if blocks else first
+        if tail <= last:
+            requests.append({
+                'stream': stream, 'start': max(tail, first), 'stop': stop, 'fields': fields
+            })
+        errors = []
+        replies = reader.get_many_stream_data(requests, errors=errors, raw=True, binary=True)
+
+        for run, data, error in zip(runs, replies, errors):
+            if not data:
+                if error not in EMPTY_REPLIES:
+                    # the blocks are read again next time
+                    continue
+                data = dict((field, np.array([])) for field in fields)
+                data[TIMESTAMP] = np.array([], dtype=np.uint64)
+            edges = np.arange(run[0], run[1] + 1, self.block, dtype=np.uint64) * np.uint64(self.ticks)
+            bounds = np.searchsorted(data[TIMESTAMP], edges, side='left')
+            for i, block in enumerate(range(run[0], run[1], self.block)):
+                rows = slice(bounds[i], bounds[i + 1])
+                part = dict((field, data[field][rows]) for field in data)
+                parts[block] = part
+                self.store(self.block_dir(stream, version, block), part)
+
+        # empty blocks are left out, their arrays do not have the field types
+        ordered = [parts[block] for block in sorted(parts) if len(parts[block][TIMESTAMP])]
+        if tail <= last and replies[-1]:
+            ordered.append(replies[-1])
+        if not ordered:
+            return {}
+        result = {}
+        for field in [TIMESTAMP] + fields:
+            result[field] = np.concatenate([part[field] for part in ordered])
+        time_stamps = result[TIMESTAMP]
+        keep = time_stamps >= first * self.ticks
+        if stop is not None:
+            keep &= time_stamps <= last * self.ticks
+        if not keep.any():
+            return {}
+        return dict((field, result[field][keep]) for field in result)
@@ -5,29 +5,60 @@ methods for subscribing to a data stream.
 
 import json
 
+import zmq
+
 import origin_reciever as reciever
+from origin_disk_cache import DiskCache
+from origin.origin_columnar import unpack_columns
+from origin import config_option
+
+INVALID_REQUEST = "The read request is not valid."
 
 
 class Reader(reciever.Reciever):
     """!@brief A class representing a data stream reader to a data server.
 
     This class handles asynchronous read events with a data server.
+
+    In pipeline mode the read socket is a DEALER socket and every request
+    carries a request id, so get_many_stream_data can have all its requests
+    in flight at once. Each reply is waited for up to the `[Reader] timeout`.
+
+    If `[Reader] cache_path` is set, raw reads go through an on-disk cache of
+    the older data, see origin_disk_cache.
     """
 
-    def __init__(self, config, logger):
+    def __init__(self, config, logger, pipeline=False):
         """!@brief Initialize the subscriber
 
         @param config is a ConfigParser object
+        @param logger python logging object
+        @param pipeline True to send requests without waiting for the replies
+            to the previous ones
         """
         # call the parent class initialization
         super(Reader, self).__init__(config, logger)
+        if pipeline:
+            self.sockets.remove(self.read_sock)
+            self.read_sock.close()
+            self.read_sock = self.context.socket(zmq.DEALER)
+            # a DEALER socket can give up on a reply and keep going
+            self.read_sock.setsockopt(zmq.RCVTIMEO, self.timeout)
+            self.sockets.append(self.read_sock)
+            self.pipeline = True
         # we only need the read socket for this class
         self.connect(self.read_sock, self.read_port)
+        # error message of the last read reply, None if it succeeded
+        self.last_error = None
+        self.disk_cache = None
+        if config_option(config, 'Reader', 'cache_path', ''):
+            self.disk_cache = DiskCache(logger, config)
         # request the available streams from the server
         self.get_available_streams()
 
-    def get_stream_data(self, stream,
-                        start=None, stop=None, fields=[], raw=False):
+    def get_stream_data(self, stream, start=None, stop=None, fields=[],
+                        raw=False, binary=False, max_points=None,
+                        downsample='minmax'):
         """!@brief Request raw stream data in time window from sever.
 
         @param stream A string holding the stream name
@@ -35,9 +66,131 @@ class Reader(reciever.Reciever):
             window
         @param stop 32b Unix timestamp that defines the end of the data window
         @param fields A list of fields from the stream that should be returned
+        @param raw True to request the raw data instead of statistics
+        @param binary True to request raw data as binary columns, they are
+            returned as read only numpy arrays instead of lists
+        @param max_points optional max number of raw measurements, the server
+            decimates the data if there are more, it has to be at least 2
+            per numeric field with minmax and 3 with lttb
+        @param downsample the decimation method, 'minmax' or 'lttb'
         @return data A dictionary containing data for each field in
             the time window
         """
+        request = self.stream_data_request(
+            stream, start, stop, fields, raw, binary, max_points, downsample
+        )
+        if request is None:
+            return {}
+        return self.send_read_request(request)[0]
+
+    def get_many_stream_data(self, requests, errors=None, **kwargs):
+        """!@brief Request the data of many streams at once.
+
+        In pipeline mode all the requests are sent before waiting for any
+        reply, so it takes about as long as the slowest one. Otherwise they
+        are sent one after the other.
+
+        @param requests A list of stream names, or of dictionaries holding
+            get_stream_data arguments
+        @param errors optional list, the error message of each request is
+            appended to it in order, None for the requests that succeeded
+        @param kwargs get_stream_data arguments shared by all the requests
+        @return a list with the data dictionary of each request, in order,
+            a dictionary is empty if there was an error
+        """
+        if errors is None:
+            errors = []
+        sent = []
+        for item in requests:
+            args = dict(kwargs)
+            if isinstance(item, dict):
+                args.update(item)
+            else:
+                args['stream'] = item
+            request = self.stream_data_request(**args)
+            if not self.pipeline:
+                if request is None:
+                    sent.append({})
+                    errors.append(INVALID_REQUEST)
+                else:
+                    sent.append(self.send_read_request(request)[0])
+                    errors.append(self.last_error)
+            elif request is None:
+                sent.append((None, None))
+            else:
+                sent.append((request, self.send_request(json.dumps(request))))
+        if not self.pipeline:
+            return sent
+
+        results = []
+        for request, request_id in sent:
+            if request is None:
+                results.append({})
+                errors.append(INVALID_REQUEST)
+                continue
+            try:
+                frames = self.recv_reply(request_id)
+            except zmq.ZMQError:
+                frames = None
+            results.append(self.read_reply(request, frames)[0])
+            errors.append(self.last_error)
+        return results
+
+    def stream_data_request(self, stream, start=None, stop=None, fields=[],
+                            raw=False, binary=False, max_points=None,
+                            downsample='minmax'):
+        """!@brief Make the request object for get_stream_data.
+
+        @return the request dictionary, or None if the fields are not valid
+        """
+        request = self.read_request(stream, start, stop, fields, raw, binary)
+        if request is None:
+            return None
+        if raw and (max_points is not None):
+            request['max_points'] = max_points
+            request['downsample'] = downsample
+        return request
+
+    def iter_stream_data(self, stream, start=None, stop=None, fields=[],
+                         page_rows=10000, page_bytes=None, binary=False):
+        """!@brief Iterate over the raw stream data in a time window, one page
+        at a time.
+
+        The server only reads and sends one page per request, so long time
+        windows can be processed in bounded memory. The time window is fixed
+        by the first request.
+
+        @param stream A string holding the stream name
+        @param start 32b Unix timestamp that defines the start of the data
+            window
+        @param stop 32b Unix timestamp that defines the end of the data window
+        @param fields A list of fields from the stream that should be returned
+        @param page_rows max number of measurements in a page
+        @param page_bytes optional max size of a page in bytes, strings count
+            as their fixed width size
+        @param binary True to receive the pages as numpy arrays
+        @return a generator of dictionaries containing the raw data for each
+            field in a page
+        """
+        request = self.read_request(stream, start, stop, fields, True, binary)
+        if request is None:
+            return
+        request['page_rows'] = page_rows
+        if page_bytes is not None:
+            request['page_bytes'] = page_bytes
+        while True:
+            data, cursor = self.send_read_request(request)
+            if data:
+                yield data
+            if cursor is None:
+                break
+            request['cursor'] = cursor
+
+    def read_request(self, stream, start, stop, fields, raw, binary):
+        """!@brief Make a read request object.
+
+        @return the request dictionary, or None if the fields are not valid
+        """
         if not self.is_stream(stream):
             raise KeyError
 
@@ -47,16 +200,46 @@ class Reader(reciever.Reciever):
             'stop'  : stop,
             'raw'   : raw,
         }
+        if raw and binary:
+            request['format'] = 'binary'
         if fields != []:
             if self.is_fields(stream, fields):
                 request['fields'] = fields
             else:
                 self.log.error('There was an issue with the specified fields.')
-                return {}
-        self.read_sock.send(json.dumps(request))
+                return None
+        return request
+
+    def send_read_request(self, request):
+        """!@brief Send a read request to the server and wait for the reply.
+
+        @param request the request dictionary
+        @return a tuple (data, cursor), data is an empty dictionary if there
+            was an error and cursor is None unless there is another page
+        """
+        request_id = self.send_request(json.dumps(request))
         try:
-            msg = self.read_sock.recv()
-            data = json.loads(msg)
+            frames = self.recv_reply(request_id)
+        except:
+            frames = None
+        return self.read_reply(request, frames)
+
+    def read_reply(self, request, frames):
+        """!@brief Decode the reply to a read request.
+
+        @param request the request dictionary
+        @param frames the reply frames, None if the request failed
+        @return a tuple (data, cursor), data is an empty dictionary if there
+            was an error and cursor is None unless there is another page. The
+            error message is kept in last_error.
+        """
+        self.last_error = None
+        try:
+            # binary replies have one frame per column after the header
+            data = json.loads(getattr(frames[0], 'bytes', frames[0]))
+            if data[0] == 0 and request.get('format') == 'binary':
+                cursor = data[1].get('cursor')
+                data = [0, unpack_columns(data[1], frames[1:]), cursor]
         except:
             msg = "There was an error communicating with the server"
             self.log.exception(msg)
@@ -65,15 +248,18 @@ class Reader(reciever.Reciever):
         if data[0] != 0:
             msg = "The server responds to the request with error message: `{}`"
             self.log.error(msg.format(data[1]["error"]))
+            self.last_error = data[1]["error"]
             known_streams = data[1]['stream']
             if known_streams != {}:
                 self.log.info('Updating stream definitions from server.')
                 self.update_known_streams(known_streams)
-            return {}
-        else:
-            return data[1]
+            return ({}, None)
+        if len(data) > 2:
+            return (data[1], data[2])
+        return (data[1], None)
 
-    def get_stream_raw_data(self, stream, start=None, stop=None, fields=[]):
+    def get_stream_raw_data(self, stream, start=None, stop=None, fields=[],
+                            binary=False, max_points=None, downsample='minmax'):
         """!@brief Request raw stream data in time window from sever.
 
         @param stream A string holding the stream name
@@ -81,15 +267,31 @@ class Reader(reciever.Reciever):
             window
         @param stop 32b Unix timestamp that defines the end of the data window
         @param fields A list of fields from the stream that should be returned
+        @param binary True to receive the data as numpy arrays, which skips
+            the JSON encoding of every value
+        @param max_points optional max number of measurements for plotting,
+            the server decimates the data if there are more
+        @param downsample the decimation method, 'minmax' keeps the extremes
+            of equal time buckets, 'lttb' keeps the visual shape
         @return data A dictionary containing raw data for each field in
             the time window
         """
+        if (self.disk_cache is not None) and (max_points is None):
+            if not self.is_stream(stream):
+                raise KeyError
+            data = self.disk_cache.read(self, stream.strip(), start, stop, fields)
+            if not binary:
+                data = dict((field, data[field].tolist()) for field in data)
+            return data
         return self.get_stream_data(
             stream,
             start=start,
             stop=stop,
             fields=fields,
-            raw=True
+            raw=True,
+            binary=binary,
+            max_points=max_points,
+            downsample=downsample
         )
 
     def get_stream_stat_data(self, stream,
@@ -111,3 +313,29 @@ class Reader(reciever.Reciever):
             fields=fields,
             raw=False
         )
+
+    def get_stream_bucket_data(self, stream, bucket_seconds, start=None,
+                               stop=None, fields=[], binary=False):
+        """!@brief Request summaries of the stream data in equal time buckets.
+
+        The server answers from its rollup tiers when it keeps them, so long
+        time windows are cheap to read.
+
+        @param stream A string holding the stream name
+        @param bucket_seconds the bucket size, buckets start at multiples of it
+        @param start 32b Unix timestamp that defines the start of the data
+            window
+        @param stop 32b Unix timestamp that defines the end of the data window
+        @param fields A list of numeric fields from the stream
+        @param binary True to receive the data as numpy arrays
+        @return data A dictionary with the bucket start timestamps, `count`,
+            and `field`_average, _standard_deviation, _min, _max, _first and
+            _last for each field
+        """
+        request = self.read_request(stream, start, stop, fields, False, binary)
+        if request is None:
+            return {}
+        request['bucket_seconds'] = bucket_seconds
+        if binary:
+            request['format'] = 'binary'
+        return self.send_read_request(request)[0]
@@ -5,6 +5,14 @@ extended by reader and subscriber classes
 
 import zmq
 import json
+import struct
+import itertools
+
+from origin.origin_batch import record_dtype
+from origin import TIMESTAMP
+
+# the request id frame of pipelined read requests
+REQUEST_ID = struct.Struct("!I")
 
 
 class Reciever(object):
@@ -21,7 +29,16 @@ class Reciever(object):
         self.config = config
         self.known_streams = {}
         self.stream_list = []
+        # how the server publishes measurements, see get_available_streams
+        self.publish_format = 'json'
         self.log = logger
+        # pipelined reads, on a DEALER read socket, see Reader
+        self.pipeline = False
+        # ids of the pipelined requests still waiting for a reply
+        self.pending = set()
+        # request id : reply frames, for replies that came in out of order
+        self.replies = {}
+        self.request_ids = itertools.count()
         self.setup()
 
     def close(self):
@@ -48,15 +65,86 @@ class Reciever(object):
         """
         # Sending an empty JSON object requests an object containing the
         # available streams
-        self.read_sock.send('{}')
+        request_id = self.send_request('{}')
         try:
-            err, known_streams = json.loads(self.read_sock.recv())
+            err, known_streams = json.loads(self.recv_reply(request_id)[0].bytes)
         except:
             self.log.exception("Error connecting to data server")
         else:
             self.update_known_streams(known_streams['streams'])
+            self.publish_format = known_streams.get('publish_format', 'json')
         return self.known_streams
 
+    def send_request(self, msg):
+        """!@brief Send a request on the read socket.
+
+        @param msg the JSON request string
+        @return the request id for pipelined reads, None otherwise
+        """
+        if not self.pipeline:
+            self.read_sock.send(msg)
+            return None
+        request_id = REQUEST_ID.pack(next(self.request_ids) & 0xffffffff)
+        # the request id and the empty delimiter frame make up the envelope
+        self.read_sock.send_multipart([request_id, b'', msg])
+        self.pending.add(request_id)
+        return request_id
+
+    def recv_reply(self, request_id):
+        """!@brief Wait for the reply to a request on the read socket.
+
+        Replies to other pipelined requests that come in first are kept
+        until they are asked for. If the wait fails the request is given up,
+        its reply is dropped if it comes in later.
+
+        @param request_id the id from send_request
+        @return the list of reply frames
+        """
+        if not self.pipeline:
+            return self.read_sock.recv_multipart(copy=False)
+        try:
+            while request_id not in self.replies:
+                frames = self.read_sock.recv_multipart(copy=False)
+                reply_id = frames[0].bytes
+                if reply_id in self.pending:
+                    self.replies[reply_id] = frames[2:]
+                else:
+                    msg = "Got a reply to an unknown request, it may have timed out."
+                    self.log.warning(msg)
+        finally:
+            self.pending.discard(request_id)
+        return self.replies.pop(request_id)
+
+    def get_stream_filter(self, stream):
+        """!@brief Make the appropriate stream filter to subscribe to a stream
+
+        @param stream A string holding the stream name
+        @return stream_filter A string holding the filter to subscribe to the
+            resquested data stream
+        """
+        if self.publish_format == 'binary':
+            # fixed width binary stream id
+            return struct.pack("!I", self.known_streams[stream]['id'])
+        stream_id = str(self.known_streams[stream]['id'])
+        # ascii to unicode str
+        stream_id = stream_id.zfill(self.filter_len)
+        stream_id = stream_id.decode('ascii')
+        self.log.info(stream_id)
+        return stream_id
+
+    def get_stream_dtype(self, stream):
+        """!@brief Make the record dtype for decoding binary messages of a
+        stream.
+
+        @param stream A string holding the stream name
+        @return a numpy structured dtype, None if the stream can not be packed
+        """
+        stream_obj = self.known_streams[stream]
+        if self.publish_format != 'binary' or not stream_obj.get('format_str'):
+            return None
+        names = [TIMESTAMP] + [str(key) for key in stream_obj['key_order']]
+        return record_dtype(stream_obj['format_str'], names)
+
     def is_fields(self, stream, fields):
         """!@brief Check that all the requested fields exist in the stream.
 
@@ -6,6 +6,7 @@ import ctypes
 import traceback
 
 from origin import data_types, TIMESTAMP
+from origin.origin_batch import pack_batch
 
 # returns string and size tuple
 def makeFormatString(config, keyOrder, records):
@@ -41,8 +42,11 @@ class server_connection:
 
         if keyOrder is None:
             self.format_string, self.data_size = (None, None)
+            self.record_format = None
         else:
             self.format_string, self.data_size = makeFormatString(self.config,keyOrder,records)
+            # same as the format string without the streamID
+            self.record_format = "!" + self.format_string[2:]
 
     def send(self,**kwargs):
         msgData = [ self.streamID ]
@@ -55,20 +59,7 @@ class server_connection:
         if self.format is None:
             for k in self.keyOrder:
                 msgData.append(kwargs[k])
-            try:
-                self.socket.send(self.formatRecord(msgData), zmq.NOBLOCK)
-            except zmq.Again:
-                print("Connection to Server Failed")
-                #self.socket.close()
-                exit(1)
-            except:
-                print "Uncaught exception:"
-                print '-'*60
-                traceback.print_exc(file=sys.stdout)
-                print '-'*60
-                print("Exiting")
-                #self.socket.close()
-                exit(1)
+            self.sendFrame(self.formatRecord(msgData))
 
         elif self.format == "json":
             msgData[0] = self.stream
@@ -92,6 +83,41 @@ class server_connection:
                 #self.socket.close()
                 exit(1)
 
+    def send_batch(self, records, delta=False):
+        """Send many records in one batched native frame.
+
+        @param records a list of dictionaries, each one formatted like the
+            keyword arguments to send
+        @param delta delta encode the timestamps, records without a
+            timestamp should not be mixed with records that have one
+        """
+        if (self.format is not None) or (self.record_format is None):
+            print("Batched records require the native format with a key order")
+            return
+        rows = []
+        for kwargs in records:
+            row = [kwargs.get(TIMESTAMP, 0)]
+            for k in self.keyOrder:
+                row.append(kwargs[k])
+            rows.append(row)
+        self.sendFrame(pack_batch(self.streamID, self.record_format, rows, delta))
+
+    def sendFrame(self, frame):
+        try:
+            self.socket.send(frame, zmq.NOBLOCK)
+        except zmq.Again:
+            print("Connection to Server Failed")
+            #self.socket.close()
+            exit(1)
+        except:
+            print "Uncaught exception:"
+            print '-'*60
+            traceback.print_exc(file=sys.stdout)
+            print '-'*60
+            print("Exiting")
+            #self.socket.close()
+            exit(1)
+
     def close(self):
         print "closing socket"
         self.socket.close()
@@ -4,10 +4,11 @@ methods for subscribing to a data stream.
 """
 
 import zmq
-import sys
 import json
+import struct
 
 import origin_reciever as reciever
+from origin.origin_batch import unpack_batch
 
 import multiprocessing
 
@@ -22,72 +23,183 @@ def sub_print(stream_id, data, log):
     log.info("[{}]: {}".format(stream_id, data))
 
 
-def poller_loop(sub_addr, queue, log):
+def decode_content(stream_filter, content, dtype, binary):
+    """!@brief Decode a published message.
+
+    JSON messages hold one measurement. In the binary publish format, messages
+    of streams that can be packed hold a batched native frame, see
+    origin.origin_batch, the others hold JSON.
+
+    @param stream_filter the message topic
+    @param content the message payload
+    @param dtype the structured record dtype of the stream, None if the
+        stream can not be packed
+    @param binary True for the binary publish format
+    @return a tuple (stream_id, data), data is a dict for a JSON message or
+        a structured array of records for a batched frame
+    """
+    if not binary:
+        return (stream_filter, json.loads(content))
+    stream_id = struct.unpack("!I", stream_filter)[0]
+    if (dtype is None) or content[:1] == b'{':
+        return (stream_id, json.loads(content))
+    return (stream_id, unpack_batch(content, dtype))
+
+
+def set_filter(sub_sock, option, stream_filter):
+    '''Subscribe or unsubscribe the socket, ascii filters are unicode'''
+    if isinstance(stream_filter, unicode):
+        sub_sock.setsockopt_string(option, stream_filter)
+    else:
+        sub_sock.setsockopt(option, stream_filter)
+
+
+def handle_command(cmd, sub_sock, subscriptions, decoders, active, log):
+    """!@brief Apply a command from the Subscriber to the poller loop.
+
+    @param cmd the command dictionary
+    @param sub_sock the SUB socket
+    @param subscriptions stream filter : list of (callback, records) tuples
+    @param decoders stream filter : (record dtype, binary format)
+    @param active the set of stream filters the socket is subscribed to
+    @param log logging object
+    @return False if the loop should shut down
+    """
+    log.debug(cmd)
+    if cmd['action'] == 'SHUTDOWN':
+        return False
+
+    stream_filter = cmd.get('stream_filter')
+    if cmd['action'] == 'SUBSCRIBE':
+        msg = 'Subscribing with stream filter: [{}]'
+        log.info(msg.format(repr(stream_filter)))
+        # add the callback to the list of things to do for the stream
+        callback = (cmd['callback'], cmd.get('records', False))
+        binary = not isinstance(stream_filter, unicode)
+        decoders[stream_filter] = (cmd.get('dtype'), binary)
+        subscriptions.setdefault(stream_filter, []).append(callback)
+        if stream_filter not in active:
+            set_filter(sub_sock, zmq.SUBSCRIBE, stream_filter)
+            active.add(stream_filter)
+        log.debug("subscriptions: {}".format(subscriptions))
+
+    if cmd['action'] in ('UNSUBSCRIBE', 'REMOVE_ALL_CBS'):
+        msg = 'Unsubscribing to stream filter: [{}]'
+        log.info(msg.format(repr(stream_filter)))
+        if stream_filter in active:
+            set_filter(sub_sock, zmq.UNSUBSCRIBE, stream_filter)
+            active.discard(stream_filter)
+
+    if cmd['action'] == 'REMOVE_ALL_CBS':
+        msg = 'Removing all callbacks for stream filter: [{}]'
+        log.info(msg.format(repr(stream_filter)))
+        subscriptions.pop(stream_filter, None)
+    return True
+
+
+def dispatch(stream_filter, content, subscriptions, decoders, log):
+    """!@brief Decode a published message and call the callbacks of its
+    stream.
+
+    @param stream_filter the message topic
+    @param content the message payload
+    @param subscriptions stream filter : list of (callback, records) tuples
+    @param decoders stream filter : (record dtype, binary format)
+    @param log logging object
+    """
+    try:
+        callbacks = subscriptions[stream_filter]
+    except KeyError:
+        msg = "An unrecognized streamID `{}` was encountered"
+        log.error(msg.format(repr(stream_filter)))
+        return
+    stream_id, data = decode_content(stream_filter, content, *decoders[stream_filter])
+    if isinstance(data, dict):
+        for cb, records in callbacks:
+            cb(stream_id, data, log)
+        return
+    rows = None
+    for cb, records in callbacks:
+        if records:
+            cb(stream_id, data, log)
+            continue
+        if rows is None:
+            names = data.dtype.names
+            rows = [dict(zip(names, row)) for row in data.tolist()]
+        for row in rows:
+            cb(stream_id, row, log)
+
+
+def poller_loop(sub_addr, commands, log, max_batch=1000):
+    """!@brief Receive published messages and call the subscribed callbacks,
+    runs in its own process.
+
+    The loop waits on the SUB socket and the command pipe at once, so
+    commands apply right away. Messages are drained without blocking, up to
+    max_batch at a time, before the commands are checked again.
+
+    @param sub_addr the address of the publish socket
+    @param commands the child end of the command pipe from the Subscriber
+    @param log logging object
+    @param max_batch max messages handled before checking for commands
+    """
     # a hash table (dict) of callbacks to perform when a message is recieved
-    # the hash is the data stream filter, the value is a list of callbacks
+    # the hash is the data stream filter, the value is a list of
+    # (callback, records) tuples
     subscriptions = {}
+    # stream filter : (record dtype, binary format) for decoding messages
+    decoders = {}
+    # the stream filters the socket is subscribed to
+    active = set()
     context = zmq.Context()
     sub_sock = context.socket(zmq.SUB)
-    # listen for one second, before doing housekeeping
-    sub_sock.setsockopt(zmq.RCVTIMEO, 1000)
     sub_sock.connect(sub_addr)
-    while True:
+    poller = zmq.Poller()
+    poller.register(sub_sock, zmq.POLLIN)
+    poller.register(commands.fileno(), zmq.POLLIN)
+    running = True
+    while running:
         try:
-            cmd = queue.get_nowait()
-            log.info(cmd)
-            if cmd['action'] == 'SHUTDOWN':
+            events = dict(poller.poll())
+        except zmq.ZMQError:
+            log.exception("zmq error encountered")
+            break
+        except KeyboardInterrupt:
+            break
+
+        if commands.fileno() in events:
+            try:
+                while running and commands.poll():
+                    cmd = commands.recv()
+                    try:
+                        running = handle_command(
+                            cmd, sub_sock, subscriptions, decoders, active, log
+                        )
+                    except Exception:
+                        log.exception("error encountered")
+            except (EOFError, IOError):
+                log.error('The command pipe is closed, probably a broken pipe. Exiting..')
                 break
 
-            if cmd['action'] == 'SUBSCRIBE':
-                msg = 'Subscribing with stream filter: [{}]'
-                stream_filter = cmd['stream_filter']
-                log.info(msg.format(stream_filter))
-                # add the callback to the list of things to do for the stream
-                if stream_filter in subscriptions:
-                    subscriptions[stream_filter].append(cmd['callback'])
-                else:
-                    subscriptions[stream_filter] = [cmd['callback']]
-                    sub_sock.setsockopt_string(zmq.SUBSCRIBE, stream_filter)
-
-                log.info("subscriptions: {}".format(subscriptions))
-
-            if (cmd['action'] == 'UNSUBSCRIBE' or
-                    cmd['action'] == 'REMOVE_ALL_CBS'):
-                msg = 'Unsubscribing to stream filter: [{}]'
-                log.info(msg.format(cmd['stream_filter']))
-                sub_sock.setsockopt_string(zmq.UNSUBSCRIBE, stream_filter)
-
-            if cmd['action'] == 'REMOVE_ALL_CBS':
-                msg = 'Removing all callbacks for stream filter: [{}]'
-                log.info(msg.format(cmd['stream_filter']))
-                del subscriptions[cmd['stream_filter']]
-
-        except multiprocessing.queues.Empty:
-            pass
-        except IOError:
-            log.error('IOError, probably a broken pipe. Exiting..')
-            sys.exit(1)
-        except:
-            log.exception("error encountered")
-
-        try:
-            [streamID, content] = sub_sock.recv_multipart()
-            try:
-                log.info("new data")
-                for cb in subscriptions[streamID]:
-                    cb(streamID, json.loads(content), log)
-            except KeyError:
-                msg = "An unrecognized streamID `{}` was encountered"
-                log.error(msg.format(streamID))
-        except zmq.ZMQError as e:
-            if e.errno != zmq.EAGAIN:
-                log.exception("zmq error encountered")
-        except:
-            log.exception("error encountered")
+        if sub_sock in events:
+            for _ in range(max_batch):
+                try:
+                    stream_filter, content = sub_sock.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                except zmq.ZMQError:
+                    log.exception("zmq error encountered")
+                    break
+                log.debug("new data")
+                try:
+                    dispatch(stream_filter, content, subscriptions, decoders, log)
+                except Exception:
+                    log.exception("error encountered")
 
     log.info('Shutting down poller loop.')
-    sub_sock.close()
+    sub_sock.close(linger=0)
     context.term()
+    commands.close()
 
 
 class Subscriber(reciever.Reciever):
@@ -107,21 +219,23 @@ class Subscriber(reciever.Reciever):
         self.connect(self.read_sock, self.read_port)
         # request the available streams from the server
         self.get_available_streams()
-        # set up queue for inter-process communication
-        self.queue = multiprocessing.Queue()
+        # set up a pipe for inter-process communication
+        self.commands, commands = multiprocessing.Pipe()
         # start process
         sub_addr = "tcp://{}:{}".format(self.ip, self.sub_port)
         self.loop = multiprocessing.Process(
             target=loop,
-            args=(sub_addr, self.queue, logger)
+            args=(sub_addr, commands, logger)
         )
         self.loop.start()
 
     def close(self):
         super(Subscriber, self).close()
-        self.queue.put({'action': 'SHUTDOWN'})
+        self.commands.send({'action': 'SHUTDOWN'})
+        self.loop.join(1)
+        self.commands.close()
 
-    def subscribe(self, stream, callback=None):
+    def subscribe(self, stream, callback=None, records=False):
         """!@brief Subscribe to a data stream and assign a callback
 
         You can subscribe to multiple data streams simultaneously using the
@@ -133,9 +247,15 @@ class Subscriber(reciever.Reciever):
         The callback has to be a standalone function, not a class method or it
         will throw an error.
 
+        When the server publishes in the binary format, the callback gets the
+        stream id number instead of the stream filter string.
+
         @param stream A string holding the stream name
         @param callback A callback function that expects a python dict with
             data
+        @param records In the binary publish format, call the callback once
+            per message with a numpy structured array holding all the
+            measurements in it, instead of once per measurement with a dict
         @return success True if the data stream subscription was successful,
             False otherwise
         """
@@ -156,24 +276,12 @@ class Subscriber(reciever.Reciever):
         cmd = {
             'action'        : 'SUBSCRIBE',
             'stream_filter' : stream_filter,
-            'callback'      : callback
+            'callback'      : callback,
+            'records'       : records,
+            'dtype'         : self.get_stream_dtype(stream)
         }
         self.log.info('sending cmd to process: {}'.format(cmd))
-        self.queue.put(cmd)
-
-    def get_stream_filter(self, stream):
-        """!@brief Make the appropriate stream filter to subscribe to a stream
-
-        @param stream A string holding the stream name
-        @return stream_filter A string holding the filter to subscribe to the
-            resquested data stream
-        """
-        stream_id = str(self.known_streams[stream]['id'])
-        # ascii to unicode str
-        stream_id = stream_id.zfill(self.filter_len)
-        stream_id = stream_id.decode('ascii')
-        self.log.info(stream_id)
-        return stream_id
+        self.commands.send(cmd)
 
     def remove_callbacks(self, stream):
         """Remove all callbacks associate with the given stream.
@@ -184,7 +292,7 @@ class Subscriber(reciever.Reciever):
         @param stream A string holding the stream name
         """
         stream_filter = self.get_stream_filter(stream)
-        self.queue.put({
+        self.commands.send({
             'action'        : 'REMOVE_ALL_CBS',
             'stream_filter' : stream_filter
         })
@@ -198,7 +306,7 @@ class Subscriber(reciever.Reciever):
         @param stream A string holding the stream name
         """
         stream_filter = self.get_stream_filter(stream)
-        self.queue.put({
+        self.commands.send({
             'action'        : 'UNSUBSCRIBE',
             'stream_filter' : stream_filter
         })
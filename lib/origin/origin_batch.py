@@ -0,0 +1,126 @@
+"""
+Functions for packing and unpacking batched native data frames.
+
+A batched frame carries many records of a single stream in one message:
+
+    stream_id | BATCH_FLAG  (uint32, network byte order)
+    record count            (uint32, network byte order)
+    frame flags             (uint8)
+    record 0 ... record N-1 (packed with the stream format string)
+
+The records are packed exactly like single native records, so a frame can be
+decoded in one pass with numpy.frombuffer and a structured dtype derived from
+the stream format string.
+If the DELTA_TIMESTAMPS flag is set, every timestamp after the first one holds
+the difference to the previous record timestamp.
+"""
+
+import struct
+import numpy as np
+
+from origin import data_types
+
+# the stream id is sent as a uint32, real ids never get close to the top bit
+BATCH_FLAG = 0x80000000
+# frame flags
+DELTA_TIMESTAMPS = 0x01
+
+BATCH_HEADER = struct.Struct("!IIB")
+
+# map struct format characters to numpy types, only binary types are allowed
+_numpy_types = {}
+for _dtype in data_types.values():
+    if _dtype["binary_allowed"]:
+        _numpy_types[_dtype["format_char"]] = _dtype["numpy"]
+
+
+def is_batch(stream_id):
+    '''Returns True if the stream id from a native message marks a batch'''
+    return (stream_id & BATCH_FLAG) != 0
+
+
+def record_dtype(format_str, names):
+    '''Make a structured numpy dtype that matches a packed native record.
+
+    @param format_str the struct format string for one record, network order
+    @param names the names for each entry in the record
+    @return a numpy dtype
+    '''
+    codes = format_str.lstrip("!><=@")
+    if len(codes) != len(names):
+        msg = "Format string `{}` does not match the {} record names."
+        raise ValueError(msg.format(format_str, len(names)))
+    fields = []
+    for name, code in zip(names, codes):
+        try:
+            dtype = np.dtype(_numpy_types[code]).newbyteorder(">")
+        except KeyError:
+            raise ValueError("Unsupported format character `{}`".format(code))
+        fields.append((str(name), dtype))
+    return np.dtype(fields)
+
+
+def pack_batch(stream_id, format_str, records, delta=False):
+    '''Pack a list of records into a batched frame.
+
+    @param stream_id the stream id number
+    @param format_str the struct format string for one record, the first
+        entry is the timestamp
+    @param records a list of record tuples, (timestamp, field1, field2, ...)
+    @param delta delta encode the timestamps
+    @return the frame as a byte string
+    '''
+    names = ["f{}".format(i) for i in range(len(format_str.lstrip("!><=@")))]
+    dtype = record_dtype(format_str, names)
+    array = np.array([tuple(r) for r in records], dtype=dtype)
+    flags = 0
+    if delta and len(array) > 1:
+        flags |= DELTA_TIMESTAMPS
+        timestamps = array[names[0]].astype(dtype[0].newbyteorder("="))
+        # uint subtraction wraps around, cumsum on the other end undoes it
+        array[names[0]][1:] = np.diff(timestamps)
+    header = BATCH_HEADER.pack(stream_id | BATCH_FLAG, len(array), flags)
+    return header + array.tobytes()
+
+
+def unpack_batch_header(frame):
+    '''Read the header from a batched frame.
+
+    @param frame the frame byte string
+    @return a tuple (stream_id, count, flags)
+    '''
+    stream_id, count, flags = BATCH_HEADER.unpack_from(frame)
+    return (stream_id & ~BATCH_FLAG, count, flags)
+
+
+def unpack_batch(frame, dtype):
+    '''Decode all the records in a batched frame.
+
+    @param frame the frame byte string
+    @param dtype the structured record dtype, see record_dtype
+    @return a structured array of records in native byte order, the
+        timestamp is always the first entry
+    '''
+    stream_id, count, flags = unpack_batch_header(frame)
+    if len(frame) != BATCH_HEADER.size + count * dtype.itemsize:
+        msg = "Frame length {} does not match {} records of {} bytes."
+        raise ValueError(msg.format(len(frame), count, dtype.itemsize))
+    records = np.frombuffer(frame, dtype=dtype, count=count, offset=BATCH_HEADER.size)
+    records = records.astype(records.dtype.newbyteorder("="))
+    if flags & DELTA_TIMESTAMPS:
+        name = dtype.names[0]
+        records[name] = np.cumsum(records[name], dtype=records.dtype[0])
+    return records
+
+
+def pack_records(stream_id, records, dtype):
+    '''Pack a structured array of records into a batched frame.
+
+    @param stream_id the stream id number
+    @param records a structured array of records, in any byte order
+    @param dtype the structured record dtype, see record_dtype
+    @return the frame as a byte string
+    '''
+    records = np.asarray(records).astype(dtype, copy=False)
+    header = BATCH_HEADER.pack(stream_id | BATCH_FLAG, len(records), 0)
+    return header + records.tobytes()
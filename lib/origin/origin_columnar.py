@@ -0,0 +1,94 @@
+"""
+Functions for packing and unpacking columnar read replies.
+
+A binary read reply is a multipart message:
+
+    frame 0 : JSON header [0, {fields: [...], dtypes: [...], lengths: [...]}]
+              paged replies also hold the cursor for the next page
+    frame 1 : raw column data of fields[0]
+    ...
+    frame N : raw column data of fields[N-1]
+
+Every column is a contiguous little endian array, dtypes holds the numpy dtype
+strings, so the columns can be wrapped with numpy.frombuffer without copying.
+Error replies are the usual single frame JSON [result, data] pair.
+"""
+
+import json
+import numpy as np
+
+from origin import data_types
+
+
+def column_array(values, dtype):
+    '''Make a contiguous little endian array from a column.
+
+    @param values an array or list of column values
+    @param dtype the server data type name of the column
+    @return a numpy array
+    '''
+    if dtype == 'string':
+        values = np.asarray(values)
+        if values.dtype.kind == 'O':
+            # strings read back from a database, make them fixed width
+            values = np.array(values.tolist())
+    else:
+        values = np.asarray(values, dtype=data_types[dtype]['numpy'])
+    values = values.astype(values.dtype.newbyteorder('<'), copy=False)
+    return np.ascontiguousarray(values)
+
+
+def pack_columns(data, types, extra=None):
+    '''Pack the columns of a read reply into frames.
+
+    @param data a dictionary with fields as keys and columns as values
+    @param types a dictionary with the server data type name of each field
+    @param extra an optional dictionary of entries to add to the header
+    @return a list of frames, the JSON header followed by the column buffers
+    '''
+    fields = sorted(data.keys())
+    columns = [column_array(data[field], types[field]) for field in fields]
+    header = dict(extra or {})
+    header.update({
+        'fields': fields,
+        'dtypes': [column.dtype.str for column in columns],
+        'lengths': [len(column) for column in columns],
+    })
+    return [json.dumps((0, header))] + columns
+
+
+def unpack_columns(header, buffers):
+    '''Wrap the column buffers of a binary read reply with numpy arrays.
+
+    The arrays share memory with the buffers, so they are read only.
+
+    @param header the decoded JSON header dictionary
+    @param buffers a list of objects exposing the buffer interface
+    @return a dictionary with fields as keys and numpy arrays as values
+    '''
+    if len(buffers) != len(header['fields']):
+        msg = "Binary reply has {} column frames, expected {}."
+        raise ValueError(msg.format(len(buffers), len(header['fields'])))
+    data = {}
+    columns = zip(header['fields'], header['dtypes'], header['lengths'], buffers)
+    for field, dtype, length, buf in columns:
+        data[field] = np.frombuffer(buf, dtype=np.dtype(str(dtype)), count=length)
+    return data
+
+
+def json_columns(data):
+    '''Convert numpy values in a reply to python types for JSON encoding.
+
+    @param data a dictionary, possibly nested, of reply values
+    @return a copy of data with lists in place of numpy arrays
+    '''
+    result = {}
+    for key, value in data.items():
+        if isinstance(value, np.ndarray):
+            value = value.tolist()
+        elif isinstance(value, np.generic):
+            value = value.item()
+        elif isinstance(value, dict):
+            value = json_columns(value)
+        result[key] = value
+    return result
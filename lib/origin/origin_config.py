@@ -0,0 +1,21 @@
+"""
+Function for reading optional settings from the config file
+"""
+
+import ConfigParser
+
+
+def config_option(config, section, option, default, getter='get'):
+    '''Read an optional setting from the config object.
+
+    @param config ConfigParser object
+    @param section the config section name
+    @param option the option name
+    @param default value returned if the section or option is not present
+    @param getter name of the ConfigParser get method, e.g. 'getint'
+    @return the option value or the default
+    '''
+    try:
+        return getattr(config, getter)(section, option)
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        return default
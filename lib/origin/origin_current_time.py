@@ -5,6 +5,8 @@ Timestamping related functions
 import calendar
 import time
 
+from origin.origin_config import config_option
+
 def current_time(config):
     '''Figures out the current time in the format that origin wants'''
 
@@ -12,3 +14,9 @@ def current_time(config):
     if config.get('Server', "timestamp_type") == "uint64":
         return long(time.time()*2**32)
     return calendar.timegm(time.gmtime())
+
+def timestamp_ticks(config):
+    '''Timestamp units per second, uint64 timestamps are 32.32 fixed point'''
+    if config_option(config, 'Server', "timestamp_type", "uint64") == "uint64":
+        return 2**32
+    return 1
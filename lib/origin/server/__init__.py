@@ -6,11 +6,23 @@ from origin.server.origin_measurement_validation import measurement_validation
 
 from origin.server.origin_template_validation import template_validation
 
+from origin.server.origin_decode_plan import DecodePlan
+
+from origin.server.origin_record_batch import RecordBatch
+
 from origin.server.origin_destination import Destination
 
+from origin.server.origin_write_behind import WriteBehind
+
+from origin.server.origin_rollup import Rollups
+
+from origin.server.origin_read_cache import ReadCache
+
+from origin.server.origin_publisher import Publisher
+
 
 # if you dont want to install these modules then just comment the ones you dont want to use
-from origin.server.origin_hdf5_destination import HDF5Destination
+from origin.server.origin_hdf5_destination import HDF5Destination, HDF5Reader, LayoutLock
 #from origin.server.origin_mysql_destination import MySQLDestination
 #from origin.server.origin_filesystem_destination import FilesystemDestination
 #from origin.server.origin_mongodb_destination import MongoDBDestination
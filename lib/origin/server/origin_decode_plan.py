@@ -0,0 +1,51 @@
+"""
+This module provides the DecodePlan class that holds everything needed to
+decode native data packets for one stream, so it only has to be worked out once.
+"""
+
+import struct
+
+from origin import TIMESTAMP
+from origin.origin_batch import record_dtype
+
+
+class DecodePlan(object):
+    """!@brief A precompiled description of how to decode a stream's native
+    data packets.
+
+    Plans are built when the stream definitions are read from the destination
+    and every time a stream is registered.
+    """
+
+    def __init__(self, stream_obj):
+        """!@brief Compile the plan for the current version of a stream.
+
+        @param stream_obj the knownStreams entry for the stream
+        """
+        self.stream = stream_obj["stream"]
+        self.id = stream_obj["id"]
+        self.version = stream_obj["version"]
+        self.key_order = stream_obj["key_order"] or []
+        self.format_str = stream_obj["format_str"]
+        # position of each entry in the unpacked record, timestamp first
+        self.names = [TIMESTAMP] + [str(key) for key in self.key_order]
+        self.field_index = dict((name, i) for i, name in enumerate(self.names))
+
+        if self.format_str:
+            self.struct = struct.Struct(str(self.format_str))
+            self.dtype = record_dtype(self.format_str, self.names)
+        else:
+            # strings or no key order, binary packets are not supported
+            self.struct = None
+            self.dtype = None
+        # values unpacked from binary are already the right type, so they can
+        # skip the measurement validation
+        self.typed = self.struct is not None
+
+    def decode(self, payload):
+        """!@brief Unpack a single native record.
+
+        @param payload the packed record, without the stream id
+        @return a dictionary of field values, including the timestamp
+        """
+        return dict(zip(self.names, self.struct.unpack_from(payload)))
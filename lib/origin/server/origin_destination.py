@@ -6,12 +6,17 @@ Destintations are databases, filesystems, file formats (HDF5, CSV), etc.
 """
 
 import struct
+import threading
+import time
 import numpy as np
 
 
 from origin.server import template_validation
 from origin.server import measurement_validation
-from origin import data_types, current_time, TIMESTAMP, registration_validation
+from origin.server import DecodePlan
+from origin.server import RecordBatch
+from origin import data_types, current_time, config_option, TIMESTAMP, registration_validation
+from origin.origin_batch import unpack_batch
 
 ###############################################################################
 #
@@ -46,6 +51,18 @@ from origin import data_types, current_time, TIMESTAMP, registration_validation
 #       ...
 #   }
 #
+#   # compiled decode plans for the current versions, see DecodePlan
+#   plans : {
+#       stream  : `decode_plan`,
+#       ...
+#   }
+#
+#   # reverse look up table for the stream names
+#   stream_ids : {
+#       `stream_id` : stream,
+#       ...
+#   }
+#
 ###############################################################################
 
 
@@ -69,9 +86,26 @@ class Destination(object):
         self.config = config
         self.known_streams = {}
         self.known_stream_versions = {}
+        self.plans = {}
+        self.stream_ids = {}
+        # optional write-behind stage, see WriteBehind
+        self.writer = None
+        # optional rollup tiers kept up to date at ingest, see Rollups
+        self.rollups = None
+        # optional cache of read replies to invalidate on writes, see ReadCache
+        self.read_cache = None
+        # held while writing to or modifying the backend from another thread
+        self.write_lock = threading.RLock()
+        # stream : [measurement dictionaries] not turned into a batch yet,
+        # see store_row
+        self.rows = {}
+        self.rows_since = {}
+        self.row_batch = config_option(config, "Server", "row_batch", 100, "getint")
+        self.row_interval = config_option(config, "Server", "row_interval", 0.1, "getfloat")
 
         self.connect()
         self.read_stream_def_table()
+        self.build_decode_plans()
 
     def connect(self):
         """!@brief Prepare the backend.
@@ -87,6 +121,15 @@ class Destination(object):
         """
         raise NotImplementedError
 
+    def flush(self, force=False):
+        """!@brief Write out measurements buffered by the destination.
+
+        The server calls this periodically, destinations that buffer writes
+        should write anything older than their flush interval, or everything
+        if force is True.
+        """
+        pass
+
     def read_stream_def_table(self):
         """!@brief Read stored metadata and populate the knownStreams, and
         knownStreamVersions dictionaries.
@@ -95,6 +138,25 @@ class Destination(object):
         """
         raise NotImplementedError
 
+    def build_decode_plans(self):
+        """!@brief Compile the decode plans and the stream id table from the
+        knownStreams dictionary.
+
+        This needs to be called every time knownStreams is reloaded.
+        """
+        plans = {}
+        stream_ids = {}
+        for stream in self.known_streams:
+            # streams without a plan can still be found by id
+            stream_ids[self.known_streams[stream]["id"]] = stream
+            try:
+                plans[stream] = DecodePlan(self.known_streams[stream])
+            except ValueError:
+                msg = "Unable to compile a decode plan for stream `{}`."
+                self.logger.exception(msg.format(stream))
+        self.plans = plans
+        self.stream_ids = stream_ids
+
     def create_new_stream(self, stream, version, template, key_order):
         """!@brief Create a new stream or create a new version of a stream based on
         a stream template.
@@ -205,6 +267,14 @@ class Destination(object):
         @return a tuple of (error, stream_ver) where error=0 for success, and
             stream_ver is a byte string that serves as a unique identifier.
         """
+        # anything queued for the old definition has to be written first
+        self.store_rows(stream)
+        if self.writer is not None:
+            self.writer.drain()
+        with self.write_lock:
+            return self._register_stream(stream, template, key_order)
+
+    def _register_stream(self, stream, template, key_order):
         update = False
         dest_version = None
         stream = stream.strip()
@@ -234,18 +304,44 @@ class Destination(object):
                 return (1, 'server error')
             # update the current streams after all that
             self.read_stream_def_table()
+            self.build_decode_plans()
+            if self.read_cache is not None:
+                self.read_cache.invalidate_stream(stream)
         return (0, struct.pack("!II", stream_id, dest_version))
 
     def insert_measurement(self, stream, measurements):
-        """!@brief Save formated measurement to the destination.
+        """!@brief Save a single formated measurement to the destination.
 
-        This method must be overwritten in the specific implementation.
+        This is a thin wrapper around insert_measurements.
 
         @param stream a string holding the stream name
         @param measurements a dictionary containing the data
         """
+        self.insert_measurements(stream, self.record_batch(stream, [measurements]))
+
+    def insert_measurements(self, stream, batch):
+        """!@brief Save a batch of formated measurements to the destination.
+
+        This method must be overwritten in the specific implementation.
+
+        @param stream a string holding the stream name
+        @param batch a RecordBatch containing the data
+        """
         raise NotImplementedError
 
+    def record_batch(self, stream, measurements):
+        """!@brief Convert measurement dictionaries into a RecordBatch.
+
+        @param stream a string holding the stream name
+        @param measurements a list of measurement dictionaries
+        @return a RecordBatch typed by the stream definition
+        """
+        return RecordBatch.from_measurements(
+            measurements,
+            self.known_stream_versions[stream],
+            self.config.get("Server", "timestamp_type")
+        )
+
     def measurement(self, stream, measurements):
         """!@brief Perfom measurement validation, timestamp data if missing field,
         then save to destination.
@@ -255,7 +351,7 @@ class Destination(object):
             result_text: message to return to client
             measurements: processed data, empty dict if error
         """
-        if stream not in self.known_streams.keys():
+        if stream not in self.known_streams:
             msg = (
                 "Trying to add a measurement to data on an unknown stream: {}"
             )
@@ -267,17 +363,91 @@ class Destination(object):
             self.logger.warning(msg)
             return (1, "Invalid measurements against schema", {})
 
+        return self.measurement_typed(stream, measurements)
+
+    def measurement_typed(self, stream, measurements):
+        """!@brief Timestamp data if missing field, then save to destination.
+
+        The measurements must already match the stream definition, this is
+        the case for data decoded with the stream's DecodePlan.
+
+        @return a tuple of (error, result_text, measurements)
+            error: 0 for successful operation
+            result_text: message to return to client
+            measurements: processed data, empty dict if error
+        """
         try:
             if measurements[TIMESTAMP] == 0:
                 raise KeyError
         except KeyError:
             measurements[TIMESTAMP] = current_time(self.config)
 
-        self.insert_measurement(stream, measurements)
+        self.store_row(stream, measurements)
         result = 0
         result_text = ""
         return (result, result_text, measurements)
 
+    def store_row(self, stream, measurement):
+        """!@brief Queue a single processed measurement.
+
+        Single measurements are kept as they are and turned into one
+        RecordBatch once there are row_batch of them, or at the first one
+        after row_interval seconds, see store_rows. The server also stores
+        them on every flush period.
+
+        @param stream a string holding the stream name
+        @param measurement a measurement dictionary matching the definition
+        """
+        rows = self.rows.get(stream)
+        if rows is None:
+            rows = self.rows[stream] = []
+            self.rows_since[stream] = time.time()
+        rows.append(measurement)
+        if (len(rows) >= self.row_batch) or (time.time() - self.rows_since[stream] >= self.row_interval):
+            self.store_rows(stream)
+
+    def store_rows(self, stream=None):
+        """!@brief Store the queued single measurements as one batch per stream.
+
+        @param stream a string holding the stream name, None for all streams
+        """
+        streams = self.rows.keys() if stream is None else [stream]
+        for stream in streams:
+            rows = self.rows.pop(stream, None)
+            self.rows_since.pop(stream, None)
+            if rows:
+                self.store_measurements(stream, self.record_batch(stream, rows))
+
+    def store_measurements(self, stream, batch):
+        """!@brief Hand processed measurements to the write-behind queue if
+        there is one, otherwise save them to the destination now.
+
+        @param stream a string holding the stream name
+        @param batch a RecordBatch containing the data
+        """
+        if stream in self.rows:
+            # keep the measurements in the order they came in
+            self.store_rows(stream)
+        if self.rollups is not None:
+            self.rollups.update(stream, batch)
+        if self.writer is not None:
+            self.writer.put(stream, batch)
+            return
+        # read workers look at the destination buffers from other threads
+        with self.write_lock:
+            self.insert_measurements(stream, batch)
+        self.inserted(stream, batch)
+
+    def inserted(self, stream, batch):
+        """!@brief Drop the cached reads that overlap measurements that were
+        just written to the destination.
+
+        @param stream a string holding the stream name
+        @param batch a RecordBatch containing the data
+        """
+        if self.read_cache is not None:
+            self.read_cache.invalidate(stream, batch.timestamps)
+
     def measurement_ordered(self, stream, time_stamp, measurements):
         """!@brief Process a list of implicitly ordered measurements, then save to
         destination.
@@ -294,10 +464,15 @@ class Destination(object):
             result_text: message to return to client
             measurements: processed data, empty dict if error
         """
-        meas = {}
-        for key in self.known_stream_versions[stream]:
-            idx = self.known_stream_versions[stream][key]["key_index"]
-            meas[key] = measurements[idx]
+        plan = self.plans.get(stream)
+        if plan is not None:
+            meas = dict(zip(plan.names[1:], measurements))
+        else:
+            # no plan was compiled for the stream, use the definition
+            meas = {}
+            for key in self.known_stream_versions[stream]:
+                idx = self.known_stream_versions[stream][key]["key_index"]
+                meas[key] = measurements[idx]
         meas[TIMESTAMP] = time_stamp
         return self.measurement(stream, meas)
 
@@ -312,18 +487,92 @@ class Destination(object):
             result_text: message to return to client
             measurements: processed data, empty dict if error
         """
-       fmtstr =  self.known_streams[stream]["format_str"]
+        plan = self.plans.get(stream)
+        if plan is None:
+            return self.measurement_unpacked(stream, measurements)
+        if not plan.typed:
+            return (1, "Stream does not support binary data.", {})
         try:
-            dtuple = struct.unpack_from(fmtstr, measurements)
-        except:
+            meas = plan.decode(measurements)
+        except struct.error:
             msg = 'Error unpacking stream data.'
             msg2 = msg + ' stream: `{}` format_str: `{}`'
-            msg2 += ' measurements bytes: `{}`'
-            self.logger.error(msg2)
+            self.logger.error(msg2.format(stream, plan.format_str))
             return (1, msg, {})
-        meas = list(dtuple[1:])
-        time_stamp = dtuple[0]
-        return self.measurement_ordered(stream, time_stamp, meas)
+        # binary data is already typed, so skip validation
+        return self.measurement_typed(stream, meas)
+
+    def measurement_unpacked(self, stream, measurements):
+        '''Unpack binary data with the format string of a stream that has no
+        decode plan, the values are validated like ordered measurements'''
+        fmtstr = self.known_streams[stream]["format_str"]
+        if not fmtstr:
+            return (1, "Stream does not support binary data.", {})
+        try:
+            dtuple = struct.unpack_from(str(fmtstr), measurements)
+        except struct.error:
+            msg = 'Error unpacking stream data.'
+            msg2 = msg + ' stream: `{}` format_str: `{}`'
+            self.logger.error(msg2.format(stream, fmtstr))
+            return (1, msg, {})
+        return self.measurement_ordered(stream, dtuple[0], list(dtuple[1:]))
+
+    def measurement_batch(self, stream, frame):
+        """!@brief Process a batched binary frame of implicitly ordered
+        measurements, then save to destination.
+
+        The whole frame is decoded in one pass, see origin.origin_batch for the
+        frame layout.
+
+        @param stream a string holding the stream name
+        @param frame the batched frame, including the header
+        @return a tuple of (error, result_text, records)
+            error: 0 for successful operation
+            result_text: message to return to client
+            records: structured array of the processed data, None if error
+        """
+        plan = self.plans.get(stream)
+        if plan is None:
+            # the records can not be laid out without a plan, see build_decode_plans
+            return (1, "Stream does not support batched data.", None)
+        if not plan.typed:
+            return (1, "Stream does not support binary data.", None)
+        try:
+            records = unpack_batch(frame, plan.dtype)
+        except (ValueError, TypeError):
+            msg = 'Error unpacking batched stream data.'
+            self.logger.exception(msg + ' stream: `{}`'.format(stream))
+            return (1, msg, None)
+
+        # binary data is already typed, so skip validation
+        time_stamps = records[TIMESTAMP]
+        missing = np.flatnonzero(time_stamps == 0)
+        if len(missing) > 1 and self.config.get("Server", "timestamp_type") != "uint64":
+            # one second steps would put the records in the future
+            msg = 'Batched records without timestamps need uint64 timestamps.'
+            self.logger.error(msg + ' stream: `{}`'.format(stream))
+            return (1, msg, None)
+        if len(missing):
+            # one tick apart, so the timestamps stay unique in the batch
+            fill = np.uint64(current_time(self.config)) + np.arange(len(missing), dtype=np.uint64)
+            time_stamps[missing] = fill
+
+        self.store_measurements(stream, RecordBatch.from_records(records))
+        return (0, "", records)
+
+    def encode_strings(self, column):
+        """!@brief Convert a string column to fixed length ascii strings, for
+        destinations that store strings in fixed width fields.
+
+        @param column an array or list of strings
+        @return a numpy array of the string data type
+        """
+        values = []
+        for value in column:
+            if isinstance(value, unicode):
+                value = value.encode("ascii", "ignore")
+            values.append(value)
+        return np.array(values, dtype=data_types["string"]["numpy"])
 
     def find_stream(self, stream_id):
         """!@brief Look up a stream name based on the stream id number
@@ -331,17 +580,15 @@ class Destination(object):
         @param stream_id the id number for the stream
         @return the stream name corresponding to the stream_id
         """
-        for stream in self.known_streams:
-            if self.known_streams[stream]["id"] == stream_id:
-                return stream
-        raise ValueError
+        try:
+            return self.stream_ids[stream_id]
+        except KeyError:
+            raise ValueError
 
     def get_raw_stream_data(self, stream, start=None, stop=None, fields=[]):
         """!@brief Read stream data from storage between the timestamps given by
         time = [start,stop].
 
-        This method must be overwritten in the specific implementation.
-
         @param stream a string holding the stream name
         @param start 32b unix timestamp that defines the start of the data
             window
@@ -350,12 +597,75 @@ class Destination(object):
             desired, the value of the dictionary key is arbitrary.
         @return a tuple with (error, data, msg)
             error: 0 for a successful operation
-            data: data is dictionary with fields as the keys and data lists as
-                the values
+            data: data is dictionary with fields as the keys and data arrays
+                (or lists) as the values, the server converts them for the
+                reply format
             msg: holds an error msg or '' if no error
         """
+        start, stop = self.validate_time_range(start, stop)
+        return self.read_stream_window(stream, start, stop, fields)
+
+    def read_stream_window(self, stream, start, stop, fields=[], limit=None):
+        """!@brief Read stream data from storage between full timestamps.
+
+        This method must be overwritten in the specific implementation.
+
+        @param stream a string holding the stream name
+        @param start timestamp that defines the start of the data window, in
+            the server timestamp format
+        @param stop timestamp that defines the end of the data window
+        @param fields A list that contains the fields for which data is
+            desired, the value of the dictionary key is arbitrary.
+        @param limit max number of measurements to return, the earliest ones
+            in the window are returned. None for no limit
+        @return a tuple with (error, data, msg), see get_raw_stream_data
+        """
         raise NotImplementedError
 
+    def get_raw_stream_page(self, stream, start=None, stop=None, fields=[],
+                            page_rows=10000, cursor=None):
+        """!@brief Read one page of the stream data in a time window.
+
+        Pages hold up to page_rows measurements in time order. The cursor
+        returned with a page is passed back to get the next page, it keeps the
+        time window fixed and marks where the next page starts, so a long
+        window is read in bounded memory.
+
+        @param stream a string holding the stream name
+        @param start 32b unix timestamp that defines the start of the data
+            window, ignored if a cursor is given
+        @param stop 32b unix timestamp that defines the end of the data window
+        @param fields A list that contains the fields for which data is
+            desired
+        @param page_rows max number of measurements in the page
+        @param cursor the cursor returned with the previous page, or None for
+            the first page
+        @return a tuple with (error, data, msg, cursor)
+            cursor: the cursor for the next page, None on the last page
+        """
+        if cursor is None:
+            start, stop = self.validate_time_range(start, stop)
+            skip = 0
+        else:
+            # [next timestamp, rows at that timestamp already sent, stop]
+            start, skip, stop = long(cursor[0]), int(cursor[1]), long(cursor[2])
+        # one extra row shows if there is another page
+        limit = skip + page_rows + 1
+        result, data, msg = self.read_stream_window(stream, start, stop, fields, limit=limit)
+        if result != 0:
+            return (result, data, msg, None)
+
+        time_stamps = np.asarray(data[TIMESTAMP])
+        next_cursor = None
+        end = skip + page_rows
+        if len(time_stamps) > end:
+            next_time = time_stamps[end]
+            sent = int(np.count_nonzero(time_stamps[:end] == next_time))
+            next_cursor = [long(next_time), sent, stop]
+        for field in data:
+            data[field] = data[field][skip:end]
+        return (0, data, '', next_cursor)
+
     def get_stat_stream_data(self, stream, start=None, stop=None, fields=[]):
         """!@brief Get statistics on the stream data during the time window defined by
         time = [start, stop].
@@ -0,0 +1,143 @@
+"""
+Functions for decimating raw stream data for plotting.
+
+Two methods are supported:
+
+    minmax : the time window is split into equal time buckets and the
+             measurements holding the min and max of each bucket are kept, so
+             every peak is still visible in a plot.
+    lttb   : largest triangle three buckets, keeps the measurement of each
+             bucket that forms the largest triangle with the point kept in the
+             previous bucket and the average of the next one, which preserves
+             the visual shape of the series.
+
+Every numeric field picks its own measurements out of an equal share of the
+point budget, the rows picked by any field are returned for all the fields,
+so the series stay aligned on one set of timestamps.
+"""
+
+import numpy as np
+
+from origin import TIMESTAMP
+
+METHODS = ('minmax', 'lttb')
+# the fewest points each numeric field can be decimated to
+MIN_POINTS = {'minmax': 2, 'lttb': 3}
+
+
+def bucket_ids(time_stamps, buckets):
+    '''Split increasing timestamps into equal time buckets.
+
+    @param time_stamps an array of increasing timestamps
+    @param buckets the number of buckets
+    @return an array with the bucket number of each timestamp
+    '''
+    time_stamps = np.asarray(time_stamps)
+    offset = (time_stamps - time_stamps[0]).astype(np.float64)
+    span = offset[-1] + 1.
+    return np.minimum((offset * buckets / span).astype(np.int64), buckets - 1)
+
+
+def minmax_indices(time_stamps, values, points):
+    '''Get the indices of the min and max measurement in each time bucket.
+
+    @param time_stamps an array of increasing timestamps
+    @param values an array of numeric values
+    @param points the max number of indices to return
+    @return an increasing array of indices
+    '''
+    count = len(values)
+    if count <= points:
+        return np.arange(count)
+    values = np.asarray(values)
+    buckets = bucket_ids(time_stamps, max(1, points // 2))
+    # the timestamps are increasing, so each bucket is a run of rows
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    sizes = np.diff(np.r_[starts, count])
+    picks = []
+    for reduce_ in (np.fmin, np.fmax):
+        extremes = np.repeat(reduce_.reduceat(values, starts), sizes)
+        # the first row of each bucket that holds the extreme value
+        hits = np.flatnonzero(values == extremes)
+        pos = np.searchsorted(hits, starts)
+        picks.append(hits[pos[pos < len(hits)]])
+    return np.unique(np.concatenate(picks))
+
+
+def lttb_indices(time_stamps, values, points):
+    '''Get the indices picked by the largest triangle three buckets method.
+
+    The first and last measurements are always kept. The bucket averages are
+    computed for all buckets at once, the triangle areas for one bucket at a
+    time, since each pick depends on the previous one.
+
+    @param time_stamps an array of increasing timestamps
+    @param values an array of numeric values
+    @param points the max number of indices to return, at least 3
+    @return an increasing array of indices
+    '''
+    count = len(values)
+    points = max(points, 3)
+    if count <= points:
+        return np.arange(count)
+    x = (np.asarray(time_stamps) - time_stamps[0]).astype(np.float64)
+    y = np.asarray(values, dtype=np.float64)
+    # points - 2 buckets between the first and last measurement
+    edges = np.linspace(1, count - 1, points - 1).astype(np.int64)
+    sizes = np.diff(np.r_[edges, count])
+    avg_x = np.add.reduceat(x, edges) / sizes
+    avg_y = np.add.reduceat(y, edges) / sizes
+
+    picked = np.empty(points, dtype=np.int64)
+    picked[0] = 0
+    picked[-1] = count - 1
+    a = 0
+    for i in range(points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # the last bucket is followed by the last measurement
+        area = np.abs(
+            (x[a] - avg_x[i + 1]) * (y[lo:hi] - y[a]) -
+            (x[a] - x[lo:hi]) * (avg_y[i + 1] - y[a])
+        )
+        a = lo + int(np.argmax(area))
+        picked[i + 1] = a
+    return picked
+
+
+def downsample(data, types, max_points, method='minmax'):
+    '''Decimate raw stream data to at most max_points measurements. Every
+    numeric field needs a share of at least 2 points with minmax and 3 with
+    lttb, a smaller max_points is refused.
+
+    @param data a dictionary of arrays, with fields and the timestamp as keys
+        and the timestamps in increasing order
+    @param types a dictionary with the server data type name of each field
+    @param max_points the max number of measurements to return
+    @param method 'minmax' or 'lttb'
+    @return a dictionary of arrays holding the picked measurements
+    '''
+    if method not in METHODS:
+        raise ValueError("Unrecognized downsample method `{}`.".format(method))
+    numeric = [f for f in data if (f != TIMESTAMP) and (types[f] != 'string')]
+    least = max(1, MIN_POINTS[method] * len(numeric))
+    if max_points < least:
+        msg = "max_points must be at least {} to downsample {} numeric fields with {}."
+        raise ValueError(msg.format(least, len(numeric), method))
+    time_stamps = np.asarray(data[TIMESTAMP])
+    if len(time_stamps) <= max_points:
+        return data
+    picked = np.zeros(0, dtype=np.int64)
+    if numeric:
+        share = max_points // len(numeric)
+        picks = []
+        for field in numeric:
+            values = np.asarray(data[field])
+            if method == 'lttb':
+                picks.append(lttb_indices(time_stamps, values, share))
+            else:
+                picks.append(minmax_indices(time_stamps, values, share))
+        picked = np.unique(np.concatenate(picks))
+    if len(picked) == 0:
+        # nothing to pick by, keep evenly spaced measurements
+        picked = np.linspace(0, len(time_stamps) - 1, max_points).astype(np.int64)
+    return dict((field, np.asarray(data[field])[picked]) for field in data)
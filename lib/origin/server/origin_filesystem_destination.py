@@ -1,12 +1,28 @@
 """
 This module extends the Destination class to save data in a filesystem.
+
+Each stream version directory holds one directory per UTC day of measurement
+time, and each day directory holds one binary file per field plus the
+timestamp. The files are fixed width little endian columns of the field's
+numpy type, so row i of every file is the same measurement.
+
+    data_path/`stream`/`stream`_`version`/`YYYYMMDD`/`field`.bin
+
+Stream versions written before the binary format hold one text file per field
+directly in the version directory. Those are still read back, together with
+the day directories of anything written to the version since.
 """
 
 import os
 import json
+import time
+
+import numpy as np
 
 from origin.server import Destination
-from origin import data_types, TIMESTAMP
+from origin import data_types, TIMESTAMP, config_option
+
+SECONDS_PER_DAY = 24*60*60
 
 def get_directory_list(dir_):
     '''Returns a list of subdirectories'''
@@ -20,6 +36,27 @@ def get_current_stream_version(config, stream):
         version_dir = f.read().strip()
     return os.path.join(stream_path, version_dir)
 
+def day_name(day):
+    '''Get the directory name for a day number, days since the unix epoch'''
+    return time.strftime('%Y%m%d', time.gmtime(day * SECONDS_PER_DAY))
+
+def column_rows(path, dtype):
+    '''Get the number of complete rows in a column file'''
+    return os.path.getsize(path) // dtype.itemsize
+
+def map_column(path, dtype, rows):
+    '''Memory map the first rows of a column file read only.
+
+    @param path the column file
+    @param dtype the numpy data type of the column
+    @param rows the number of rows to map
+    @return a numpy array backed by the file
+    '''
+    if rows == 0:
+        # an empty file can't be mapped
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(rows,))
+
 class FilesystemDestination(Destination):
     '''A class for storing data in an filesystem format.'''
 
@@ -30,6 +67,27 @@ class FilesystemDestination(Destination):
         if not os.path.exists(self.data_path):
             os.makedirs(self.data_path)
             self.logger.info("Creating data directory at: " + self.data_path)
+        # bytes buffered in memory for each open column file
+        self.buffer_size = config_option(self.config, 'FileSystem', 'buffer_size', 65536, 'getint')
+        # open append handles for each stream: ((version, day), {field: file})
+        self.handles = {}
+
+    def close(self):
+        for stream in self.handles.keys():
+            self.close_handles(stream)
+
+    def flush(self, force=False):
+        '''Write the buffered measurements to the column files'''
+        for _, files in self.handles.values():
+            for f in files.values():
+                f.flush()
+
+    def flush_stream(self, stream):
+        '''Write the buffered measurements of a stream to the column files'''
+        with self.write_lock:
+            if stream in self.handles:
+                for f in self.handles[stream][1].values():
+                    f.flush()
 
     def read_stream_def_table(self):
         known_streams = {}
@@ -52,6 +110,8 @@ class FilesystemDestination(Destination):
     def create_new_stream_destination(self, stream_obj):
         stream = stream_obj["stream"]
         version = stream_obj["version"]
+        # new measurements go to the new version
+        self.close_handles(stream)
         stream_path = os.path.join(os.path.join(self.data_path, stream))
         if version == 1:    # create a new stream group under root
             os.mkdir(stream_path)
@@ -71,25 +131,154 @@ class FilesystemDestination(Destination):
             f.write(json.dumps(stream_obj['definition']))
         return stream_obj['id']
 
-    def insert_measurement(self, stream, measurements):
-        current_stream_version = get_current_stream_version(self.config, stream)
-        for field in measurements:
-            with open(os.path.join(current_stream_version, field), 'a') as f:
-                f.write(str(measurements[field]) + '\n')
+    def version_path(self, stream):
+        '''Get the directory of the current version of a stream'''
+        version_dir = stream + '_' + str(self.known_streams[stream]['version'])
+        return os.path.join(self.data_path, stream, version_dir)
 
-    # read stream data from storage between the timestamps given by time = [start,stop]
-    # only takes timestamps in seconds
-    def get_raw_stream_data(self, stream, start=None, stop=None, definition=None):
-        start, stop = self.validate_time_range(start, stop)
-        # get data from buffer
+    def column_dtype(self, stream, field):
+        '''Get the numpy data type of a column file'''
+        if field == TIMESTAMP:
+            dtype = self.config.get('Server', 'timestamp_type')
+        else:
+            dtype = self.known_stream_versions[stream][field]['type']
+        return np.dtype(data_types[dtype]['numpy']).newbyteorder('<')
+
+    def column_files(self, stream, day):
+        '''Get the open append handles to the column files of a stream for a day'''
+        key = (self.known_streams[stream]['version'], day)
         try:
-            current_stream_version = get_current_stream_version(self.config, stream)
-        except IOError:
-            self.logger.debug("Read requested on empty dataset. stream: {}", stream)
-            raise IndexError
-        if definition is None:
-            definition = self.known_stream_versions[stream]
+            handle_key, files = self.handles[stream]
+            if handle_key == key:
+                return files
+        except KeyError:
+            pass
+        # measurements moved on to a new day or version
+        self.close_handles(stream)
+        path = os.path.join(self.version_path(stream), day_name(day))
+        if not os.path.exists(path):
+            os.makedirs(path)
+        files = {}
+        for field in [TIMESTAMP] + self.known_stream_versions[stream].keys():
+            files[field] = open(os.path.join(path, field + '.bin'), 'ab', self.buffer_size)
+        self.handles[stream] = (key, files)
+        return files
+
+    def close_handles(self, stream):
+        '''Close the open column files of a stream'''
+        if stream in self.handles:
+            for f in self.handles.pop(stream)[1].values():
+                f.close()
+
+    def insert_measurements(self, stream, batch):
+        if len(batch) == 0:
+            return
+        days = (batch.timestamps.astype(np.uint64) >> np.uint64(32)) // np.uint64(SECONDS_PER_DAY)
+        for day in np.unique(days):
+            if days[0] == days[-1]:
+                rows = slice(None)
+            else:
+                rows = days == day
+            files = self.column_files(stream, int(day))
+            for field in [TIMESTAMP] + batch.fields:
+                column = batch.column(field)[rows]
+                if self.known_stream_versions[stream].get(field, {}).get('type') == 'string':
+                    column = self.encode_strings(column)
+                files[field].write(column.astype(self.column_dtype(stream, field)).tobytes())
+
+    def day_paths(self, stream, start, stop):
+        '''Get the day directories of the current stream version that overlap
+        the time window, in time order'''
+        version_path = self.version_path(stream)
+        first = day_name((long(start) >> 32) // SECONDS_PER_DAY)
+        last = day_name((long(stop) >> 32) // SECONDS_PER_DAY)
+        days = [d for d in get_directory_list(version_path) if first <= d <= last]
+        return [os.path.join(version_path, d) for d in sorted(days)]
+
+    # read stream data from storage between the timestamps given by time = [start,stop]
+    def read_stream_window(self, stream, start, stop, fields=[], limit=None):
+        if stream not in self.known_streams:
+            msg = "Requested stream `{}` does not exist.".format(stream)
+            return (1, {}, msg)
+
+        if fields == []:
+            fields = self.known_stream_versions[stream].keys()
+        for field in fields:
+            if field not in self.known_stream_versions[stream]:
+                msg = "Requested stream field `{}.{}` does not exist.".format(stream, field)
+                return (1, {}, msg)
+
+        parts = {}
+        for field in [TIMESTAMP] + fields:
+            parts[field] = []
+        text = None
+        if os.path.exists(os.path.join(self.version_path(stream), TIMESTAMP)):
+            # written before the upgrade to the binary format
+            result, text, msg = self.get_text_stream_data(stream, start, stop, fields)
+            if result != 0:
+                return (result, {}, msg)
+            if text[TIMESTAMP]:
+                for field in parts:
+                    parts[field].append(np.array(text[field], dtype=self.column_dtype(stream, field)))
+
+        # make buffered measurements visible
+        self.flush_stream(stream)
+        self.read_day_columns(stream, start, stop, fields, limit, parts)
+
+        if not parts[TIMESTAMP]:
+            msg = "No data in requested time window."
+            return (1, {}, msg)
+        data = {}
+        for field in parts:
+            # slices of the mapped files, only copied when days are joined
+            if len(parts[field]) == 1:
+                data[field] = parts[field][0]
+            else:
+                data[field] = np.concatenate(parts[field])
+        if text is not None:
+            # the text rows usually come first, but can overlap the new ones
+            time_stamps = data[TIMESTAMP]
+            if np.any(time_stamps[1:] < time_stamps[:-1]):
+                order = np.argsort(time_stamps, kind='mergesort')
+                for field in data:
+                    data[field] = data[field][order]
+            if limit is not None:
+                for field in data:
+                    data[field] = data[field][:limit]
+        return (0, data, '')
+
+    def read_day_columns(self, stream, start, stop, fields, limit, parts):
+        '''Add the rows in the time window from the day column files to the
+        lists of arrays in parts, up to limit rows'''
+        # compare in the column type, python longs would be compared as floats
+        ts_dtype = self.column_dtype(stream, TIMESTAMP)
+        start, stop = np.array([start, stop], dtype=ts_dtype)
+        remaining = limit
+        for path in self.day_paths(stream, start, stop):
+            if remaining == 0:
+                break
+            columns = {}
+            for field in [TIMESTAMP] + fields:
+                columns[field] = (os.path.join(path, field + '.bin'), self.column_dtype(stream, field))
+            # columns can only be shorter than the others after a crash
+            rows = min(column_rows(*columns[field]) for field in columns)
+            time_stamps = map_column(columns[TIMESTAMP][0], ts_dtype, rows)
+            # timestamps are expected to be increasing
+            idx_start = np.searchsorted(time_stamps, start, side='left')
+            idx_stop = np.searchsorted(time_stamps, stop, side='right')
+            if idx_stop <= idx_start:
+                continue
+            if remaining is not None:
+                idx_stop = min(idx_stop, idx_start + remaining)
+                remaining -= idx_stop - idx_start
+            parts[TIMESTAMP].append(time_stamps[idx_start:idx_stop])
+            for field in fields:
+                values = map_column(columns[field][0], columns[field][1], rows)
+                parts[field].append(values[idx_start:idx_stop])
 
+    def get_text_stream_data(self, stream, start, stop, fields):
+        '''Read stream data from a version saved in the old text format'''
+        current_stream_version = self.version_path(stream)
         start_idx = None
         stop_idx = None
         try:
@@ -101,9 +290,9 @@ class FilesystemDestination(Destination):
             while True:
                 x = f.readline()
                 x = x.strip()
-                if not x: 
+                if not x:
                     break
-                x = dtype(x) 
+                x = dtype(x)
                 if (start_idx is None) and (x >= start):
                     start_idx = i
                 if (start_idx is not None) and (x >= stop):
@@ -124,19 +313,20 @@ class FilesystemDestination(Destination):
             f.close()
 
         if (start_idx is None) or (stop_idx is None):
-            msg = "error in indexing (index start, index stop): ({},{})"
-            self.logger.warning(msg.format(start_idx, stop_idx))
-            raise IndexError
+            # newer measurements can be in the binary columns
+            msg = "No text data in the window (index start, index stop): ({},{})"
+            self.logger.debug(msg.format(start_idx, stop_idx))
+            return (0, dict((field, []) for field in [TIMESTAMP] + fields), '')
 
         self.logger.debug((start_idx, stop_idx))
-        for field in definition:
+        for field in fields:
             data[field] = []
             dtype = self.known_stream_versions[stream][field]['type']
             type_cast = data_types[dtype]['type']
             try:
                 f = open(os.path.join(current_stream_version, field), 'r')
                 i = 0
-                while i <= stop_idx:
+                while i < stop_idx:
                     x = f.readline()
                     if i >= start_idx:
                         x = type_cast(x.strip())
@@ -146,7 +336,7 @@ class FilesystemDestination(Destination):
                 pass # reached EOF
             except:
                 self.logger.exception("Unexpected exception reading from data file. Message code:")
-                raise IndexError
+                return (1, {}, "Server encountered an error.")
             finally:
                 f.close()
-        return data
+        return (0, data, '')
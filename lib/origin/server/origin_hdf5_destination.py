@@ -4,18 +4,212 @@ This module extends the Destination class to work with the HDF5 file format.
 
 import os
 import json
+import time
+import multiprocessing
+from contextlib import contextmanager
 
 import h5py
 import numpy as np
 
-from origin.server import Destination
-from origin import data_types, TIMESTAMP
+from origin.server import Destination, RecordBatch
+from origin import data_types, TIMESTAMP, config_option
+
+# dataset holding the write pointers of a stream version group
+POINTERS = TIMESTAMP + '_pointers'
+
+# times a SWMR reader reads the ring buffer again when the writer moved it
+HEAD_RETRIES = 10
+
+# length of a data file partition in seconds
+PARTITION_PERIODS = {
+    'none': None,
+    'day': 24*60*60,
+    'week': 7*24*60*60,
+}
+
+def partition_start(now, period):
+    '''Get the start of the partition period holding a unix time, days start
+    at midnight UTC and weeks on monday'''
+    # the unix epoch was on a thursday
+    offset = 4*24*60*60 if period == PARTITION_PERIODS['week'] else 0
+    return int((now - offset) // period) * period + offset
+
+def read_pointers(group):
+    '''Get the (row_count, row_count_buffer) write pointers of a stream version
+    group. row_count is the number of archived rows and row_count_buffer is the
+    position of the last entry in the ring buffer, -1 if nothing was written.'''
+    if POINTERS in group:
+        return tuple(int(x) for x in group[POINTERS][...])
+    if 'row_count' in group.attrs:
+        return (int(group.attrs['row_count']), int(group.attrs['row_count_buffer']))
+    return (0, -1)
+
+class LayoutLock(object):
+    '''Lock shared by the SWMR writer and the reader processes.
+
+    Any number of readers can hold the lock at once with reading(). The writer
+    takes it with acquire() or a with statement, which stops new readers and
+    waits for the current ones to finish. The writer side is reentrant.
+    '''
+
+    def __init__(self):
+        self.lock = multiprocessing.RLock()
+        self.readers = multiprocessing.Value('i', 0)
+
+    def acquire(self, blocking=True):
+        '''Stop new readers and wait for the current ones to finish. With
+        blocking False it does not wait, and returns True if there are no
+        readers left. New readers are kept out until release() either way.'''
+        self.lock.acquire()
+        if blocking:
+            while not self.idle():
+                time.sleep(0.001)
+        return self.idle()
+
+    def idle(self):
+        '''True if no reader holds the lock'''
+        return self.readers.value == 0
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    @contextmanager
+    def reading(self):
+        '''Hold the lock as one of the readers'''
+        with self.lock:
+            with self.readers.get_lock():
+                self.readers.value += 1
+        try:
+            yield
+        finally:
+            with self.readers.get_lock():
+                self.readers.value -= 1
+
+
+class AppendBuffer(object):
+    '''Measurements waiting to be written to a stream version group, and the
+    group write pointers kept in memory so they are not read back every time.'''
+
+    def __init__(self, group):
+        self.group = group
+        self.buffer_size = group[TIMESTAMP + '_buffer'].shape[0]
+        self.row_count, last = read_pointers(group)
+        # next free position in the ring buffer
+        self.row_count_buffer = last + 1
+        self.pending = []
+        self.pending_rows = 0
+        self.since = None
+
+    def append(self, batch):
+        '''Add a batch to the pending measurements'''
+        if self.since is None:
+            self.since = time.time()
+        self.pending.append(batch)
+        self.pending_rows += len(batch)
+
+    def age(self):
+        '''Seconds since the oldest pending measurement was added'''
+        if self.since is None:
+            return 0
+        return time.time() - self.since
+
+    def snapshot(self):
+        '''Get the pending measurements as one batch, without removing them,
+        None if there are none'''
+        if not self.pending:
+            return None
+        return RecordBatch.concatenate(list(self.pending))
+
+    def take(self):
+        '''Remove and return all pending measurements as one batch'''
+        batch = RecordBatch.concatenate(self.pending)
+        self.pending = []
+        self.pending_rows = 0
+        self.since = None
+        return batch
 
 
 class HDF5Destination(Destination):
     '''A class for storing data in an HDF5 file.'''
 
     def connect(self):
+        # measurements are buffered in memory until one of these is reached
+        self.flush_interval = config_option(self.config, 'HDF5', 'flush_interval', 1.0, 'getfloat')
+        self.flush_rows = config_option(
+            self.config, 'HDF5', 'flush_rows', self.config.getint('HDF5', 'chunksize'), 'getint'
+        )
+        self.append_buffers = {}
+        # measurements written since the last file flush, see sync
+        self.unsynced = []
+        # single-writer/multiple-reader mode, see start_swmr
+        self.swmr = config_option(self.config, 'HDF5', 'swmr', False, 'getboolean')
+        self.swmr_reader = False
+        self.layout_lock = None
+        # held while waiting for the readers to finish, see change_layout
+        self.layout_held = False
+        # stream objects whose groups wait for a layout change
+        self.layout_changes = []
+        # stream : [batches] sent for the waiting stream groups
+        self.waiting = {}
+        # SWMR needs the newest file format
+        self.libver = 'latest' if self.swmr else None
+        self.read_partition_config()
+
+        if self.catalog_enabled():
+            self.load_catalog()
+            self.known_streams = self.catalog['knownStreams']
+            self.known_stream_versions = dict(
+                (stream, self.known_streams[stream]['definition']) for stream in self.known_streams
+            )
+            self.open_partition()
+        else:
+            self.hdf5_file = self.open_data_file(self.data_file_path())
+
+    def read_partition_config(self):
+        '''Read the partition settings, data files are rolled over every period
+        and listed in a catalog'''
+        self.partition = config_option(self.config, 'HDF5', 'partition', 'none').lower()
+        if self.partition not in PARTITION_PERIODS:
+            msg = "Unrecognized partition period `{}`, using `none`."
+            self.logger.warning(msg.format(self.partition))
+            self.partition = 'none'
+        self.catalog = None
+        self.catalog_dirty = False
+        # catalog entry of the partition being written
+        self.active = None
+        # read only handles for the partitions that are no longer written
+        self.closed_files = {}
+        # id(file) : number of reads using a data file, see pin_files
+        self.pins = {}
+        # id(file) : data files that were rolled over while they were read
+        self.retired = {}
+
+    def catalog_enabled(self):
+        return PARTITION_PERIODS[self.partition] is not None
+
+    def open_data_file(self, h5f):
+        '''Open a data file for writing, it is created if it does not exist'''
+        try:
+            hdf5_file = h5py.File(h5f, 'r+', libver=self.libver)
+            self.logger.info("Opened data file: {}".format(h5f))
+        except IOError:
+            try:
+                hdf5_file = h5py.File(h5f, 'w', libver=self.libver)
+                self.logger.info("New data file: {}".format(h5f))
+            except IOError:
+                self.logger.error("Unable to create data file: {}".format(h5f))
+                raise
+        return hdf5_file
+
+    def data_dir(self):
+        '''Get the data directory, it is created if needed'''
         data_dir = self.config.get('HDF5', 'data_path')
         if not os.path.exists(data_dir):
             data_dir = os.path.join(self.config.get("Server", 'var_path'), data_dir)
@@ -23,31 +217,312 @@ class HDF5Destination(Destination):
         if not os.path.exists(data_dir):
             os.makedirs(data_dir)
             self.logger.info("Creating data directory at: " + self.config.get('HDF5', 'data_path'))
-
-        h5f = os.path.join(data_dir, self.config.get('HDF5', 'data_file'))
+        return data_dir
+
+    def data_file_path(self):
+        '''Get the path to the data file'''
+        return os.path.join(self.data_dir(), self.config.get('HDF5', 'data_file'))
+
+    def active_file_path(self):
+        '''Get the path to the data file that is being written'''
+        if self.active is None:
+            return self.data_file_path()
+        return os.path.join(self.data_dir(), self.active['file'])
+
+    ## partition catalog ##################################################
+    #
+    #   catalog : {
+    #       partition   : `period name`,
+    #       knownStreams: { ... }, # see Destination
+    #       partitions  : [ # in the order they were written
+    #           {
+    #               file    : `file name`,
+    #               start   : `period start`, # unix time, None for old files
+    #               stop    : `period end`,
+    #               closed  : `bool`,
+    #               streams : { `version group name` : [`min time`, `max time`] },
+    #           },
+    #           ...
+    #       ]
+    #   }
+    #
+    #######################################################################
+
+    def catalog_path(self):
+        stem = os.path.splitext(self.config.get('HDF5', 'data_file'))[0]
+        return os.path.join(self.data_dir(), stem + '_catalog.json')
+
+    def read_catalog(self):
+        '''Read the partition catalog, None if there is no catalog'''
         try:
-            self.hdf5_file = h5py.File(h5f, 'r+')
-            self.logger.info("Opened data file: {}".format(h5f))
+            with open(self.catalog_path(), 'r') as f:
+                return json.load(f)
         except IOError:
+            return None
+
+    def load_catalog(self):
+        '''Read the partition catalog, or start a new one. An existing
+        unpartitioned data file is added as the first, closed, partition.'''
+        self.catalog = self.read_catalog()
+        if self.catalog is None:
+            self.catalog = {'knownStreams': {}, 'partitions': []}
+            if os.path.exists(self.data_file_path()):
+                self.add_closed_partition(self.data_file_path())
+        self.catalog['partition'] = self.partition
+        self.save_catalog()
+
+    def save_catalog(self):
+        '''Write out the partition catalog, readers never see a partial file'''
+        path = self.catalog_path()
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.catalog, f)
+        os.rename(path + '.tmp', path)
+        self.catalog_dirty = False
+
+    def add_closed_partition(self, path):
+        '''Add an existing data file to the catalog'''
+        self.logger.info("Adding data file to the partition catalog: {}".format(path))
+        streams = {}
+        with h5py.File(path, 'r+') as h5f:
             try:
-                self.hdf5_file = h5py.File(h5f, 'w')
-                self.logger.info("New data file: {}".format(h5f))
-            except IOError:
-                self.logger.error("Unable to create data file: {}".format(h5f))
+                known_streams = json.loads(h5f.attrs['knownStreams'])
+            except KeyError:
+                known_streams = {}
+            for stream in known_streams:
+                group = h5f[h5f[stream].attrs['currentVersion']]
+                self.prepare_group(group)
+                time_range = self.group_time_range(group)
+                if time_range is not None:
+                    streams[group.name] = time_range
+        self.catalog['knownStreams'] = known_streams
+        self.catalog['partitions'].append({
+            'file': os.path.basename(path),
+            'start': None,
+            'stop': None,
+            'closed': True,
+            'streams': streams,
+        })
+
+    def group_time_range(self, group):
+        '''Get the [min, max] timestamps stored in a stream version group'''
+        row_count, last = read_pointers(group)
+        if last < 0:
+            return None
+        chunk_min, chunk_max = self.chunk_index(group)
+        stamps = group[TIMESTAMP + '_buffer'][:last+1]
+        if chunk_min.shape[0]:
+            stamps = np.concatenate((stamps, chunk_min[...], chunk_max[...]))
+        return [int(stamps.min()), int(stamps.max())]
+
+    def update_time_range(self, name, time_stamps):
+        '''Widen the time range of a stream version group in the partition
+        being written'''
+        streams = self.active['streams']
+        time_range = [int(time_stamps.min()), int(time_stamps.max())]
+        if name in streams:
+            time_range = [min(time_range[0], streams[name][0]), max(time_range[1], streams[name][1])]
+        if streams.get(name) != time_range:
+            streams[name] = time_range
+            self.catalog_dirty = True
+
+    def open_partition(self):
+        '''Open the partition file for the current period, it is created with
+        groups for every known stream if needed'''
+        period = PARTITION_PERIODS[self.partition]
+        start = partition_start(time.time(), period)
+        entry = None
+        if self.catalog['partitions'] and not self.catalog['partitions'][-1]['closed']:
+            entry = self.catalog['partitions'][-1]
+            if entry['start'] != start:
+                entry['closed'] = True
+                entry = None
+        if entry is None:
+            stem, ext = os.path.splitext(self.config.get('HDF5', 'data_file'))
+            entry = {
+                'file': stem + time.strftime('_%Y%m%d', time.gmtime(start)) + ext,
+                'start': start,
+                'stop': start + period,
+                'closed': False,
+                'streams': {},
+            }
+            self.catalog['partitions'].append(entry)
+        self.active = entry
+        self.hdf5_file = self.open_data_file(self.active_file_path())
+        for stream in self.known_streams:
+            stream_obj = self.known_streams[stream]
+            name = '/{0}/{0}_{1}'.format(stream, stream_obj['version'])
+            if name not in self.hdf5_file:
+                self.create_stream_groups(stream_obj)
+        self.save_catalog()
+
+    def partition_over(self):
+        '''True if the period of the partition being written is over'''
+        return (self.active is not None) and (time.time() >= self.active['stop'])
+
+    def change_layout(self, force=False):
+        '''Make the stream groups waiting to be made, and start a new partition
+        file if the current period is over.
+
+        In SWMR mode the file has to leave SWMR mode for this, with no readers
+        left. New readers are kept out right away, but the running reads are
+        only waited for if force is True. Otherwise the change is tried again
+        on the next flush, measurements keep being written in the meantime and
+        the ones for the waiting groups are held in memory.
+        '''
+        roll = self.partition_over()
+        if not (roll or self.layout_changes):
+            return
+        if self.layout_lock is None:
+            return self.roll_partition()
+        if not self.layout_held:
+            self.layout_held = True
+            idle = self.layout_lock.acquire(blocking=False)
+        else:
+            idle = self.layout_lock.idle()
+        if not (idle or force):
+            self.logger.debug("Waiting for the running reads to change the file layout.")
+            return
+        try:
+            while not self.layout_lock.idle():
+                time.sleep(0.001)
+            self.write_buffers(force=True)
+            if roll:
+                self.roll_partition()
+            else:
+                self.reopen(swmr=False)
+            for stream_obj in self.layout_changes:
+                name = '/{0}/{0}_{1}'.format(stream_obj['stream'], stream_obj['version'])
+                # a new partition has groups for every known stream already
+                if name not in self.hdf5_file:
+                    self.create_stream_groups(stream_obj)
+            self.layout_changes = []
+            self.hdf5_file.flush()
+            self.hdf5_file.swmr_mode = True
+        finally:
+            self.layout_held = False
+            self.layout_lock.release()
+        waiting, self.waiting = self.waiting, {}
+        for stream in waiting:
+            if waiting[stream]:
+                self.insert_measurements(stream, RecordBatch.concatenate(waiting[stream]))
+
+    def roll_partition(self):
+        '''Close the current partition file and open the next one'''
+        self.logger.info("Closing data file partition: {}".format(self.active['file']))
+        self.write_buffers(force=True)
+        self.append_buffers = {}
+        self.retire_file(self.hdf5_file)
+        self.open_partition()
+
+    def retire_file(self, h5f):
+        '''Close a data file that is no longer written, files that are still
+        being read are closed after the last read, see unpin_files'''
+        if id(h5f) in self.pins:
+            self.retired[id(h5f)] = h5f
+        else:
+            h5f.close()
+
+    def pin_files(self, files):
+        '''Keep data files open while they are read, call with the write lock'''
+        for h5f, active in files:
+            self.pins[id(h5f)] = self.pins.get(id(h5f), 0) + 1
+
+    def unpin_files(self, files):
+        '''Release the data files pinned for a read, call with the write lock'''
+        for h5f, active in files:
+            key = id(h5f)
+            self.pins[key] -= 1
+            if self.pins[key] == 0:
+                del self.pins[key]
+                if key in self.retired:
+                    self.retired.pop(key).close()
+
+    def partition_file(self, entry):
+        '''Get the file handle for a catalog entry, closed partitions are opened
+        read only. Call with the write lock, the handles are shared by the read
+        threads.'''
+        if entry is self.active:
+            return self.hdf5_file
+        if entry['file'] not in self.closed_files:
+            path = os.path.join(self.data_dir(), entry['file'])
+            self.closed_files[entry['file']] = h5py.File(path, 'r')
+        return self.closed_files[entry['file']]
+
+    def read_files(self, name, start, stop):
+        '''Get the data files holding data for a stream version group in a time
+        window, as (file, active) tuples in the order they were written.
+
+        @return the list of files, or None if no data was saved for the group
+        '''
+        if self.catalog is None:
+            return [(self.hdf5_file, True)]
+        saved = False
+        files = []
+        for entry in self.catalog['partitions']:
+            time_range = entry['streams'].get(name)
+            if time_range is None:
+                continue
+            saved = True
+            if (time_range[1] >= start) and (time_range[0] <= stop):
+                files.append((self.partition_file(entry), entry is self.active))
+        if not saved:
+            return None
+        return files
+
+    def start_swmr(self, layout_lock):
+        '''Switch the data file to SWMR write mode.
+
+        In SWMR mode readers in other processes (see HDF5Reader) open the file
+        while it is being written, and never wait on the writer. Datasets can
+        still be appended to, but no new objects can be made, so registering a
+        stream closes and reopens the file, see change_layout. The layout lock
+        is shared with the readers, they hold it while the file is open and the
+        writer holds it while the file is not in SWMR mode.
+
+        @param layout_lock a LayoutLock shared with the readers
+        '''
+        self.layout_lock = layout_lock
+        with self.layout_lock:
+            for stream in self.known_streams:
+                group = self.hdf5_file[self.hdf5_file[stream].attrs['currentVersion']]
+                self.prepare_group(group)
+            self.hdf5_file.flush()
+            # fails for files that were not created with the newest file format
+            self.hdf5_file.swmr_mode = True
+        self.logger.info("Data file is in SWMR write mode.")
+
+    def reopen(self, swmr):
+        '''Close and reopen the data file for writing, in or out of SWMR mode'''
+        self.append_buffers = {}
+        self.hdf5_file.close()
+        self.hdf5_file = h5py.File(self.active_file_path(), 'r+', libver=self.libver)
+        if swmr:
+            self.hdf5_file.swmr_mode = True
 
     def close(self):
         '''Disconnects and prepares to stop'''
+        if self.layout_changes:
+            self.change_layout(force=True)
+        self.write_buffers(force=True)
         self.hdf5_file.flush()
         self.hdf5_file.close()
+        for h5f in self.closed_files.values() + self.retired.values():
+            h5f.close()
 
     def read_stream_def_table(self):
         known_streams = {}
         known_stream_versions = {}
-        try:
-            known_streams = json.loads(self.hdf5_file.attrs['knownStreams'])
-        except KeyError:
-            self.logger.debug("known_streams attribute not found")
-            known_streams = {}
+        if self.layout_changes:
+            # the waiting streams are only saved with their groups
+            known_streams = self.known_streams
+        elif self.catalog is not None:
+            known_streams = self.catalog['knownStreams']
+        else:
+            try:
+                known_streams = json.loads(self.hdf5_file.attrs['knownStreams'])
+            except KeyError:
+                self.logger.debug("known_streams attribute not found")
+                known_streams = {}
 
         for stream in known_streams:
             known_stream_versions[stream] = known_streams[stream]['definition']
@@ -57,12 +532,29 @@ class HDF5Destination(Destination):
         self.print_stream_info()
 
     def create_new_stream_destination(self, stream_obj):
+        if stream_obj['stream'] in self.waiting:
+            # the groups of the old version have to be made first
+            self.change_layout(force=True)
+        # write out anything buffered for the old version
+        self.flush_stream(stream_obj['stream'])
+        self.append_buffers.pop(stream_obj['stream'], None)
+        if self.layout_lock is None:
+            return self.create_stream_groups(stream_obj)
+
+        # new objects can't be made in SWMR mode, so the groups are made once
+        # the running reads are done, see change_layout
+        self.layout_changes.append(stream_obj)
+        self.waiting[stream_obj['stream']] = []
+        self.change_layout()
+        return stream_obj['id']
+
+    def create_stream_groups(self, stream_obj):
+        '''Make the group and datasets for a new stream version'''
         stream = stream_obj['stream']
         version = stream_obj['version']
-        if version == 1:    # create a new stream group under root
-            stream_group = self.hdf5_file.create_group(stream)
-        else:
-            stream_group = self.hdf5_file[stream]
+        # a new stream, or the first version of a stream in a new partition,
+        # needs a new stream group under root
+        stream_group = self.hdf5_file.require_group(stream)
         # create a new subgroup for this instance of the current stream
         stream_ver = stream_group.create_group(stream + '_' + str(version))
 
@@ -115,175 +607,416 @@ class HDF5Destination(Destination):
                 self.logger.exception("Server error occured.")
                 return -1
 
+        self.prepare_group(stream_ver)
         self.hdf5_file.attrs['knownStreams'] = json.dumps(self.known_streams)
-        stream_ver.attrs['definition'] = json.dumps(self.known_stream_versions[stream])
+        stream_ver.attrs['definition'] = json.dumps(stream_obj['definition'])
+        if self.catalog is not None:
+            self.catalog['knownStreams'] = self.known_streams
+            self.save_catalog()
         return stream_obj['id']
 
-    def insert_measurement(self, stream, measurements):
-        dgroup = self.hdf5_file[self.hdf5_file[stream].attrs['currentVersion']]
-        if 'row_count' in dgroup.attrs:
-            row_count = dgroup.attrs['row_count']
-            row_count_buffer = dgroup.attrs['row_count_buffer'] + 1
-            buffer_size = dgroup[TIMESTAMP + '_buffer'].shape[0]
-            if row_count_buffer == buffer_size:
+    def prepare_group(self, group):
+        '''Make sure a stream version group has the chunk index and the write
+        pointer datasets, groups from older files get them added'''
+        self.chunk_index(group)
+        if POINTERS not in group:
+            group.create_dataset(POINTERS, data=np.array(read_pointers(group), dtype='int64'))
+
+    def dataset(self, group, name):
+        '''Get a dataset from a group, refreshed if the file is being read in
+        SWMR mode'''
+        dset = group[name]
+        if self.swmr_reader:
+            dset.refresh()
+        return dset
+
+    def chunk_index(self, group):
+        '''Get the datasets holding the min and max timestamp of every archived
+        chunk, the index is built first for groups that were written without one'''
+        if TIMESTAMP + '_chunk_min' not in group:
+            self.logger.info("Building the chunk index for {}".format(group.name))
+            tstype = self.config.get('Server', 'timestamp_type')
+            for suffix in ('_chunk_min', '_chunk_max'):
+                group.create_dataset(
+                    TIMESTAMP + suffix
+                    , (0,)
+                    , maxshape=(None,)
+                    , dtype=data_types[tstype]['numpy']
+                    , chunks=(1024,)
+                )
+            buffer_size = group[TIMESTAMP + '_buffer'].shape[0]
+            row_count = read_pointers(group)[0]
+            for row in range(0, row_count, buffer_size):
+                self.append_chunk_index(group, group[TIMESTAMP][row:row+buffer_size])
+        return (
+            self.dataset(group, TIMESTAMP + '_chunk_min'),
+            self.dataset(group, TIMESTAMP + '_chunk_max')
+        )
+
+    def append_chunk_index(self, group, time_stamps):
+        '''Add the timestamp range of a newly archived chunk to the index'''
+        for suffix, value in (('_chunk_min', time_stamps.min()), ('_chunk_max', time_stamps.max())):
+            dset = group[TIMESTAMP + suffix]
+            length = dset.shape[0]
+            dset.resize((length+1,))
+            dset[length] = value
+
+    def insert_measurements(self, stream, batch):
+        if len(batch) == 0:
+            return
+        if stream in self.waiting:
+            # the stream groups are not made yet
+            self.waiting[stream].append(batch)
+            return
+        try:
+            buf = self.append_buffers[stream]
+        except KeyError:
+            group = self.hdf5_file[self.hdf5_file[stream].attrs['currentVersion']]
+            self.prepare_group(group)
+            buf = AppendBuffer(group)
+            self.append_buffers[stream] = buf
+        buf.append(batch)
+        if (buf.pending_rows >= self.flush_rows) or (buf.age() >= self.flush_interval):
+            self.write_buffer(stream, buf)
+            self.sync()
+
+    def write_buffer(self, stream, buf):
+        '''Write the pending measurements of a stream as contiguous slices'''
+        dgroup = buf.group
+        batch = buf.take()
+        if self.active is not None:
+            self.update_time_range(dgroup.name, batch.timestamps)
+        columns = {TIMESTAMP: batch.timestamps}
+        for field in batch.columns:
+            columns[field] = batch.columns[field]
+            if self.known_stream_versions[stream][field]['type'] == "string":
+                columns[field] = self.encode_strings(batch.columns[field])
+
+        # archive the ring buffer every time it fills up
+        written = 0
+        while written < len(batch):
+            if buf.row_count_buffer == buf.buffer_size:
                 msg = "Buffer is full. Moving completed chunk to archive and "
                 msg += "wrapping pointer around."
                 self.logger.debug(msg)
                 length = dgroup[TIMESTAMP].shape[0]
                 chunksize = self.config.getint('HDF5', 'chunksize')
-                for field in measurements:
-                    dgroup[field][row_count:] = dgroup[field+'_buffer']
+                row_count = buf.row_count
+                for field in columns:
+                    chunk = dgroup[field+'_buffer'][...]
+                    dgroup[field][row_count:row_count+buf.buffer_size] = chunk
                     dgroup[field].resize((length+chunksize,))
-                row_count += buffer_size
-                row_count_buffer = 0
+                    if field == TIMESTAMP:
+                        self.append_chunk_index(dgroup, chunk)
+                buf.row_count += buf.buffer_size
+                buf.row_count_buffer = 0
+            count = min(len(batch) - written, buf.buffer_size - buf.row_count_buffer)
+            pointer = buf.row_count_buffer
+            for field in columns:
+                dgroup[field+"_buffer"][pointer:pointer+count] = columns[field][written:written+count]
+            buf.row_count_buffer += count
+            written += count
+
+        dgroup[POINTERS][...] = (buf.row_count, buf.row_count_buffer - 1)
+        if not self.swmr:
+            # attributes can't be written in SWMR mode, kept for older readers
+            dgroup.attrs['row_count'] = buf.row_count # move pointer for next entry
+            dgroup.attrs['row_count_buffer'] = buf.row_count_buffer - 1 # last entry
         else:
-            row_count = 0
-            row_count_buffer = 0
-
-        dgroup.attrs['row_count'] = row_count # move pointer for next entry
-        dgroup.attrs['row_count_buffer'] = row_count_buffer # move pointer for next entry
-
-        for field in measurements:
-            if field != TIMESTAMP: # if we dont check it will throw KeyError
-                dtype = self.known_stream_versions[stream][field]['type']
-                if dtype == "string":
-                    measurements[field] = measurements[field].encode("ascii", "ignore")
-            dgroup[field+"_buffer"][row_count_buffer] = measurements[field]
+            # reader processes only see the measurements after the file flush
+            self.unsynced.append((stream, batch))
+
+    def flush(self, force=False):
+        '''Write buffered measurements that are older than the flush interval,
+        or all of them if force is True, then roll over to a new partition if
+        the current one is over'''
+        self.write_buffers(force)
+        self.change_layout()
+
+    def write_buffers(self, force=False):
+        '''Write buffered measurements that are older than the flush interval,
+        or all of them if force is True'''
+        flushed = False
+        for stream, buf in self.append_buffers.items():
+            if buf.pending_rows and (force or (buf.age() >= self.flush_interval)):
+                self.write_buffer(stream, buf)
+                flushed = True
+        if flushed:
+            self.sync()
+
+    def flush_stream(self, stream):
+        '''Write all buffered measurements of a stream'''
+        with self.write_lock:
+            buf = self.append_buffers.get(stream)
+            if (buf is not None) and buf.pending_rows:
+                self.write_buffer(stream, buf)
+                self.sync()
+
+    def sync(self):
+        '''Flush the data file, then save the catalog if it changed, so readers
+        never find time ranges for data that is not in the file'''
         self.hdf5_file.flush()
-
-    def get_raw_stream_data(self, stream, start=None, stop=None, fields=[]):
+        if self.catalog_dirty:
+            self.save_catalog()
+        for stream, batch in self.unsynced:
+            Destination.inserted(self, stream, batch)
+        self.unsynced = []
+
+    def inserted(self, stream, batch):
+        '''Reader processes in SWMR mode only see the measurements after the
+        file flush, the cached reads are dropped then'''
+        if not self.swmr:
+            Destination.inserted(self, stream, batch)
+
+    def read_stream_window(self, stream, start, stop, fields=[], limit=None):
         '''read stream data from storage between the timestamps given by time = [start,stop]
-        only takes timestamps in second
+
+        Only the partitions that hold data in the window are opened.
         '''
-        start, stop = self.validate_time_range(start, stop)
         self.logger.debug("Read request time range (start, stop): ({},{})".format(start, stop))
-        # get data from buffer
-        try:
-            stream_group = self.hdf5_file[self.hdf5_file[stream].attrs['currentVersion']]
-        except KeyError:
+        if stream not in self.known_streams:
             msg = "Requested stream `{}` does not exist.".format(stream)
             return (1, {}, msg)
 
         if fields == []:
-             fields = self.known_stream_versions[stream].keys()
-
-        # read ring buffers and pointers in case the pointer advances during read
-        raw_data = {}
+            fields = self.known_stream_versions[stream].keys()
+        for field in fields:
+            if field not in self.known_stream_versions[stream]:
+                msg = "Requested stream field `{}.{}` does not exist.".format(stream, field)
+                return (1, {}, msg)
+
+        name = '/{0}/{0}_{1}'.format(stream, self.known_streams[stream]['version'])
+        # the writer can roll over to a new partition at any time, so the files
+        # are looked up and pinned together
+        with self.write_lock:
+            files = self.read_files(name, start, stop)
+            if (stream in self.append_buffers) and not any(active for h5f, active in files or []):
+                # buffered measurements are read with the file being written
+                files = (files or []) + [(self.hdf5_file, True)]
+            self.pin_files(files or [])
+        parts = []
         try:
-            raw_data[TIMESTAMP] = {
-                'pointer': stream_group.attrs['row_count_buffer'], # pointer in ring buffer
-                'array':  stream_group[TIMESTAMP + '_buffer']
-            }
-        except KeyError:
+            for h5f, active in files or []:
+                part = self.read_group(stream, h5f[name], fields, start, stop, active, limit)
+                if part is not None:
+                    parts.append(part)
+        finally:
+            with self.write_lock:
+                self.unpin_files(files or [])
+        if (files is None) or (files and not parts):
             # no data has been saved yet, so all queries are out of range
             msg = "Stream declared, but no data saved."
             return (1, {}, msg)
 
-        try:
-            for field in fields:
-                raw_data[field] = {
-                    'pointer': stream_group.attrs['row_count_buffer'], # pointer in ring buffer
-                    'array':  stream_group[field + '_buffer']
-                }
-        except KeyError:
-            msg = "Requested stream field `{}.{}` does not exist.".format(stream, field)
+        time_stamps = np.concatenate([part[0] for part in parts] or [[]])
+        if len(time_stamps) == 0:
+            msg = "No data in requested time window."
             return (1, {}, msg)
+        order = None
+        if len(parts) > 1 and np.any(time_stamps[1:] < time_stamps[:-1]):
+            # partitions can overlap if old timestamps were sent
+            order = np.argsort(time_stamps, kind='mergesort')
+        if (limit is not None) and (len(time_stamps) > limit):
+            # every part holds its earliest rows, so the earliest overall are kept
+            if order is None:
+                order = slice(0, limit)
+            else:
+                order = order[:limit]
 
-        # correct the ring buffer order to linear
-        pointer = raw_data[TIMESTAMP]['pointer']+1
-        array = raw_data[TIMESTAMP]['array']
-
-        # check if the buffer has the requested range first, it usually will be
-        buff_start = array[pointer]
-        # if this is our first pass then the buffer starts at position 0
-        # we can tell because if the timestamp is 0, it has not been overwritten yet
-        if buff_start == 0:
-            buff_start = array[0]
+        data = {}
+        for field in [TIMESTAMP] + fields:
+            if field == TIMESTAMP:
+                values = time_stamps
+            else:
+                values = np.concatenate([part[1][field] for part in parts])
+            if order is not None:
+                values = values[order]
+            data[field] = values
+        return (0, data, '')
 
-        if buff_start > start: # if not go look for it
-            # data after pointer has already been saved to the archive
-            raw_data[TIMESTAMP] = array[:pointer]
+    def group_pointers(self, group):
+        '''Get the write pointers of a stream version group, see read_pointers,
+        refreshed if the file is being read in SWMR mode'''
+        if POINTERS in group:
+            return tuple(int(x) for x in self.dataset(group, POINTERS)[...])
+        return read_pointers(group)
+
+    def read_head(self, group, fields):
+        '''Read the write pointers, the chunk index and the ring buffer of a
+        stream version group, they change with every write so they have to be
+        read together.
+
+        The writer process does not wait for SWMR readers, so they read the
+        pointers again afterwards and start over if they moved. Rows written
+        after the ones that were read don't change them, so if the writer
+        keeps writing the last try is kept as long as the ring buffer was not
+        archived and reused.
+        '''
+        for attempt in range(HEAD_RETRIES):
+            row_count, last = self.group_pointers(group)
+            if last < 0:
+                return None
+            chunk_min, chunk_max = [dset[...] for dset in self.chunk_index(group)]
+            buffer_data = {}
+            for field in [TIMESTAMP] + fields:
+                buffer_data[field] = self.dataset(group, field + '_buffer')[:last+1]
+            head = (row_count, chunk_min, chunk_max, buffer_data)
+            if not self.swmr_reader:
+                # the writer holds the write lock, or the file is closed
+                return head
+            pointers = self.group_pointers(group)
+            if pointers == (row_count, last):
+                return head
+        if pointers[0] == row_count:
+            return head
+        msg = "The ring buffer of `{}` kept moving while it was read."
+        raise IOError(msg.format(group.name))
+
+    def read_group(self, stream, group, fields, start, stop, active, limit=None):
+        '''Read the measurements in a time window from a stream version group.
+
+        Timestamps are expected to be increasing, so the per-chunk timestamp
+        index and the buffer can be searched with np.searchsorted, and only the
+        archived chunks that overlap the window are read. Measurements still
+        buffered in memory are read from a copy, the buffer is left to the
+        writer.
+
+        @param stream a string holding the stream name
+        @param active True if the group is in the file that is being written
+        @param limit max number of measurements to read, None for no limit
+        @return a tuple (timestamps, {field: values}) of arrays, or None if
+            no data has been saved in the group
+        '''
+        pending = None
+        if active:
+            # the archive never changes below row_count, but the ring buffer
+            # and the write buffer do
+            with self.write_lock:
+                if not self.swmr_reader:
+                    self.prepare_group(group)
+                head = self.read_head(group, fields)
+                buf = self.append_buffers.get(stream)
+                if (buf is not None) and (buf.group == group):
+                    pending = buf.snapshot()
+        else:
+            head = self.read_head(group, fields)
+        part = None
+        if head is not None:
+            part = self.read_saved(group, fields, start, stop, head, limit)
+        if pending is not None:
+            part = self.add_pending(stream, part, pending, fields, start, stop, limit)
+        return part
+
+    def add_pending(self, stream, part, pending, fields, start, stop, limit):
+        '''Add the buffered measurements in the time window to the rows read
+        from the file, they were sent after the rows in the file'''
+        time_stamps = pending.timestamps
+        start, stop = np.array([start, stop], dtype=time_stamps.dtype)
+        rows = (time_stamps >= start) & (time_stamps <= stop)
+        columns = {TIMESTAMP: time_stamps[rows]}
+        for field in fields:
+            columns[field] = pending.columns[field][rows]
+            if self.known_stream_versions[stream][field]['type'] == "string":
+                columns[field] = self.encode_strings(columns[field])
+        if part is not None:
+            columns[TIMESTAMP] = np.concatenate((part[0], columns[TIMESTAMP]))
             for field in fields:
-                raw_data[field] = raw_data[field]['array'][:pointer]
-
-            raw_data = self.get_archived_stream_data(
-                stream_group,
-                start,
-                stop,
-                raw_data,
-                fields
-            )
-
-        else:   # otherwise all requested data is contained in the buffer
-            raw_data[TIMESTAMP] = np.concatenate((array[pointer:], array[:pointer]))
+                columns[field] = np.concatenate((part[1][field], columns[field]))
+        time_stamps = columns.pop(TIMESTAMP)
+        if limit is not None:
+            time_stamps = time_stamps[:limit]
             for field in fields:
-                field_pointer = raw_data[field]['pointer']+1
-                offset = field_pointer - pointer
-                array = raw_data[field]['array']
-                length = len(array)
-                # in the ring buffer the oldest data could have been overwritten during the read
-                if offset < 0:
-                    self.logger.debug("negative offset")
-                    offset += length
-                raw_data[field] = np.concatenate((
-                    np.full(offset, None)
-                    , array[pointer+offset:]
-                    , array[:pointer+offset]
-                ))[:length]
-
-        # now filter the data down to the requested range
-        idx_start = None
-        idx_stop = None # when slicing None goes to end of list not -1
-        for i, time_stamp in enumerate(raw_data[TIMESTAMP]):
-            if (idx_start is None) and (time_stamp >= start):
-                idx_start = i
-            elif time_stamp > stop:
-                idx_stop = i-1
-                break
-
-        if idx_start is None:
-            msg = "error in indexing (index start, index stop): ({},{})"
-            self.logger.warning(msg.format(idx_start, idx_stop))
-            msg = "No data in requested time window."
-            return (1, {}, msg)
+                columns[field] = columns[field][:limit]
+        return (time_stamps, columns)
+
+    def read_saved(self, group, fields, start, stop, head, limit):
+        '''Read the measurements in a time window from the archive and the ring
+        buffer of a stream version group, see read_group'''
+        row_count, chunk_min, chunk_max, buffer_data = head
+        # compare in the timestamp type, python longs would be compared as floats
+        start, stop = np.array([start, stop], dtype=buffer_data[TIMESTAMP].dtype)
+
+        # archived chunks [first, last) overlap the window
+        buffer_size = group[TIMESTAMP + '_buffer'].shape[0]
+        first = np.searchsorted(chunk_max, start, side='left')
+        last = np.searchsorted(chunk_min, stop, side='right')
+        if limit is not None:
+            # the chunks after the first one are all in the window
+            last = min(last, first + 1 + (limit + buffer_size - 1) // buffer_size)
+        archive_start = first * buffer_size
+        archive_stop = max(min(last * buffer_size, row_count), archive_start)
+
+        time_stamps = np.concatenate((
+            self.dataset(group, TIMESTAMP)[archive_start:archive_stop],
+            buffer_data[TIMESTAMP]
+        ))
+        idx_start = np.searchsorted(time_stamps, start, side='left')
+        idx_stop = max(np.searchsorted(time_stamps, stop, side='right'), idx_start)
+        if limit is not None:
+            idx_stop = min(idx_stop, idx_start + limit)
+
+        # split the window into the archive part and the buffer part
+        archive_rows = archive_stop - archive_start
+        a_start = archive_start + min(idx_start, archive_rows)
+        a_stop = archive_start + min(idx_stop, archive_rows)
+        b_start = max(idx_start - archive_rows, 0)
+        b_stop = max(idx_stop - archive_rows, 0)
+
+        columns = {}
+        for field in fields:
+            values = buffer_data[field][b_start:b_stop]
+            if a_stop > a_start:
+                values = np.concatenate((self.dataset(group, field)[a_start:a_stop], values))
+            columns[field] = values
+        return (time_stamps[idx_start:idx_stop], columns)
 
-        data = {}
-        # json method cant handle numpy array
-        data[TIMESTAMP] = raw_data[TIMESTAMP][idx_start:idx_stop].tolist()
+class HDF5Reader(HDF5Destination):
+    '''A read only view of an HDF5 data file that is being written in SWMR mode
+    by another process.
 
-        for field in fields:
-            # json method cant handle numpy array
-            data[field] = raw_data[field][idx_start:idx_stop].tolist()
-        return (0, data, '')
+    The file is only open between open() and close(), so the writer can get
+    the layout lock when it has to leave SWMR mode or roll over to a new
+    partition. Partitions that are no longer written stay open read only.
+    '''
 
-    def get_archived_stream_data(self, stream_group, start, stop, buffer_data, fields):
-        '''get raw_data in range from the archived data'''
-        time_dset = stream_group[TIMESTAMP]
-        row_pointer = stream_group.attrs['row_count']
-        # if there is no old data then just stop now
-        if row_pointer == 0:
-            return buffer_data
-
-        old_data = {}
-        # make as big as it needs to be then resize
-        old_data[TIMESTAMP] = np.zeros(row_pointer)
-        for field in fields:
-            old_data[field] = np.zeros(row_pointer)
-        chunksize = self.config.getint('HDF5', 'chunksize')
-        row_pointer -= chunksize
-        # pull data out by chunksize until the end of the data set,
-        # or the start time has been reached
-        while row_pointer >= 0:
-            chunk = time_dset[row_pointer:row_pointer+chunksize]
-            pnt = row_pointer
-            if chunk[0] < stop:
-                old_data[TIMESTAMP][pnt:pnt+chunksize] = chunk
-                for field in fields:
-                    old_data[field][pnt:pnt+chunksize] = stream_group[field][pnt:pnt+chunksize]
-            if chunk[0] < start:
-                old_data[TIMESTAMP] = np.concatenate((old_data[TIMESTAMP][pnt:], buffer_data[TIMESTAMP]))
-                for field in fields:
-                    old_data[field] = np.concatenate((old_data[field][pnt:], buffer_data[field]))
-                break
-            row_pointer -= chunksize
-        return old_data
+    def connect(self):
+        self.append_buffers = {}
+        self.swmr = True
+        self.swmr_reader = True
+        self.layout_lock = None
+        self.hdf5_file = None
+        self.read_partition_config()
+
+    def read_stream_def_table(self):
+        # nothing to read until the file is opened
+        pass
+
+    def open(self):
+        '''Open the data file in SWMR read mode and load the stream definitions'''
+        if self.catalog_enabled():
+            self.catalog = self.read_catalog()
+            self.active = self.catalog['partitions'][-1]
+            known_streams = self.catalog['knownStreams']
+        self.hdf5_file = h5py.File(self.active_file_path(), 'r', libver='latest', swmr=True)
+        if self.catalog is None:
+            try:
+                known_streams = json.loads(self.hdf5_file.attrs['knownStreams'])
+            except KeyError:
+                known_streams = {}
+        self.known_streams = known_streams
+        self.known_stream_versions = dict(
+            (stream, known_streams[stream]['definition']) for stream in known_streams
+        )
+        self.build_decode_plans()
+
+    def close(self):
+        '''Close the data file, closed partitions are kept open'''
+        if self.hdf5_file is not None:
+            self.hdf5_file.close()
+            self.hdf5_file = None
+
+    def create_new_stream_destination(self, stream_obj):
+        raise NotImplementedError
+
+    def insert_measurements(self, stream, batch):
+        raise NotImplementedError
@@ -1,11 +1,53 @@
 """
 This module extends the Destination class to work with a mongo database.
+
+Measurements are stored in time bucketed documents, one collection per stream
+version:
+
+    {
+        bucket : `bucket start`, # unix time, multiple of bucket_seconds
+        n      : `number of samples`,
+        tmin   : `min timestamp`,
+        tmax   : `max timestamp`,
+        measurement_time : [`timestamp`, ...],
+        `field1`         : [`value`, ...],
+        ...
+    }
+
+Numbers are stored as native BSON types. BSON only has signed 64b integers,
+so uint64 values, including the timestamps, are stored as int64 with the top
+bit flipped, v ^ 2**63. That keeps their order, so range queries still work.
 """
 
+import numpy as np
 import pymongo
 
 from origin.server import Destination
-from origin import data_types, TIMESTAMP
+from origin import data_types, TIMESTAMP, config_option
+
+UINT64_FLIP = np.uint64(2**63)
+
+def encode_column(values, dtype):
+    '''Convert a column to a list of BSON compatible values
+
+    @param values a numpy array
+    @param dtype the server data type name
+    '''
+    if dtype == 'uint64':
+        return (values.astype(np.uint64) ^ UINT64_FLIP).view(np.int64).tolist()
+    return values.tolist()
+
+def decode_column(values, dtype):
+    '''Convert a list of stored values back to a numpy array
+
+    @param values a list of values from the database
+    @param dtype the server data type name
+    '''
+    if dtype == 'uint64':
+        return np.array(values, dtype=np.int64).view(np.uint64) ^ UINT64_FLIP
+    if dtype == 'string':
+        return np.array(values, dtype=object)
+    return np.array(values, dtype=data_types[dtype]['numpy'])
 
 class MongoDBDestination(Destination):
     '''A class for storing data in a mongodb database.'''
@@ -16,6 +58,13 @@ class MongoDBDestination(Destination):
             port=self.config.getint("MongoDB", "port")
         )
         self.db = self.client[self.config.get("MongoDB", "db")]
+        self.timestamp_type = self.config.get("Server", "timestamp_type")
+        # bucket documents hold the samples from one time span, and are split
+        # when they reach the max number of samples
+        self.bucket_seconds = config_option(self.config, "MongoDB", "bucket_seconds", 3600, "getint")
+        self.bucket_size = config_option(self.config, "MongoDB", "bucket_size", 1000, "getint")
+        # collections holding one document per sample from older versions
+        self.legacy = {}
 
     def close(self):
         self.client.close()
@@ -31,48 +80,145 @@ class MongoDBDestination(Destination):
             self.db.known_streams.create_index([('id', pymongo.ASCENDING)], unique=True)
         self.known_streams = known_streams
         self.known_stream_versions = known_stream_versions
+        for stream in known_streams:
+            self.create_indexes(stream)
+
+    def collection(self, stream):
+        '''Get the collection for the current version of a stream'''
+        stream_obj = self.known_streams[stream]
+        return self.db["{}_{}".format(stream, stream_obj["version"])]
+
+    def create_indexes(self, stream):
+        '''Make the bucket index for the current version of a stream'''
+        self.collection(stream).create_index([
+            ('bucket', pymongo.ASCENDING),
+            ('n', pymongo.ASCENDING)
+        ])
 
     def create_new_stream_destination(self, stream_obj):
         stream_id = stream_obj["id"]
         # update/create document in db
         self.db.known_streams.replace_one({'id': stream_id}, stream_obj, upsert=True)
+        self.create_indexes(stream_obj["stream"])
         return stream_id
 
-    def insert_measurement(self, stream, measurements):
-        stream_obj = self.known_streams[stream]
-        stream_collection = "{}_{}".format(stream, stream_obj["version"])
-        str_meas = {TIMESTAMP: measurements[TIMESTAMP]}
-        for key in measurements: # mongodb doesn't do unsigned ints, because its dumb
-            if key != TIMESTAMP: # could be smarter about this, but I'm tired
-                str_meas[key] = str(measurements[key])
-        self.db[stream_collection].insert_one(str_meas)
+    def buckets(self, time_stamps):
+        '''Get the bucket start time for timestamps'''
+        seconds = time_stamps.astype(np.uint64) >> np.uint64(32)
+        return (seconds // np.uint64(self.bucket_seconds)) * np.uint64(self.bucket_seconds)
+
+    def insert_measurements(self, stream, batch):
+        if len(batch) == 0:
+            return
+        definition = self.known_stream_versions[stream]
+        buckets = self.buckets(batch.timestamps)
+        # split the batch where the bucket changes, then into bucket_size pieces
+        edges = (np.flatnonzero(buckets[1:] != buckets[:-1]) + 1).tolist()
+        requests = []
+        for first, last in zip([0] + edges, edges + [len(batch)]):
+            for start in range(first, last, self.bucket_size):
+                rows = batch.slice(start, min(start + self.bucket_size, last))
+                time_stamps = encode_column(rows.timestamps, self.timestamp_type)
+                push = {TIMESTAMP: {'$each': time_stamps}}
+                for field in rows.fields:
+                    values = encode_column(rows.columns[field], definition[field]['type'])
+                    push[field] = {'$each': values}
+                # add to a bucket document that has room, or start a new one
+                requests.append(pymongo.UpdateOne(
+                    {'bucket': int(buckets[start]), 'n': {'$lt': self.bucket_size}},
+                    {
+                        '$push': push,
+                        '$inc': {'n': len(rows)},
+                        '$min': {'tmin': min(time_stamps)},
+                        '$max': {'tmax': max(time_stamps)},
+                    },
+                    upsert=True
+                ))
+        self.collection(stream).bulk_write(requests, ordered=True)
 
     # read stream data from storage between the timestamps given by time = [start,stop]
-    def get_raw_stream_data(self, stream, start=None, stop=None, definition=None):
-        start, stop = self.validate_time_range(start, stop)
+    def read_stream_window(self, stream, start, stop, fields=[], limit=None):
+        if stream not in self.known_streams:
+            msg = "Requested stream `{}` does not exist.".format(stream)
+            return (1, {}, msg)
 
-        stream_obj = self.known_streams[stream]
-        stream_collection = "{}_{}".format(stream, stream_obj["version"])
+        definition = self.known_stream_versions[stream]
+        if fields == []:
+            fields = definition.keys()
+        for field in fields:
+            if field not in definition:
+                msg = "Requested stream field `{}.{}` does not exist.".format(stream, field)
+                return (1, {}, msg)
 
-        if definition is None:
-            definition = self.known_streams[stream]["definition"]
+        types = dict((field, definition[field]['type']) for field in fields)
+        types[TIMESTAMP] = self.timestamp_type
+        start, stop = np.array([start, stop], dtype=data_types[self.timestamp_type]['numpy'])
+        enc_start, enc_stop = encode_column(np.array([start, stop]), self.timestamp_type)
+        buckets = self.buckets(np.array([start, stop])).tolist()
 
-        field_list = [field for field in definition]
-        data = {TIMESTAMP: []}
-        for field in field_list:
-            data[field] = []
+        values = dict((field, []) for field in types)
+        cursor = self.collection(stream).find(
+            {
+                'bucket': {'$gte': buckets[0], '$lte': buckets[1]},
+                'tmin': {'$lte': enc_stop},
+                'tmax': {'$gte': enc_start},
+            },
+            projection=types.keys() + ['bucket']
+        ).sort([('bucket', pymongo.ASCENDING), ('tmin', pymongo.ASCENDING)])
+        count = 0
+        full_bucket = None
+        for doc in cursor:
+            if (full_bucket is not None) and (doc['bucket'] > full_bucket):
+                # later buckets only hold later measurements
+                break
+            for field in types:
+                values[field].extend(doc[field])
+            if limit is not None:
+                count += sum(1 for ts in doc[TIMESTAMP] if enc_start <= ts <= enc_stop)
+                if (count >= limit) and (full_bucket is None):
+                    full_bucket = doc['bucket']
+        parts = [dict((field, decode_column(values[field], types[field])) for field in types)]
+        if self.has_legacy_documents(stream):
+            parts.append(self.get_legacy_stream_data(stream, start, stop, types, limit))
 
-        results = self.db[stream_collection].find({"$and": [
-            {TIMESTAMP: {"$gte": start}},
-            {TIMESTAMP: {"$lte": stop}}
-        ]})
+        data = {}
+        for field in types:
+            data[field] = np.concatenate([part[field] for part in parts])
+        rows = (data[TIMESTAMP] >= start) & (data[TIMESTAMP] <= stop)
+        if not rows.any():
+            msg = "No data in requested time window."
+            return (1, {}, msg)
+        order = np.argsort(data[TIMESTAMP][rows], kind='mergesort')[:limit]
+        for field in types:
+            data[field] = data[field][rows][order]
+        return (0, data, '')
 
-        for meas in results:
-            for field in field_list:
-                # recast to native type from string because mongo is stupid
-                dtype = data_types[self.known_stream_versions[stream][field]['type']]
-                data[field].append(dtype['type'](meas[field]))
-            dtype = data_types[self.config.get("Server", "timestamp_type")]   
-            data[TIMESTAMP].append(dtype['type'](meas[TIMESTAMP]))
+    def has_legacy_documents(self, stream):
+        '''Check if the current version of a stream holds one document per
+        sample with string values, as written by older versions'''
+        collection = self.collection(stream)
+        if collection.name not in self.legacy:
+            doc = collection.find_one({'bucket': {'$exists': False}}, projection=['_id'])
+            self.legacy[collection.name] = doc is not None
+            if doc is not None:
+                collection.create_index([(TIMESTAMP, pymongo.ASCENDING)])
+        return self.legacy[collection.name]
 
-        return (0, data, '')
+    def get_legacy_stream_data(self, stream, start, stop, types, limit=None):
+        '''Read one document per sample data in a time window'''
+        results = self.collection(stream).find({
+            'bucket': {'$exists': False},
+            TIMESTAMP: {'$gte': long(start), '$lte': long(stop)},
+        }).sort(TIMESTAMP, pymongo.ASCENDING).limit(limit or 0)
+        values = dict((field, []) for field in types)
+        for meas in results:
+            for field in types:
+                # values were stored as strings
+                values[field].append(data_types[types[field]]['type'](meas[field]))
+        columns = {}
+        for field in types:
+            if types[field] == 'string':
+                columns[field] = np.array(values[field], dtype=object)
+            else:
+                columns[field] = np.array(values[field], dtype=data_types[types[field]]['numpy'])
+        return columns
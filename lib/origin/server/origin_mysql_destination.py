@@ -3,12 +3,13 @@ This module extends the Destination class to work with a MySQL database.
 """
 
 import sys
+import time
 
 import mysql.connector
-from mysql.connector import errorcode
+from mysql.connector import errorcode, pooling
 
 from origin.server import Destination
-from origin import data_types, TIMESTAMP
+from origin import data_types, TIMESTAMP, config_option
 
 
 class MySQLDestination(Destination):
@@ -16,6 +17,20 @@ class MySQLDestination(Destination):
 
     def connect(self):
         db = self.config.get("MySQL", "db")
+        # inserts are committed in groups, every commit_rows rows or
+        # commit_interval seconds, whichever comes first
+        self.commit_interval = config_option(self.config, "MySQL", "commit_interval", 0., "getfloat")
+        self.commit_rows = config_option(self.config, "MySQL", "commit_rows", 10000, "getint")
+        self.uncommitted_rows = 0
+        # inserted batches, read connections only see them after the commit
+        self.uncommitted = []
+        self.last_commit = time.time()
+        # (stream, batch, tries) for inserts that failed, sent again on flush
+        self.retries = []
+        self.insert_tries = config_option(self.config, "MySQL", "insert_tries", 3, "getint")
+        # insert query strings for each stream version and field list
+        self.insert_queries = {}
+
         self.cnx = mysql.connector.connect(
             user=self.config.get("MySQL", "user"),
             password=self.config.get("MySQL", "password"),
@@ -34,6 +49,21 @@ class MySQLDestination(Destination):
         except Exception:
             self.logger.exception('Unexpected exception when connecting to database.')
 
+        # reads get their own connections so they don't wait behind inserts,
+        # one for each read worker by default
+        workers = config_option(self.config, "ReadPool", "workers", 4, "getint")
+        # a read that has to wait longer for a connection has timed out anyway
+        self.read_pool_wait = config_option(self.config, "ReadPool", "read_timeout", 60, "getfloat")
+        self.read_pool = pooling.MySQLConnectionPool(
+            pool_name="origin_read",
+            pool_size=config_option(self.config, "MySQL", "read_pool_size", workers, "getint"),
+            user=self.config.get("MySQL", "user"),
+            password=self.config.get("MySQL", "password"),
+            host=self.config.get("MySQL", "server_ip"),
+            database=db,
+            autocommit=True
+        )
+
     def create_database(self, db=''):
         '''Creates a new database default name comes from the specification in the config file'''
         query = "CREATE DATABASE {} DEFAULT CHARACTER SET 'utf8'"
@@ -55,8 +85,53 @@ class MySQLDestination(Destination):
         cursor.close()
 
     def close(self):
+        self.flush(force=True)
+        for stream, batch, tries in self.retries:
+            msg = "Dropping {} measurements of stream `{}` that could not be inserted."
+            self.logger.error(msg.format(len(batch), stream))
         self.cnx.close()
 
+    def read_connection(self):
+        '''Get a read connection from the pool, waiting for one if they are
+        all in use. Replaced read workers can still hold one.'''
+        deadline = time.time() + self.read_pool_wait
+        while True:
+            try:
+                return self.read_pool.get_connection()
+            except mysql.connector.errors.PoolError:
+                if time.time() >= deadline:
+                    raise
+                time.sleep(0.01)
+
+    def flush(self, force=False):
+        '''Send failed inserts again, then commit inserted measurements if the
+        commit interval is up, or always if force is True'''
+        self.retry_inserts()
+        self.commit_due(force)
+
+    def commit_due(self, force=False):
+        '''Commit inserted measurements if the commit interval is up, or
+        always if force is True'''
+        if self.uncommitted_rows and (force or (time.time() - self.last_commit >= self.commit_interval)):
+            self.commit()
+
+    def commit(self):
+        '''Commit the inserted measurements'''
+        try:
+            self.cnx.commit()
+        except mysql.connector.Error:
+            self.logger.exception('Error committing data to mysql server.')
+        for stream, batch in self.uncommitted:
+            Destination.inserted(self, stream, batch)
+        self.uncommitted_rows = 0
+        self.uncommitted = []
+        self.last_commit = time.time()
+
+    def inserted(self, stream, batch):
+        '''Read connections only see the measurements after the commit, the
+        cached reads are dropped then'''
+        pass
+
     def read_stream_def_table(self):
         # make a table for the list of streams
         stream_creation = (
@@ -218,40 +293,70 @@ class MySQLDestination(Destination):
         self.cnx.commit()
         cursor.close()
         # should we close the cursor here?
+        self.insert_queries = {}
         return stream_id
 
-    def insert_measurement(self, stream, measurements):
-        measurement_array = []
-        keys = measurements.keys()
-        keys.sort()
-        for k in keys:
-            measurement_array.append((k, measurements[k]))
-
-        fmt = ["("]
-        values = []
-        for entry in measurement_array:
-            fmt += [entry[0], ',']
-            values.append(entry[1])
-        fmt[-1] = ")"
-        value_placeholders = "(" + ','.join(["%s"]*len(measurement_array)) + ")"
+    def insert_query(self, stream, fields):
+        '''Get the insert query string for the current version of a stream.
 
+        Only the query text is cached, these are not server side prepared
+        statements. The connector turns executemany with a plain INSERT into
+        one multi-row statement, a prepared cursor would send the rows one at
+        a time.'''
         version = self.known_streams[stream]["version"]
-        query = """INSERT INTO measurements_{}_{} {} VALUES {}"""
-        query = query.format(stream, version, ''.join(fmt), value_placeholders)
-        #self.logger.debug(query)
-        #self.logger.debug(values)
+        key = (stream, version, tuple(fields))
+        try:
+            return self.insert_queries[key]
+        except KeyError:
+            value_placeholders = "(" + ','.join(["%s"]*len(fields)) + ")"
+            query = """INSERT INTO measurements_{}_{} ({}) VALUES {}"""
+            query = query.format(stream, version, ','.join(fields), value_placeholders)
+            self.insert_queries[key] = query
+            return query
+
+    def insert_measurements(self, stream, batch):
+        if len(batch) == 0:
+            return
+        if not self.execute_insert(stream, batch):
+            self.retries.append((stream, batch, 1))
+        if self.uncommitted_rows >= self.commit_rows:
+            self.commit()
+        else:
+            self.commit_due()
+
+    def execute_insert(self, stream, batch):
+        '''Send a batch as one multi-row insert, returns False if it failed'''
+        fields = [TIMESTAMP] + sorted(batch.fields)
+        query = self.insert_query(stream, fields)
+        # native python types for the connector
+        rows = zip(*[batch.column(field).tolist() for field in fields])
         cursor = self.cnx.cursor()
         try:
-            cursor.execute(query, values)
-        except IntegrityError:
-            self.exception('Error writing data to mysql server.')
-        self.cnx.commit()
-        cursor.close()
+            cursor.executemany(query, rows)
+        except mysql.connector.Error:
+            self.logger.exception('Error writing data to mysql server.')
+            return False
+        finally:
+            cursor.close()
+        self.uncommitted_rows += len(batch)
+        self.uncommitted.append((stream, batch))
+        return True
+
+    def retry_inserts(self):
+        '''Send the batches that failed to insert again, a batch is dropped
+        after insert_tries failures'''
+        retries, self.retries = self.retries, []
+        for stream, batch, tries in retries:
+            if self.execute_insert(stream, batch):
+                continue
+            if tries + 1 < self.insert_tries:
+                self.retries.append((stream, batch, tries + 1))
+            else:
+                msg = "Dropping {} measurements of stream `{}` after {} failed inserts."
+                self.logger.error(msg.format(len(batch), stream, tries + 1))
 
     # read stream data from storage between the timestamps given by time = [start,stop]
-    def get_raw_stream_data(self, stream, start=None, stop=None, fields=[]):
-        start, stop = self.validate_time_range(start, stop)
-
+    def read_stream_window(self, stream, start, stop, fields=[], limit=None):
         if stream not in self.known_streams:
             msg = "Requested stream `{}` does not exist.".format(stream)
             return (1, {}, msg)
@@ -265,7 +370,7 @@ class MySQLDestination(Destination):
                     msg = "Requested stream field `{}.{}` does not exist.".format(stream, f)
                     return (1, {}, msg)
 
-        fields.append(TIMESTAMP)
+        fields = fields + [TIMESTAMP]
         query = "SELECT %s FROM measurements_%s_%d WHERE %s BETWEEN %d AND %d"
         values = (
             ",".join(fields),
@@ -275,22 +380,29 @@ class MySQLDestination(Destination):
             start,
             stop
         )
+        if limit is not None:
+            query += " ORDER BY {} LIMIT {:d}".format(TIMESTAMP, limit)
         #print query % values
-        cursor = self.cnx.cursor()
-        cursor.execute(query % values)
-
         data = {}
 
         for field in fields:
             data[field] = []
 
-        results = cursor.fetchall()
-
-        err = 0
-        if cursor.rowcount <= 0:
-            msg = "Stream declared, but no data saved."
-            err = 1
-        cursor.close()
+        # only committed measurements are visible
+        cnx = self.read_connection()
+        try:
+            cursor = cnx.cursor()
+            cursor.execute(query % values)
+            results = cursor.fetchall()
+
+            err = 0
+            if cursor.rowcount <= 0:
+                msg = "Stream declared, but no data saved."
+                err = 1
+            cursor.close()
+        finally:
+            # back to the pool
+            cnx.close()
 
         for row in results:
             for i, field in enumerate(fields):
@@ -298,3 +410,75 @@ class MySQLDestination(Destination):
         if err == 0:
             return (0, data, '')
         return (1, {}, msg)
+
+    def get_stat_stream_data(self, stream, start=None, stop=None, fields=[]):
+        '''Get statistics on the stream data in the time window. The statistics
+        are computed by the database in one query, so only the aggregates are
+        sent over the connection. String fields are returned raw.'''
+        start, stop = self.validate_time_range(start, stop)
+
+        if stream not in self.known_streams:
+            msg = "Requested stream `{}` does not exist.".format(stream)
+            return (1, {}, msg)
+
+        definition = self.known_stream_versions[stream]
+        if fields == []:
+            fields = definition.keys()
+        else:
+            # check that the requestd fields are all in the stream defintion
+            for f in fields:
+                if f not in definition:
+                    msg = "Requested stream field `{}.{}` does not exist.".format(stream, f)
+                    return (1, {}, msg)
+
+        numeric = [f for f in fields if definition[f]['type'] != 'string']
+        strings = [f for f in fields if definition[f]['type'] == 'string']
+        columns = ["COUNT(*)", "MIN({})".format(TIMESTAMP), "MAX({})".format(TIMESTAMP)]
+        for field in numeric:
+            columns += [
+                "AVG({})".format(field),
+                "STDDEV_POP({})".format(field),
+                "MIN({})".format(field),
+                "MAX({})".format(field),
+            ]
+        table = "measurements_{}_{}".format(stream, self.known_streams[stream]["version"])
+        where = "{} BETWEEN %s AND %s".format(TIMESTAMP)
+        query = "SELECT {} FROM {} WHERE {}"
+
+        string_rows = []
+        cnx = self.read_connection()
+        try:
+            cursor = cnx.cursor()
+            cursor.execute(query.format(",".join(columns), table, where), (start, stop))
+            row = cursor.fetchone()
+            if strings and row[0]:
+                cursor.execute(query.format(",".join(strings), table, where), (start, stop))
+                string_rows = cursor.fetchall()
+            cursor.close()
+        except mysql.connector.Error:
+            self.logger.exception("Exception in server code:")
+            msg = "Could not process request."
+            return (1, {}, msg)
+        finally:
+            # back to the pool
+            cnx.close()
+
+        if row[0] == 0:
+            msg = "Stream declared, but no data saved."
+            return (1, {}, msg)
+
+        data = {TIMESTAMP: {'start': row[1], 'stop': row[2]}}
+        for i, field in enumerate(numeric):
+            avg, std, min, max = row[3 + 4*i:7 + 4*i]
+            # AVG of an integer column is a decimal, convert everything back to
+            # the native python type for JSON serialization
+            dtype = data_types[definition[field]['type']]["type"]
+            data[field] = {
+                'average': float(avg),
+                'standard_deviation': float(std),
+                'max': dtype(max),
+                'min': dtype(min)
+            }
+        for i, field in enumerate(strings):
+            data[field] = [r[i] for r in string_rows]
+        return (0, data, '')
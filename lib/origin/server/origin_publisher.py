@@ -0,0 +1,297 @@
+"""
+This module provides the Publisher class, a publisher thread that owns the
+publish socket, so encoding and sending measurements to the subscribers is
+kept off the ingest thread.
+
+The ingest thread hands measurements to the publisher thread over an inproc
+PUSH/PULL pair, without encoding them. Each hand-off message is
+
+    stream id  (uint32, network byte order)
+    kind       F : a batched native frame as it came in, see origin.origin_batch
+               R : native byte order records of the stream dtype
+               S : one record packed with the stream format string
+               D : a marshalled measurement dictionary, for streams with strings
+    payload
+"""
+
+import json
+import marshal
+import struct
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import zmq
+
+from origin import config_option, TIMESTAMP
+from origin.origin_batch import (
+    unpack_batch, unpack_batch_header, pack_records, BATCH_HEADER
+)
+
+# json : ascii stream id topic, one JSON measurement per message
+# binary : uint32 stream id topic, batched native frames
+PUBLISH_FORMATS = ('json', 'binary')
+
+STREAM_ID = struct.Struct("!I")
+
+
+class Publisher(object):
+    """!@brief A publisher thread between the ingest path and the subscribers.
+
+    The publish socket is an XPUB socket, the publisher thread tracks the
+    subscribed topics so the ingest thread does not hand off measurements of
+    streams nobody subscribes to. The thread drains the hand-off socket in
+    chunks and publishes each stream in a chunk at once.
+    """
+
+    def __init__(self, logger, config, dest):
+        """!@brief Bind the sockets and start the publisher thread.
+
+        @param logger pass in a logger object
+        @param config configuration object
+        @param dest the destination, for the stream definitions
+        """
+        self.logger = logger
+        self.dest = dest
+        self.publish_format = config_option(config, 'Server', 'publish_format', 'json')
+        if self.publish_format not in PUBLISH_FORMATS:
+            msg = "Unrecognized publish format `{}`."
+            raise ValueError(msg.format(self.publish_format))
+        self.queue_size = config_option(config, 'Publisher', 'queue_size', 10000, 'getint')
+        self.max_batch = config_option(config, 'Publisher', 'max_batch', 1000, 'getint')
+
+        context = zmq.Context.instance()
+        self.pub_socket = context.socket(zmq.XPUB)
+        self.pub_socket.bind("tcp://*:{}".format(config.getint('Server', 'pub_port')))
+        address = "inproc://publisher_{}".format(id(self))
+        self.pull_socket = context.socket(zmq.PULL)
+        self.pull_socket.set_hwm(self.queue_size)
+        self.pull_socket.bind(address)
+        self.push_socket = context.socket(zmq.PUSH)
+        self.push_socket.set_hwm(self.queue_size)
+        self.push_socket.connect(address)
+
+        # subscribed topic prefixes, and topic : True if anyone subscribes to
+        # it. The publisher thread replaces both when the subscriptions change,
+        # the prefixes first, so a lookup never caches a stale answer
+        self.subscriptions = frozenset()
+        self.subscribed = {}
+        self.counters = {
+            'queued': 0,
+            'dropped': 0,
+            'published': 0,
+            'messages': 0,
+            'failed': 0,
+        }
+        self.running = True
+        self.thread = threading.Thread(target=self.publisher_loop, name='publisher')
+        self.thread.daemon = True
+        self.thread.start()
+        msg = "Publisher started. format: {}, queue size: {}"
+        self.logger.info(msg.format(self.publish_format, self.queue_size))
+
+    def topic(self, stream_id):
+        '''the publish topic of a stream'''
+        if self.publish_format == 'binary':
+            return STREAM_ID.pack(stream_id)
+        return b"{0:04d}".format(stream_id)
+
+    def has_subscribers(self, stream_id):
+        """!@brief Check if anyone subscribes to a stream.
+
+        @param stream_id the stream id number
+        @return True if the stream has subscribers
+        """
+        subscribed = self.subscribed
+        topic = self.topic(stream_id)
+        try:
+            return subscribed[topic]
+        except KeyError:
+            found = any(topic.startswith(prefix) for prefix in self.subscriptions)
+            subscribed[topic] = found
+            return found
+
+    def hand_off(self, stream_id, kind, payload, count):
+        '''send measurements to the publisher thread, without blocking'''
+        try:
+            self.push_socket.send_multipart(
+                [STREAM_ID.pack(stream_id), kind, payload], flags=zmq.NOBLOCK, copy=False
+            )
+        except zmq.Again:
+            self.counters['dropped'] += count
+            return False
+        self.counters['queued'] += count
+        return True
+
+    def publish(self, stream_id, stream, measurements):
+        """!@brief Hand off one measurement for publishing, from the ingest
+        thread.
+
+        @param stream_id the stream id number
+        @param stream a string holding the stream name
+        @param measurements the measurement dictionary, with the timestamp
+        """
+        if not self.has_subscribers(stream_id):
+            return
+        plan = self.dest.plans.get(stream)
+        if (plan is not None) and plan.typed:
+            try:
+                record = plan.struct.pack(*[measurements[name] for name in plan.names])
+                self.hand_off(stream_id, b'S', record, 1)
+                return
+            except struct.error:
+                pass
+        self.hand_off(stream_id, b'D', marshal.dumps(measurements), 1)
+
+    def publish_batch(self, stream_id, stream, frame, records):
+        """!@brief Hand off a batch of measurements for publishing, from the
+        ingest thread.
+
+        The batched frame is handed off as it came in, unless the server had
+        to fill in timestamps.
+
+        @param stream_id the stream id number
+        @param stream a string holding the stream name
+        @param frame the batched frame, including the header
+        @param records the structured array of processed records
+        """
+        if not self.has_subscribers(stream_id):
+            return
+        dtype = self.dest.plans[stream].dtype
+        flags = unpack_batch_header(frame)[2]
+        sent = np.frombuffer(frame, dtype=dtype, count=len(records), offset=BATCH_HEADER.size)
+        if (flags == 0) and sent[TIMESTAMP].all():
+            self.hand_off(stream_id, b'F', frame, len(records))
+        else:
+            self.hand_off(stream_id, b'R', records.tobytes(), len(records))
+
+    def publisher_loop(self):
+        """!@brief Track subscriptions and publish handed off measurements."""
+        poller = zmq.Poller()
+        poller.register(self.pull_socket, zmq.POLLIN)
+        poller.register(self.pub_socket, zmq.POLLIN)
+        while self.running:
+            try:
+                events = dict(poller.poll(100))
+            except zmq.ZMQError:
+                break
+            if self.pub_socket in events:
+                self.update_subscriptions()
+            if self.pull_socket in events:
+                items = []
+                while len(items) < self.max_batch:
+                    try:
+                        items.append(self.pull_socket.recv_multipart(zmq.NOBLOCK))
+                    except zmq.Again:
+                        break
+                self.publish_items(items)
+        self.pub_socket.close(linger=0)
+        self.pull_socket.close(linger=0)
+
+    def update_subscriptions(self):
+        '''read the subscription messages, 1 (subscribe) or 0 (unsubscribe)
+        followed by the topic prefix'''
+        subscriptions = set(self.subscriptions)
+        while True:
+            try:
+                msg = self.pub_socket.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            if msg[:1] == b'\x01':
+                subscriptions.add(msg[1:])
+            elif msg[:1] == b'\x00':
+                subscriptions.discard(msg[1:])
+        self.subscriptions = frozenset(subscriptions)
+        self.subscribed = {}
+
+    def publish_items(self, items):
+        """!@brief Group handed off measurements by stream and publish them.
+
+        @param items list of hand-off messages
+        """
+        groups = OrderedDict()
+        for item in items:
+            groups.setdefault(STREAM_ID.unpack(item[0])[0], []).append(item[1:])
+        for stream_id in groups:
+            try:
+                self.publish_stream(stream_id, groups[stream_id])
+            except Exception:
+                self.counters['failed'] += len(groups[stream_id])
+                msg = "Error publishing measurements for stream id {}."
+                self.logger.exception(msg.format(stream_id))
+
+    def publish_stream(self, stream_id, parts):
+        """!@brief Encode and send the handed off measurements of one stream.
+
+        Measurements are sent in hand-off order, runs of records are sent
+        together.
+
+        @param stream_id the stream id number
+        @param parts list of (kind, payload) pairs
+        """
+        topic = self.topic(stream_id)
+        plan = self.dest.plans.get(self.dest.find_stream(stream_id))
+        if (plan is None) and any(kind != b'D' for kind, _ in parts):
+            raise ValueError("No decode plan for the records of stream id {}.".format(stream_id))
+        binary = self.publish_format == 'binary'
+        if binary and (len(parts) == 1) and (parts[0][0] == b'F'):
+            self.send(topic, [parts[0][1]], BATCH_HEADER.unpack_from(parts[0][1])[1])
+            return
+
+        records = []
+        for kind, payload in parts:
+            if kind == b'D':
+                self.send_records(topic, stream_id, plan, records)
+                records = []
+                measurements = marshal.loads(payload)
+                self.send(topic, [json.dumps(measurements)], 1)
+            elif kind == b'F':
+                records.append(unpack_batch(payload, plan.dtype))
+            elif kind == b'R':
+                records.append(np.frombuffer(payload, dtype=plan.dtype.newbyteorder('=')))
+            else:
+                records.append(np.frombuffer(payload, dtype=plan.dtype))
+        self.send_records(topic, stream_id, plan, records)
+
+    def send_records(self, topic, stream_id, plan, records):
+        '''send a run of record arrays of a stream'''
+        if not records:
+            return
+        records = [r.astype(plan.dtype, copy=False) for r in records]
+        records = np.concatenate(records)
+        if self.publish_format == 'binary':
+            self.send(topic, [pack_records(stream_id, records, plan.dtype)], len(records))
+        else:
+            names = records.dtype.names
+            self.send(topic, [json.dumps(dict(zip(names, row))) for row in records.tolist()], 1)
+
+    def send(self, topic, payloads, count):
+        '''send messages to the subscribers, count is the measurements in each'''
+        for payload in payloads:
+            self.pub_socket.send_multipart([topic, payload])
+            self.counters['published'] += count
+            self.counters['messages'] += 1
+
+    def stats(self):
+        """!@brief Get the publisher statistics.
+
+        @return a dictionary with the current queue depth and counters
+        """
+        stats = dict(self.counters)
+        # measurements handed off and not published yet
+        stats['depth'] = stats['queued'] - stats['published'] - stats['failed']
+        return stats
+
+    def log_stats(self):
+        """!@brief Write the publisher statistics to the log."""
+        msg = (
+            "Publisher depth: {depth}, queued: {queued}, published: {published}, "
+            "messages: {messages}, dropped: {dropped}, failed: {failed}"
+        )
+        self.logger.info(msg.format(**self.stats()))
+
+    def close(self):
+        """!@brief Stop the publisher thread."""
+        self.running = False
+        self.thread.join()
+        self.push_socket.close(linger=0)
@@ -0,0 +1,230 @@
+"""
+This module provides the ReadCache class, a cache of read replies that sits in
+the read broker, in front of the read workers.
+
+Requests are normalized before they are looked up: a window that runs up to
+now is quantized, so polls of the same "last N minutes" window share an entry,
+and identical requests that arrive while one is being read wait for its reply
+instead of reading the destination again. Entries are dropped when
+measurements are written inside their time window.
+"""
+
+import json
+import math
+import time
+import threading
+from collections import OrderedDict, deque
+
+import numpy as np
+
+from origin import config_option
+
+# the default read window, as in Destination.validate_time_range
+DEFAULT_WINDOW = 5 * 60
+# request properties of paged reads, those are not cached
+PAGE_KEYS = ('cursor', 'page_rows', 'page_bytes')
+
+
+class ReadCache(object):
+    """!@brief An LRU cache of read replies, keyed by the normalized request.
+
+    The broker thread looks up and stores replies, while the ingest path
+    invalidates entries from other threads, so everything is done under a
+    lock. Each invalidation is logged for a while, so a reply that was being
+    read while overlapping measurements were written is not stored.
+    """
+
+    def __init__(self, logger, config):
+        """!@brief Read the cache settings.
+
+        @param logger pass in a logger object
+        @param config configuration object
+        """
+        self.logger = logger
+        self.max_entries = config_option(config, 'ReadCache', 'max_entries', 1000, 'getint')
+        self.max_bytes = config_option(config, 'ReadCache', 'max_bytes', 64 * 2**20, 'getint')
+        self.quantum = config_option(config, 'ReadCache', 'quantum', 1, 'getint')
+        # uint64 timestamps are 32.32 fixed point, the others are seconds
+        timestamp_type = config.get('Server', 'timestamp_type')
+        self.shift = 32 if timestamp_type == 'uint64' else 0
+        self.lock = threading.Lock()
+        # key : (stream, window, reply frames, size)
+        self.entries = OrderedDict()
+        self.size = 0
+        # stream : set of keys
+        self.stream_keys = {}
+        # key : list of envelopes waiting for the reply to the same request
+        self.waiting = {}
+        # stream : recent invalidations, (sequence number, start, stop)
+        self.invalidations = {}
+        self.sequence = 0
+        self.counters = {
+            'hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'invalidated': 0,
+            'evicted': 0,
+        }
+
+    def normalize(self, msg):
+        """!@brief Normalize a read request so equivalent requests share a key.
+
+        @param msg the JSON read request
+        @return a tuple (key, msg, stream, window), key is None if the request
+            can not be cached, msg is the request to send to the workers
+        """
+        try:
+            request = json.loads(msg)
+            stream = request['stream'].strip()
+            if any(key in request for key in PAGE_KEYS):
+                return (None, msg, None, None)
+            stop = request.get('stop')
+            if stop is None:
+                # nothing is newer than now, so rounding a stop of now up
+                # does not add measurements outside the requested window
+                q = self.quantum
+                stop = int(math.ceil(time.time() / q)) * q
+            request['stop'] = float(stop)
+            start = request.get('start')
+            if start is not None:
+                request['start'] = float(start)
+            else:
+                start = request['stop'] - DEFAULT_WINDOW
+            # the destinations read from the whole second
+            window = (math.floor(float(start)), request['stop'])
+            request['stream'] = stream
+            if 'fields' in request:
+                request['fields'] = sorted(f.strip() for f in request['fields'])
+        except (ValueError, TypeError, KeyError, AttributeError):
+            # the read worker answers with the error
+            return (None, msg, None, None)
+        key = json.dumps(request, sort_keys=True)
+        return (key, key, stream, (min(window), max(window)))
+
+    def get(self, key):
+        """!@brief Look up the reply frames for a request key, None if missing."""
+        with self.lock:
+            try:
+                entry = self.entries.pop(key)
+            except KeyError:
+                self.counters['misses'] += 1
+                return None
+            self.entries[key] = entry
+            self.counters['hits'] += 1
+            return entry[2]
+
+    def wait(self, key, envelope):
+        """!@brief Join a request that is already being read.
+
+        @param key the request key
+        @param envelope the routing frames of the new request
+        @return True if the request waits for the reply of the first one,
+            False if it is the first one and has to be read
+        """
+        with self.lock:
+            if key in self.waiting:
+                self.waiting[key].append(envelope)
+                self.counters['coalesced'] += 1
+                return True
+            self.waiting[key] = []
+            return False
+
+    def abandon(self, key):
+        """!@brief Give up on a request that was not read in time, so the next
+        identical request is read again.
+
+        @param key the request key
+        @return the list of envelopes of the requests waiting for the reply
+        """
+        with self.lock:
+            return self.waiting.pop(key, [])
+
+    def sequence_number(self):
+        """!@brief Get the current invalidation sequence number, taken before
+        a request is read."""
+        with self.lock:
+            return self.sequence
+
+    def finish(self, key, stream, window, reply, sequence):
+        """!@brief Store the reply to a request that was read.
+
+        Replies with an error, or that were read while overlapping
+        measurements were written, are not stored.
+
+        @param key the request key
+        @param stream the stream name
+        @param window the (start, stop) time window in seconds
+        @param reply the reply frames
+        @param sequence the sequence number from before the read
+        @return the list of envelopes of the requests waiting for the reply
+        """
+        with self.lock:
+            waiting = self.waiting.pop(key, [])
+            header = getattr(reply[0], 'bytes', reply[0])
+            if not header.startswith('[0,'):
+                return waiting
+            recent = self.invalidations.get(stream, ())
+            if recent and (len(recent) == recent.maxlen) and (recent[0][0] > sequence + 1):
+                # the log does not go back far enough to tell
+                return waiting
+            for number, start, stop in recent:
+                if (number > sequence) and (start <= window[1]) and (window[0] <= stop):
+                    return waiting
+            size = sum(len(frame) for frame in reply)
+            if size > self.max_bytes:
+                return waiting
+            self.remove(key)
+            self.entries[key] = (stream, window, reply, size)
+            self.stream_keys.setdefault(stream, set()).add(key)
+            self.size += size
+            while (len(self.entries) > self.max_entries) or (self.size > self.max_bytes):
+                self.remove(next(iter(self.entries)))
+                self.counters['evicted'] += 1
+            return waiting
+
+    def remove(self, key):
+        '''Drop an entry, the lock has to be held'''
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[3]
+            self.stream_keys[entry[0]].discard(key)
+
+    def invalidate(self, stream, time_stamps):
+        """!@brief Drop the entries of a stream whose time window overlaps
+        newly written measurements.
+
+        @param stream a string holding the stream name
+        @param time_stamps the timestamps of the written measurements
+        """
+        if len(time_stamps) == 0:
+            return
+        start = long(np.min(time_stamps)) >> self.shift
+        # the window stop is a whole second
+        stop = -(-long(np.max(time_stamps)) >> self.shift)
+        self.invalidate_window(stream, start, stop)
+
+    def invalidate_window(self, stream, start, stop):
+        """!@brief Drop the entries of a stream whose time window overlaps
+        [start, stop], in seconds."""
+        with self.lock:
+            self.sequence += 1
+            recent = self.invalidations.setdefault(stream, deque(maxlen=64))
+            recent.append((self.sequence, start, stop))
+            for key in list(self.stream_keys.get(stream, ())):
+                window = self.entries[key][1]
+                if (window[0] <= stop) and (start <= window[1]):
+                    self.remove(key)
+                    self.counters['invalidated'] += 1
+
+    def invalidate_stream(self, stream):
+        """!@brief Drop every entry of a stream, when its definition changes."""
+        self.invalidate_window(stream, 0, float('inf'))
+
+    def log_stats(self):
+        """!@brief Log the cache counters."""
+        with self.lock:
+            counters = dict(self.counters, entries=len(self.entries), bytes=self.size)
+        msg = "Read cache stats: {}".format(
+            ", ".join("{}: {}".format(k, counters[k]) for k in sorted(counters))
+        )
+        self.logger.info(msg)
@@ -0,0 +1,113 @@
+"""
+This module provides the RecordBatch class, a columnar block of measurements
+for a single stream that destinations can write in bulk.
+"""
+
+import numpy as np
+
+from origin import data_types, TIMESTAMP
+
+
+class RecordBatch(object):
+    """!@brief A columnar set of measurements: one numpy array of timestamps
+    and one numpy array per field, all the same length.
+
+    String fields are kept as object arrays so nothing is truncated before it
+    reaches the destination.
+    """
+
+    def __init__(self, timestamps, columns):
+        """!@brief Wrap existing arrays, no data is copied.
+
+        @param timestamps array of timestamps
+        @param columns dictionary with field names as keys and arrays as values
+        """
+        self.timestamps = timestamps
+        self.columns = columns
+        for field in columns:
+            if len(columns[field]) != len(timestamps):
+                msg = "Field `{}` length does not match the timestamp length."
+                raise ValueError(msg.format(field))
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @property
+    def fields(self):
+        """!@brief The list of field names, not including the timestamp."""
+        return self.columns.keys()
+
+    @classmethod
+    def from_measurements(cls, measurements, definition, timestamp_type):
+        """!@brief Build a batch from measurement dictionaries.
+
+        @param measurements a list of measurement dictionaries, with timestamps
+        @param definition the stream definition dictionary
+        @param timestamp_type the server timestamp data type name
+        @return a new RecordBatch
+        """
+        timestamps = np.array(
+            [m[TIMESTAMP] for m in measurements],
+            dtype=data_types[timestamp_type]["numpy"]
+        )
+        columns = {}
+        for field in definition:
+            dtype = definition[field]["type"]
+            if dtype == "string":
+                numpy_type = object
+            else:
+                numpy_type = data_types[dtype]["numpy"]
+            columns[field] = np.array([m[field] for m in measurements], dtype=numpy_type)
+        return cls(timestamps, columns)
+
+    @classmethod
+    def from_records(cls, records):
+        """!@brief Wrap a structured record array, like the output from
+        origin.origin_batch.unpack_batch, without copying.
+
+        @param records structured array with the timestamp as the first entry
+        @return a new RecordBatch
+        """
+        names = records.dtype.names
+        columns = dict((name, records[name]) for name in names[1:])
+        return cls(records[names[0]], columns)
+
+    @classmethod
+    def concatenate(cls, batches):
+        """!@brief Join batches of the same stream in order.
+
+        @param batches a list of RecordBatch objects
+        @return a new RecordBatch
+        """
+        if len(batches) == 1:
+            return batches[0]
+        timestamps = np.concatenate([b.timestamps for b in batches])
+        columns = {}
+        for field in batches[0].columns:
+            columns[field] = np.concatenate([b.columns[field] for b in batches])
+        return cls(timestamps, columns)
+
+    def slice(self, start, stop):
+        """!@brief Get a view of the rows in [start, stop).
+
+        @return a new RecordBatch
+        """
+        columns = dict((f, self.columns[f][start:stop]) for f in self.columns)
+        return RecordBatch(self.timestamps[start:stop], columns)
+
+    def column(self, field):
+        """!@brief Get a column by name, including the timestamp."""
+        if field == TIMESTAMP:
+            return self.timestamps
+        return self.columns[field]
+
+    def rows(self):
+        """!@brief Iterate over the batch as measurement dictionaries.
+
+        Values are converted to native python types.
+        """
+        names = [TIMESTAMP] + self.columns.keys()
+        values = [self.timestamps.tolist()]
+        values += [self.columns[name].tolist() for name in names[1:]]
+        for row in zip(*values):
+            yield dict(zip(names, row))
@@ -0,0 +1,467 @@
+"""
+This module provides the Rollups class, which keeps multi-resolution summaries
+of the numeric streams up to date as measurements arrive.
+
+Every tier splits time into buckets of a fixed number of seconds, and holds
+one row per bucket in a hidden stream of the same destination:
+
+    _rollup_`seconds`_`stream` : {
+        measurement_time : `bucket start`,
+        count            : `number of measurements`,
+        first_time       : `timestamp of the first measurement`,
+        last_time        : `timestamp of the last measurement`,
+        `field`_sum      : `sum of the values`,
+        `field`_m2       : `sum of the squared deviations from the mean`,
+        `field`_min      : ...,
+        `field`_max      : ...,
+        `field`_first    : `value of the first measurement`,
+        `field`_last     : `value of the last measurement`,
+        ...
+    }
+
+The rows are partial aggregates, a bucket can have more than one row, after a
+restart for example, they are merged when read. The squared
+deviations are merged with the parallel variance formula, a plain sum of
+squares loses too much precision for values with a large offset.
+"""
+
+import numpy as np
+
+from origin import data_types, current_time, config_option, TIMESTAMP
+from origin.server import RecordBatch
+
+ROLLUP_PREFIX = '_rollup_'
+FIRST_TIME = 'first_time'
+LAST_TIME = 'last_time'
+STATS = ('sum', 'm2', 'min', 'max', 'first', 'last')
+
+
+def rollup_stream_name(stream, seconds):
+    '''Get the name of the hidden stream holding a tier of a stream'''
+    return '{}{}_{}'.format(ROLLUP_PREFIX, seconds, stream)
+
+
+def is_rollup_stream(stream):
+    '''True if the stream holds a rollup tier'''
+    return stream.startswith(ROLLUP_PREFIX)
+
+
+def part_keys(fields):
+    '''Get the partial aggregate column names for a list of fields'''
+    keys = ['count', FIRST_TIME, LAST_TIME]
+    for field in fields:
+        keys.extend('{}_{}'.format(field, stat) for stat in STATS)
+    return keys
+
+
+def sample_parts(time_stamps, columns):
+    '''Make partial aggregates that hold one measurement each.
+
+    @param time_stamps an array of timestamps
+    @param columns a dictionary with numeric fields as keys and arrays as values
+    @return a dictionary of partial aggregate columns
+    '''
+    parts = {
+        'count': np.ones(len(time_stamps), dtype=np.uint64),
+        FIRST_TIME: time_stamps,
+        LAST_TIME: time_stamps,
+    }
+    zeros = np.zeros(len(time_stamps))
+    for field, values in columns.items():
+        values = np.asarray(values, dtype=np.float64)
+        for stat in STATS:
+            parts['{}_{}'.format(field, stat)] = values
+        parts[field + '_m2'] = zeros
+    return parts
+
+
+def combine_parts(groups, parts, fields):
+    '''Merge the partial aggregates that share a group.
+
+    @param groups an array with the group of each partial aggregate
+    @param parts a dictionary of partial aggregate columns
+    @param fields the list of numeric fields in parts
+    @return a tuple of (group ids, merged parts), one merged row per group in
+        increasing group order
+    '''
+    groups = np.asarray(groups)
+    if len(groups) == 0:
+        return (groups, parts)
+    order = np.lexsort((parts[FIRST_TIME], groups))
+    groups = groups[order]
+    rows = dict((key, np.asarray(parts[key])[order]) for key in part_keys(fields))
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    sizes = np.diff(np.r_[starts, len(groups)])
+    # rows are in first_time order within a group, find the latest last_time
+    last = np.lexsort((rows[LAST_TIME], groups))[starts + sizes - 1]
+
+    counts = rows['count'].astype(np.float64)
+    merged = {
+        'count': np.add.reduceat(rows['count'], starts),
+        FIRST_TIME: rows[FIRST_TIME][starts],
+        LAST_TIME: rows[LAST_TIME][last],
+    }
+    group_counts = merged['count'].astype(np.float64)
+    for field in fields:
+        total = np.add.reduceat(rows[field + '_sum'], starts)
+        deviation = rows[field + '_sum'] / counts - np.repeat(total / group_counts, sizes)
+        m2 = rows[field + '_m2'] + counts * deviation * deviation
+        merged[field + '_sum'] = total
+        merged[field + '_m2'] = np.add.reduceat(m2, starts)
+        merged[field + '_min'] = np.fmin.reduceat(rows[field + '_min'], starts)
+        merged[field + '_max'] = np.fmax.reduceat(rows[field + '_max'], starts)
+        merged[field + '_first'] = rows[field + '_first'][starts]
+        merged[field + '_last'] = rows[field + '_last'][last]
+    return (groups[starts], merged)
+
+
+def join_parts(parts_list, fields):
+    '''Concatenate partial aggregate columns'''
+    return dict(
+        (key, np.concatenate([parts[key] for parts in parts_list]))
+        for key in part_keys(fields)
+    )
+
+
+class Rollups(object):
+    """!@brief Maintains the rollup tiers of a destination and answers
+    statistics and bucketed reads from them.
+
+    The open bucket of each stream and tier is kept in memory, a row is
+    written when a later bucket starts or when the bucket end has passed, see
+    flush. Reads only use the tier buckets that ended more than the grace
+    period ago, anything newer or not covered by a tier is read from the raw
+    data.
+
+    Like the file based destinations, the tiers expect the timestamps of a
+    stream to increase. Measurements for a bucket before the last written one
+    are left out of the tier, so late or out of order measurements are in the
+    raw data but missing from the stats and bucketed reads that use a tier.
+    The results are only exact for streams without them.
+    """
+
+    def __init__(self, logger, config, dest, tiers=None):
+        """!@brief Read the tier settings.
+
+        @param logger pass in a logger object
+        @param config configuration object
+        @param dest the destination holding the streams
+        @param tiers list of tier bucket sizes in seconds, read from the
+            config if None
+        """
+        self.logger = logger
+        self.dest = dest
+        if tiers is None:
+            tiers = config_option(config, 'Rollup', 'tiers', '1,60,3600').split(',')
+        self.tiers = []
+        for seconds in sorted(int(t) for t in tiers if str(t).strip()):
+            # coarser tiers are built from the finer ones
+            if self.tiers and (seconds % self.tiers[-1] != 0):
+                msg = "Rollup tier {} s is not a multiple of {} s, skipping it."
+                self.logger.warning(msg.format(seconds, self.tiers[-1]))
+                continue
+            self.tiers.append(seconds)
+        self.grace = config_option(config, 'Rollup', 'grace', 10, 'getfloat')
+        self.config = config
+        self.timestamp_type = config.get('Server', 'timestamp_type')
+        self.ts_dtype = np.dtype(data_types[self.timestamp_type]['numpy'])
+        # uint64 timestamps are 32.32 fixed point, the others are seconds
+        self.shift = 32 if self.timestamp_type == 'uint64' else 0
+        # (stream, seconds) : (bucket start, parts) for the open buckets
+        self.open = {}
+        # (stream, seconds) : start of the last written bucket
+        self.written = {}
+        # stream : source version the tiers are registered for
+        self.versions = {}
+        # (tier stream, version) : start of the first complete bucket
+        self.since = {}
+
+    def numeric_fields(self, stream):
+        '''Get the sorted numeric fields of a stream'''
+        definition = self.dest.known_stream_versions[stream]
+        return sorted(f for f in definition if definition[f]['type'] != 'string')
+
+    def template(self, stream):
+        '''Get the (template, key_order) of the tier streams for a stream'''
+        template = {'count': 'uint64'}
+        template[FIRST_TIME] = self.timestamp_type
+        template[LAST_TIME] = self.timestamp_type
+        for key in part_keys(self.numeric_fields(stream))[3:]:
+            template[key] = 'double'
+        return (template, sorted(template.keys()))
+
+    def bucket_starts(self, time_stamps, seconds):
+        '''Get the start timestamp of the bucket holding each timestamp'''
+        unit = np.uint64(seconds << self.shift)
+        return (np.asarray(time_stamps).astype(np.uint64) // unit) * unit
+
+    def ensure_tiers(self, stream):
+        '''Register the tier streams for the current version of a stream'''
+        version = self.dest.known_streams[stream]['version']
+        if self.versions.get(stream) == version:
+            return
+        # buckets of the old version have the old fields
+        self.flush(force=True, stream=stream)
+        template, key_order = self.template(stream)
+        for seconds in self.tiers:
+            err, msg = self.dest.register_stream(
+                rollup_stream_name(stream, seconds), template, key_order
+            )
+            if err != 0:
+                raise ValueError(msg)
+        self.versions[stream] = version
+
+    def update(self, stream, batch):
+        """!@brief Add measurements to the open buckets of a stream.
+
+        Buckets before the latest one are written out, tier rows are written
+        in time order so measurements for earlier buckets are skipped.
+
+        @param stream a string holding the stream name
+        @param batch a RecordBatch containing the data
+        """
+        if (not self.tiers) or is_rollup_stream(stream) or (len(batch) == 0):
+            return
+        fields = self.numeric_fields(stream)
+        if not fields:
+            return
+        self.ensure_tiers(stream)
+        time_stamps = np.asarray(batch.timestamps).astype(self.ts_dtype)
+        columns = dict((field, batch.columns[field]) for field in fields)
+        groups, parts = time_stamps, sample_parts(time_stamps, columns)
+        for seconds in self.tiers:
+            # each tier is built from the batch buckets of the finer tier
+            groups, parts = combine_parts(self.bucket_starts(groups, seconds), parts, fields)
+            starts, merged = groups, parts
+            key = (stream, seconds)
+            if key in self.open:
+                start, open_parts = self.open[key]
+                starts = np.r_[np.array([start], dtype=np.uint64), starts]
+                starts, merged = combine_parts(starts, join_parts([open_parts, merged], fields), fields)
+            if key in self.written:
+                keep = starts >= self.written[key]
+                if not keep.all():
+                    msg = "Skipping {} late measurements in the {} s tier of stream `{}`."
+                    late = merged['count'][~keep].sum()
+                    self.logger.debug(msg.format(late, seconds, stream))
+                    if not keep.any():
+                        continue
+                    starts = starts[keep]
+                    merged = dict((k, v[keep]) for k, v in merged.items())
+            done = starts < starts[-1]
+            if done.any():
+                self.write(stream, seconds, starts[done], merged, done)
+            latest = len(starts) - 1
+            self.open[key] = (
+                starts[latest],
+                dict((k, v[latest:]) for k, v in merged.items())
+            )
+
+    def write(self, stream, seconds, starts, parts, rows):
+        '''Store rows of partial aggregates in a tier stream'''
+        self.written[(stream, seconds)] = long(starts[-1])
+        columns = dict((key, np.asarray(parts[key])[rows]) for key in parts)
+        self.dest.store_measurements(
+            rollup_stream_name(stream, seconds),
+            RecordBatch(np.asarray(starts).astype(self.ts_dtype), columns)
+        )
+
+    def flush(self, force=False, stream=None):
+        """!@brief Write out the open buckets that have ended.
+
+        @param force write out every open bucket, for a clean shutdown
+        @param stream only write the buckets of this stream, all if None
+        """
+        now = current_time(self.config)
+        for key in self.open.keys():
+            if (stream is not None) and (key[0] != stream):
+                continue
+            start, parts = self.open[key]
+            if force or (long(start) + (key[1] << self.shift) <= now):
+                del self.open[key]
+                self.write(key[0], key[1], [start], parts, slice(None))
+
+    def tier_since(self, stream, seconds):
+        '''Get the start of the first complete bucket of a tier, None if the
+        tier is empty. The first bucket is skipped, it may have started before
+        the tier did.'''
+        name = rollup_stream_name(stream, seconds)
+        if name not in self.dest.known_streams:
+            return None
+        key = (name, self.dest.known_streams[name]['version'])
+        if key not in self.since:
+            last = np.iinfo(self.ts_dtype).max
+            result, data, _ = self.dest.read_stream_window(name, 0, last, ['count'], limit=1)
+            if result != 0:
+                return None
+            self.since[key] = long(data[TIMESTAMP][0]) + (seconds << self.shift)
+        return self.since[key]
+
+    def read_tier(self, stream, seconds, start, stop, fields):
+        '''Read partial aggregates from a tier, None if there are none'''
+        result, data, _ = self.dest.read_stream_window(
+            rollup_stream_name(stream, seconds), start, stop, part_keys(fields)
+        )
+        if result != 0:
+            return None
+        return (np.asarray(data[TIMESTAMP]), data)
+
+    def read_raw(self, stream, start, stop, fields):
+        '''Read measurements as partial aggregates, None if there are none'''
+        result, data, _ = self.dest.read_stream_window(stream, start, stop, fields)
+        if result != 0:
+            return None
+        time_stamps = np.asarray(data[TIMESTAMP])
+        columns = dict((field, data[field]) for field in fields)
+        return (time_stamps, sample_parts(time_stamps, columns))
+
+    def plan(self, stream, start, stop, level, pieces):
+        '''Split a window between the tiers, the coarsest tier that has
+        complete buckets in the window covers them, the edges go to finer
+        tiers and then to the raw data.
+
+        @param pieces list to add (seconds, start, stop) to, seconds is None
+            for raw data
+        '''
+        limit = current_time(self.config) - (long(self.grace) << self.shift)
+        for level in range(level, -1, -1):
+            seconds = self.tiers[level]
+            since = self.tier_since(stream, seconds)
+            if since is None:
+                continue
+            unit = seconds << self.shift
+            first = max(-(-start // unit) * unit, since)
+            end = (min(stop + 1, limit) // unit) * unit
+            if end <= first:
+                continue
+            pieces.append((seconds, first, end - 1))
+            if start < first:
+                self.plan(stream, start, first - 1, level - 1, pieces)
+            if end <= stop:
+                self.plan(stream, end, stop, level - 1, pieces)
+            return
+        pieces.append((None, start, stop))
+
+    def read_pieces(self, stream, pieces, fields):
+        '''Read the pieces of a plan, a list of (times, parts)'''
+        results = []
+        for seconds, start, stop in pieces:
+            if seconds is None:
+                piece = self.read_raw(stream, start, stop, fields)
+            else:
+                piece = self.read_tier(stream, seconds, start, stop, fields)
+            if piece is not None:
+                results.append(piece)
+        return results
+
+    def check_fields(self, stream, fields):
+        '''Get the fields to read, None if the tiers can't hold them'''
+        if (stream not in self.dest.known_streams) or is_rollup_stream(stream):
+            return None
+        definition = self.dest.known_stream_versions[stream]
+        fields = fields or definition.keys()
+        for field in fields:
+            if (field not in definition) or (definition[field]['type'] == 'string'):
+                return None
+        return fields
+
+    def get_stat_stream_data(self, stream, start=None, stop=None, fields=[]):
+        """!@brief Get statistics on the stream data in a time window, using the
+        coarsest tiers that cover it.
+
+        @param stream a string holding the stream name
+        @param start 32b unix timestamp that defines the start of the data
+            window
+        @param stop 32b unix timestamp that defines the end of the data window
+        @param fields A list that contains the fields for which data is desired
+        @return a tuple with (error, data, msg) like
+            Destination.get_stat_stream_data, or None if the tiers can not
+            answer the request, for string fields or windows without tier data
+        """
+        fields = self.check_fields(stream, fields)
+        if (fields is None) or (not self.tiers):
+            return None
+        start, stop = self.dest.validate_time_range(start, stop)
+        pieces = []
+        self.plan(stream, start, stop, len(self.tiers) - 1, pieces)
+        if all(seconds is None for seconds, _, _ in pieces):
+            return None
+        self.logger.debug("Rollup stat read pieces: {}".format(pieces))
+        results = self.read_pieces(stream, pieces, fields)
+        if not results:
+            return (1, {}, "No data in requested time window.")
+        parts = join_parts([parts for _, parts in results], fields)
+        _, parts = combine_parts(np.zeros(len(parts['count'])), parts, fields)
+
+        count = float(parts['count'][0])
+        definition = self.dest.known_stream_versions[stream]
+        data = {TIMESTAMP: {
+            'start': long(parts[FIRST_TIME][0]),
+            'stop': long(parts[LAST_TIME][0])
+        }}
+        for field in fields:
+            dtype = data_types[definition[field]['type']]['type']
+            data[field] = {
+                'average': float(parts[field + '_sum'][0]) / count,
+                'standard_deviation': float(np.sqrt(parts[field + '_m2'][0] / count)),
+                'max': dtype(parts[field + '_max'][0]),
+                'min': dtype(parts[field + '_min'][0]),
+            }
+        return (0, data, '')
+
+    def get_bucket_stream_data(self, stream, start=None, stop=None, fields=[],
+                               bucket_seconds=60):
+        """!@brief Get summaries of the stream data in equal time buckets.
+
+        The coarsest tier that evenly divides the bucket size is used, the
+        edges of the window and the latest data are read raw.
+
+        @param stream a string holding the stream name
+        @param start 32b unix timestamp that defines the start of the data
+            window
+        @param stop 32b unix timestamp that defines the end of the data window
+        @param fields A list that contains the fields for which data is desired
+        @param bucket_seconds the bucket size, buckets start at multiples of it
+        @return a tuple with (error, data, msg)
+            data: a dictionary of arrays, the bucket start timestamps, `count`
+                and `field`_average, _standard_deviation, _min, _max, _first
+                and _last for each field
+        """
+        bucket_seconds = int(bucket_seconds)
+        if bucket_seconds < 1:
+            return (1, {}, "Bucket size has to be at least one second.")
+        if stream not in self.dest.known_streams:
+            return (1, {}, "Requested stream `{}` does not exist.".format(stream))
+        fields = self.check_fields(stream, fields)
+        if fields is None:
+            return (1, {}, "Bucketed reads are only supported for numeric fields.")
+        start, stop = self.dest.validate_time_range(start, stop)
+        pieces = []
+        for level in range(len(self.tiers) - 1, -1, -1):
+            if bucket_seconds % self.tiers[level] == 0:
+                self.plan(stream, start, stop, level, pieces)
+                break
+        else:
+            pieces.append((None, start, stop))
+        results = self.read_pieces(stream, pieces, fields)
+        if not results:
+            return (1, {}, "No data in requested time window.")
+        time_stamps = np.concatenate([times for times, _ in results])
+        parts = join_parts([parts for _, parts in results], fields)
+        groups, parts = combine_parts(self.bucket_starts(time_stamps, bucket_seconds), parts, fields)
+
+        counts = parts['count'].astype(np.float64)
+        data = {TIMESTAMP: groups.astype(self.ts_dtype), 'count': parts['count']}
+        for field in fields:
+            data[field + '_average'] = parts[field + '_sum'] / counts
+            data[field + '_standard_deviation'] = np.sqrt(parts[field + '_m2'] / counts)
+            for stat in ('min', 'max', 'first', 'last'):
+                data['{}_{}'.format(field, stat)] = parts['{}_{}'.format(field, stat)]
+        return (0, data, '')
+
+    def bucket_types(self, data):
+        '''Get the data type names of the columns from a bucketed read'''
+        types = dict((key, 'double') for key in data)
+        types['count'] = 'uint64'
+        types[TIMESTAMP] = self.timestamp_type
+        return types
@@ -0,0 +1,166 @@
+"""
+This module provides the WriteBehind class, a bounded queue and writer thread
+that decouples the ingest sockets from the destination writes.
+"""
+
+import threading
+import time
+import Queue
+from collections import OrderedDict
+
+from origin import config_option
+from origin.server import RecordBatch
+
+
+class WriteBehind(object):
+    """!@brief A write-behind stage between the ingest path and a destination.
+
+    Processed measurements are put in a bounded in-memory queue. A dedicated
+    writer thread drains the queue, groups the measurements by stream and
+    hands them to the destination, so slow storage does not stall the sockets.
+    """
+
+    def __init__(self, logger, config, dest):
+        """!@brief Set up the queue and start the writer thread.
+
+        @param logger pass in a logger object
+        @param config configuration object
+        @param dest the destination that does the writing
+        """
+        self.logger = logger
+        self.dest = dest
+        self.queue_size = config_option(config, 'WriteBehind', 'queue_size', 10000, 'getint')
+        self.policy = config_option(config, 'WriteBehind', 'policy', 'block').lower()
+        self.flush_interval = config_option(config, 'WriteBehind', 'flush_interval', 0.1, 'getfloat')
+        self.batch_size = config_option(config, 'WriteBehind', 'batch_size', 1000, 'getint')
+        if self.policy not in ('block', 'drop'):
+            msg = "Unrecognized write-behind policy `{}`, using `block`."
+            self.logger.warning(msg.format(self.policy))
+            self.policy = 'block'
+
+        self.queue = Queue.Queue(self.queue_size)
+        self.counters = {
+            'enqueued': 0,
+            'dropped': 0,
+            'written': 0,
+            'failed': 0,
+            'batches': 0,
+            'max_depth': 0,
+            'last_flush_latency': 0.,
+            'max_flush_latency': 0.,
+        }
+        self.running = True
+        self.thread = threading.Thread(target=self.writer_loop, name='write_behind')
+        self.thread.daemon = True
+        self.thread.start()
+        msg = "Write-behind queue started. size: {}, policy: {}, flush interval: {} s"
+        self.logger.info(msg.format(self.queue_size, self.policy, self.flush_interval))
+
+    def put(self, stream, batch):
+        """!@brief Queue measurements for writing.
+
+        @param stream a string holding the stream name
+        @param batch a RecordBatch containing the data
+        @return True if the measurements were queued, False if dropped
+        """
+        item = (stream, batch, time.time())
+        if self.policy == 'drop':
+            try:
+                self.queue.put_nowait(item)
+            except Queue.Full:
+                self.counters['dropped'] += len(batch)
+                return False
+        else:
+            self.queue.put(item)
+        self.counters['enqueued'] += len(batch)
+        depth = self.queue.qsize()
+        if depth > self.counters['max_depth']:
+            self.counters['max_depth'] = depth
+        return True
+
+    def writer_loop(self):
+        """!@brief Drain the queue and write grouped batches to the destination."""
+        while self.running or not self.queue.empty():
+            try:
+                items = [self.queue.get(timeout=self.flush_interval)]
+            except Queue.Empty:
+                continue
+            # collect more until the batch is full or the flush interval is up
+            deadline = time.time() + self.flush_interval
+            count = len(items[0][1])
+            while count < self.batch_size:
+                timeout = deadline - time.time()
+                try:
+                    if timeout > 0:
+                        item = self.queue.get(timeout=timeout)
+                    else:
+                        item = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                items.append(item)
+                count += len(item[1])
+            try:
+                self.write(items)
+            except Exception:
+                # the thread has to keep draining the queue, or ingest stalls
+                self.logger.exception("Error in the write-behind thread.")
+
+    def write(self, items):
+        """!@brief Group queued items by stream and write them.
+
+        Every item is marked done, even if writing it failed, so drain does
+        not wait for it forever.
+
+        @param items list of queued (stream, batch, enqueue_time) tuples
+        """
+        try:
+            groups = OrderedDict()
+            for stream, batch, _ in items:
+                groups.setdefault(stream, []).append(batch)
+            with self.dest.write_lock:
+                for stream in groups:
+                    try:
+                        batch = RecordBatch.concatenate(groups[stream])
+                        self.dest.insert_measurements(stream, batch)
+                        self.dest.inserted(stream, batch)
+                        self.counters['written'] += len(batch)
+                    except Exception:
+                        self.counters['failed'] += sum(len(b) for b in groups[stream])
+                        msg = "Error writing queued measurements for stream `{}`."
+                        self.logger.exception(msg.format(stream))
+            latency = time.time() - items[0][2]
+            self.counters['batches'] += 1
+            self.counters['last_flush_latency'] = latency
+            if latency > self.counters['max_flush_latency']:
+                self.counters['max_flush_latency'] = latency
+        finally:
+            for _ in items:
+                self.queue.task_done()
+
+    def drain(self):
+        """!@brief Block until every queued measurement has been written."""
+        self.queue.join()
+
+    def stats(self):
+        """!@brief Get the queue statistics.
+
+        @return a dictionary with the current queue depth and counters
+        """
+        stats = dict(self.counters)
+        stats['depth'] = self.queue.qsize()
+        return stats
+
+    def log_stats(self):
+        """!@brief Write the queue statistics to the log."""
+        msg = (
+            "Write-behind depth: {depth}, max depth: {max_depth}, "
+            "enqueued: {enqueued}, written: {written}, dropped: {dropped}, "
+            "failed: {failed}, batches: {batches}, "
+            "flush latency (last, max): ({last_flush_latency:.3f}, {max_flush_latency:.3f}) s"
+        )
+        self.logger.info(msg.format(**self.stats()))
+
+    def close(self):
+        """!@brief Write everything still queued and stop the writer thread."""
+        self.running = False
+        self.thread.join()
@@ -0,0 +1,73 @@
+'''
+Unit tests for the event loop based reader
+'''
+
+import sys
+from os import path, getcwd
+import logging
+import time
+import json
+import threading
+import ConfigParser
+
+import zmq
+from zmq.eventloop import ioloop
+
+FULL_BASE_PATH = path.dirname(path.abspath(getcwd()))
+FULL_LIB_PATH = path.join(FULL_BASE_PATH, "lib")
+sys.path.append(FULL_LIB_PATH)
+
+from origin.client.origin_async import AsyncReader
+
+logger = logging.getLogger()
+
+STREAMS = json.dumps((0, dict(
+    streams={name: {"id": i + 1, "key_order": ["value"]} for i, name in enumerate("abc")}
+)))
+
+
+def read_server(router, count, order, delay):
+    '''answer the stream list, then count reads in the given order, the last
+    ones after a delay'''
+    requests = []
+    while len(requests) < count:
+        frames = router.recv_multipart()
+        i = frames.index(b'')
+        if frames[i + 1] == '{}':
+            router.send_multipart(frames[:i + 1] + [STREAMS])
+        else:
+            requests.append((frames[:i + 1], json.loads(frames[i + 1])))
+    for n, index in enumerate(order):
+        if n == len(order) - 1:
+            time.sleep(delay)
+        envelope, request = requests[index]
+        router.send_multipart(envelope + [json.dumps((0, {"stream": request["stream"]}))])
+
+
+def test_timeout():
+    '''replies are matched in any order, a late one only fails its own read'''
+    router = zmq.Context.instance().socket(zmq.ROUTER)
+    config = ConfigParser.ConfigParser()
+    config.read(path.join(FULL_BASE_PATH, "config", "origin-server-test.cfg"))
+    config.set("Server", "read_port", str(router.bind_to_random_port("tcp://127.0.0.1")))
+    config.set("Reader", "timeout", "200")
+    server = threading.Thread(target=read_server, args=(router, 3, [2, 0, 1], 0.4))
+    server.start()
+
+    io_loop = ioloop.IOLoop()
+    reader = AsyncReader(config, logger, io_loop=io_loop)
+    results = []
+    for stream in "abc":
+        reader.get_stream_raw_data(stream, lambda data, s=stream: results.append((s, data)))
+    assert len(reader.pending) == 3
+    # long enough for the late reply to come in
+    io_loop.add_timeout(io_loop.time() + 0.6, io_loop.stop)
+    io_loop.start()
+    server.join()
+    try:
+        assert results == [("c", {"stream": "c"}), ("a", {"stream": "a"}), ("b", {})]
+        assert not reader.pending
+    finally:
+        reader.close()
+        io_loop.close()
+        router.close(linger=0)
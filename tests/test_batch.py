@@ -0,0 +1,119 @@
+'''
+Unit tests for the batched native frame format
+'''
+
+import sys
+from os import path, getcwd
+import struct
+import logging
+import ConfigParser
+
+import numpy as np
+import pytest
+
+FULL_BASE_PATH = path.dirname(path.abspath(getcwd()))
+FULL_LIB_PATH = path.join(FULL_BASE_PATH, "lib")
+sys.path.append(FULL_LIB_PATH)
+
+from origin.origin_batch import (
+    pack_batch, pack_records, unpack_batch, unpack_batch_header, record_dtype,
+    is_batch, BATCH_HEADER, DELTA_TIMESTAMPS
+)
+from origin.client.origin_subscriber import decode_content
+from origin.server import HDF5Destination
+from origin import TIMESTAMP
+
+FORMAT_STR = "!Qifd"
+NAMES = [TIMESTAMP, "key1", "key2", "key3"]
+RECORDS = [
+    (2**32 * 1500000000 + 10, -1, 0.5, 1.0/3),
+    (2**32 * 1500000000 + 20, 2, 1.5, 2.0/3),
+    (2**32 * 1500000000 + 15, 3, -2.5, 1.0),
+]
+
+
+@pytest.mark.parametrize("delta", [False, True])
+def test_roundtrip(delta):
+    '''records should decode back to the packed values'''
+    frame = pack_batch(7, FORMAT_STR, RECORDS, delta=delta)
+    stream_id, count, flags = unpack_batch_header(frame)
+    assert stream_id == 7
+    assert count == len(RECORDS)
+    assert bool(flags & DELTA_TIMESTAMPS) == delta
+    assert is_batch(struct.unpack("!I", frame[:4])[0])
+
+    records = unpack_batch(frame, record_dtype(FORMAT_STR, NAMES))
+    assert records.dtype.names == tuple(NAMES)
+    for record, expected in zip(records.tolist(), RECORDS):
+        assert record[0] == expected[0]
+        assert record[1] == expected[1]
+        assert record[2] == pytest.approx(expected[2])
+        assert record[3] == expected[3]
+
+
+def test_records_match_single_format():
+    '''each packed record should be identical to a single native record'''
+    frame = pack_batch(1, FORMAT_STR, RECORDS)
+    size = struct.calcsize(FORMAT_STR)
+    for i, record in enumerate(RECORDS):
+        offset = BATCH_HEADER.size + i * size
+        assert frame[offset:offset + size] == struct.pack(FORMAT_STR, *record)
+
+
+def test_truncated_frame():
+    '''a frame with a wrong record count should not decode'''
+    frame = pack_batch(1, FORMAT_STR, RECORDS)
+    with pytest.raises(ValueError):
+        unpack_batch(frame[:-1], record_dtype(FORMAT_STR, NAMES))
+
+
+def test_bad_format():
+    '''format strings must match the names and only hold binary types'''
+    with pytest.raises(ValueError):
+        record_dtype("!Qi", NAMES)
+    with pytest.raises(ValueError):
+        record_dtype("!Qs", [TIMESTAMP, "key1"])
+    assert record_dtype("!Q?", [TIMESTAMP, "key1"])["key1"] == np.dtype(bool)
+
+
+def test_published_records():
+    '''repacked records should decode the same as the original frame'''
+    dtype = record_dtype(FORMAT_STR, NAMES)
+    frame = pack_batch(9, FORMAT_STR, RECORDS, delta=True)
+    records = unpack_batch(frame, dtype)
+    published = pack_records(9, records, dtype)
+    assert unpack_batch_header(published) == (9, len(RECORDS), 0)
+    assert published == pack_batch(9, FORMAT_STR, RECORDS)
+
+    topic = struct.pack("!I", 9)
+    stream_id, data = decode_content(topic, published, dtype, True)
+    assert stream_id == 9
+    assert data.tolist() == records.tolist()
+    # streams that can not be packed are published as JSON
+    assert decode_content(topic, '{"key1": 1}', None, True) == (9, {"key1": 1})
+
+
+def test_missing_timestamps(tmpdir):
+    '''records sent without a timestamp get unique, increasing ones'''
+    config = ConfigParser.ConfigParser()
+    config.read(path.join(FULL_BASE_PATH, "config", "origin-server-test.cfg"))
+    config.set("Server", "var_path", str(tmpdir))
+    dest = HDF5Destination(logging.getLogger(), config)
+    try:
+        dest.register_stream("test", {"key1": "int"}, ["key1"])
+        stream_id = dest.known_streams["test"]["id"]
+        records = [(0, 1), (2**32 * 1500000000, 2), (0, 3), (0, 4)]
+        result, msg, data = dest.measurement_batch("test", pack_batch(stream_id, "!Qi", records))
+        assert result == 0
+        time_stamps = data[TIMESTAMP]
+        assert time_stamps[1] == 2**32 * 1500000000
+        filled = time_stamps[[0, 2, 3]]
+        assert (np.diff(filled) == 1).all()
+        assert filled[0] > 2**32 * 1500000000
+
+        # one second steps would be wrong, so 32 bit timestamps are refused
+        config.set("Server", "timestamp_type", "uint")
+        frame = pack_batch(stream_id, "!Qi", [(0, 1), (0, 2)])
+        assert dest.measurement_batch("test", frame)[0] == 1
+    finally:
+        dest.close()
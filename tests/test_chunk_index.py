@@ -0,0 +1,152 @@
+'''
+Unit tests for the HDF5 chunk index and the window reads that search it,
+checked against a scan of every stored measurement
+'''
+
+import sys
+from os import path, getcwd
+import logging
+import ConfigParser
+
+import numpy as np
+import pytest
+
+FULL_BASE_PATH = path.dirname(path.abspath(getcwd()))
+FULL_LIB_PATH = path.join(FULL_BASE_PATH, "lib")
+sys.path.append(FULL_LIB_PATH)
+
+from origin.server import RecordBatch, HDF5Destination
+from origin import TIMESTAMP
+
+logger = logging.getLogger()
+
+START = 1500000000
+# five archived chunks of 1024 rows and some rows in the ring buffer
+ROWS = 5 * 1024 + 300
+
+
+@pytest.fixture
+def dest(tmpdir):
+    config = ConfigParser.ConfigParser()
+    config.read(path.join(FULL_BASE_PATH, "config", "origin-server-test.cfg"))
+    config.set("Server", "var_path", str(tmpdir))
+    dest = HDF5Destination(logger, config)
+    dest.register_stream("test", {"key1": "int"}, ["key1"])
+    yield dest
+    dest.close()
+
+
+def seconds(offset):
+    return int((START + offset) * 2**32)
+
+
+def time_stamps():
+    '''one measurement every 2 seconds, a run of repeated timestamps across
+    the first chunk boundary and a gap inside the third chunk'''
+    offsets = 2 * np.arange(ROWS, dtype=np.uint64)
+    offsets[1020:1030] = offsets[1020]
+    offsets[2500:] += 1000
+    return (START + offsets) * 2**32
+
+
+@pytest.fixture
+def written(dest):
+    stamps = time_stamps()
+    dest.insert_measurements("test", RecordBatch(stamps, {
+        "key1": np.arange(ROWS, dtype=np.int32)
+    }))
+    dest.flush(force=True)
+    return stamps
+
+
+def group(dest):
+    return dest.hdf5_file[dest.hdf5_file["test"].attrs["currentVersion"]]
+
+
+def scan(stamps, start, stop, limit=None):
+    '''the rows in the window, by checking every timestamp'''
+    rows = [i for i, t in enumerate(stamps) if start <= t <= stop]
+    return rows[:limit]
+
+
+def check_index(dest, stamps):
+    chunk_min, chunk_max = [dset[...] for dset in dest.chunk_index(group(dest))]
+    assert len(chunk_min) == ROWS // 1024
+    for chunk in range(ROWS // 1024):
+        rows = stamps[chunk * 1024:(chunk + 1) * 1024]
+        assert chunk_min[chunk] == rows.min()
+        assert chunk_max[chunk] == rows.max()
+
+
+def test_chunk_index(dest, written):
+    '''the index holds the timestamp range of every archived chunk'''
+    check_index(dest, written)
+
+
+def test_rebuilt_index(dest, written):
+    '''groups written without an index get it built from the archive'''
+    for suffix in ("_chunk_min", "_chunk_max"):
+        del group(dest)[TIMESTAMP + suffix]
+    check_index(dest, written)
+
+
+@pytest.mark.parametrize("window", [
+    (-100, -10),  # before the first chunk
+    (-100, 0),
+    (0, 2 * ROWS + 2000),  # everything
+    (2 * ROWS + 1000, 2 * ROWS + 2000),  # after the last row
+    (2 * ROWS + 990, 2 * ROWS + 2000),  # the end of the ring buffer
+    (2040, 2050),  # the repeated timestamps at the first chunk boundary
+    (2046, 2047),  # the first rows of the second chunk
+    (2 * 1500 + 1, 2 * 1600 + 1),  # splits the second chunk
+    (2 * 1023 - 10, 2 * 2048 + 10),  # spans a chunk
+    (5001, 5999),  # in the gap
+    (4990, 6010),  # across the gap
+    (2 * 5 * 1024 - 5, 2 * 5 * 1024 + 1004),  # from the archive into the ring buffer
+    (3001, 3001),  # between two rows
+    (3000, 3000),  # one row
+])
+def test_windows(dest, written, window):
+    '''window reads return the same rows as a scan'''
+    start, stop = seconds(window[0]), seconds(window[1])
+    expected = scan(written, start, stop)
+    result, data, msg = dest.read_stream_window("test", start, stop)
+    if not expected:
+        assert result == 1
+        assert msg == "No data in requested time window."
+        return
+    assert result == 0, msg
+    assert data["key1"].tolist() == expected
+    assert data[TIMESTAMP].tolist() == written[expected].tolist()
+
+
+@pytest.mark.parametrize("window", [(0, 2 * ROWS + 2000), (2 * 1500 + 1, 2 * ROWS)])
+@pytest.mark.parametrize("limit", [1, 1023, 1024, 3000])
+def test_limited_windows(dest, written, window, limit):
+    '''limited reads return the earliest rows of the window'''
+    start, stop = seconds(window[0]), seconds(window[1])
+    result, data, msg = dest.read_stream_window("test", start, stop, limit=limit)
+    assert result == 0, msg
+    assert data["key1"].tolist() == scan(written, start, stop, limit)
+
+
+def test_empty(dest):
+    '''a stream without saved measurements has an empty index'''
+    chunk_min, chunk_max = dest.chunk_index(group(dest))
+    assert chunk_min.shape == chunk_max.shape == (0,)
+    result, data, msg = dest.read_stream_window("test", seconds(-100), seconds(100))
+    assert result == 1
+    assert msg == "Stream declared, but no data saved."
+
+
+def test_buffer_only(dest):
+    '''measurements that were not archived yet are found without an index'''
+    stamps = time_stamps()[:100]
+    dest.insert_measurements("test", RecordBatch(stamps, {
+        "key1": np.arange(100, dtype=np.int32)
+    }))
+    dest.flush(force=True)
+    assert dest.chunk_index(group(dest))[0].shape == (0,)
+    result, data, msg = dest.read_stream_window("test", seconds(11), seconds(51))
+    assert result == 0, msg
+    assert data["key1"].tolist() == scan(stamps, seconds(11), seconds(51))
@@ -0,0 +1,57 @@
+'''
+Unit tests for the binary columnar read reply format
+'''
+
+import sys
+from os import path, getcwd
+import json
+
+import numpy as np
+
+FULL_BASE_PATH = path.dirname(path.abspath(getcwd()))
+FULL_LIB_PATH = path.join(FULL_BASE_PATH, "lib")
+sys.path.append(FULL_LIB_PATH)
+
+from origin.origin_columnar import pack_columns, unpack_columns, json_columns
+from origin import TIMESTAMP
+
+TYPES = {TIMESTAMP: "uint64", "key1": "int", "key2": "float", "key3": "string"}
+
+
+def test_roundtrip():
+    '''columns should come back with the declared types and values'''
+    data = {
+        TIMESTAMP: np.array([2**64 - 1, 2**32], dtype=">u8"),
+        "key1": [-1, 2],
+        "key2": np.array([0.5, 1.5], dtype=np.float32),
+        "key3": np.array(["ab", u"cde"], dtype=object),
+    }
+    frames = pack_columns(data, TYPES)
+    result, header = json.loads(frames[0])
+    assert result == 0
+    assert len(frames) == len(header["fields"]) + 1
+    buffers = [column.tobytes() for column in frames[1:]]
+    columns = unpack_columns(header, buffers)
+    assert columns[TIMESTAMP].dtype == np.dtype("<u8")
+    assert columns[TIMESTAMP].tolist() == [2**64 - 1, 2**32]
+    assert columns["key1"].dtype == np.dtype("<i4")
+    assert columns["key1"].tolist() == [-1, 2]
+    assert columns["key2"].tolist() == [0.5, 1.5]
+    assert columns["key3"].tolist() == ["ab", "cde"]
+
+
+def test_empty_columns():
+    '''zero length columns should unpack to empty arrays'''
+    frames = pack_columns({"key1": []}, TYPES)
+    _, header = json.loads(frames[0])
+    columns = unpack_columns(header, [b""])
+    assert len(columns["key1"]) == 0
+
+
+def test_json_columns():
+    '''numpy values should be converted for JSON encoding'''
+    data = {"key1": np.arange(3), "stats": {"max": np.uint64(2**64 - 1)}}
+    converted = json_columns(data)
+    assert json.loads(json.dumps(converted)) == {
+        "key1": [0, 1, 2], "stats": {"max": 2**64 - 1}
+    }
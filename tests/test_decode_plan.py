@@ -0,0 +1,106 @@
+'''
+Unit tests for ingest through the precompiled decode plans
+'''
+
+import sys
+from os import path, getcwd
+import logging
+import time
+import struct
+import ConfigParser
+
+import pytest
+
+FULL_BASE_PATH = path.dirname(path.abspath(getcwd()))
+FULL_LIB_PATH = path.join(FULL_BASE_PATH, "lib")
+sys.path.append(FULL_LIB_PATH)
+
+from origin.server import HDF5Destination
+from origin.server import origin_destination
+from origin.origin_batch import pack_batch
+from origin import TIMESTAMP
+
+logger = logging.getLogger()
+
+
+@pytest.fixture
+def dest(tmpdir):
+    config = ConfigParser.ConfigParser()
+    config.read(path.join(FULL_BASE_PATH, "config", "origin-server-test.cfg"))
+    config.set("Server", "var_path", str(tmpdir))
+    dest = HDF5Destination(logger, config)
+    dest.register_stream("test", {"key1": "int", "key2": "double"}, ["key1", "key2"])
+    yield dest
+    dest.close()
+
+
+def read(dest, start):
+    result, data, msg = dest.get_raw_stream_data("test", start=start - 1, stop=start + 10)
+    assert result == 0
+    return [list(data[field]) for field in (TIMESTAMP, "key1", "key2")]
+
+
+def test_plan(dest):
+    '''the plan follows the key order and is rebuilt for new versions'''
+    plan = dest.plans["test"]
+    assert plan.names == [TIMESTAMP, "key1", "key2"]
+    assert plan.format_str == "!Qid"
+    assert plan.typed
+    assert dest.find_stream(plan.id) == "test"
+
+    dest.register_stream("test", {"key1": "int", "key2": "string"}, ["key1", "key2"])
+    plan = dest.plans["test"]
+    assert plan.version == 2
+    # strings can not be sent in binary
+    assert not plan.typed
+    assert dest.measurement_binary("test", b"")[0] == 1
+
+
+def test_ingest(dest):
+    '''binary and ordered measurements are stored by field name'''
+    start = int(time.time())
+    binary = struct.pack("!Qid", 2**32 * start, 7, 0.5)
+    result, msg, meas = dest.measurement_binary("test", binary)
+    assert result == 0
+    assert meas == {TIMESTAMP: 2**32 * start, "key1": 7, "key2": 0.5}
+    # truncated packets are refused
+    assert dest.measurement_binary("test", binary[:-1])[0] == 1
+
+    result, msg, meas = dest.measurement_ordered("test", 2**32 * (start + 1), [8, 1.5])
+    assert result == 0
+    # without a plan the key indexes of the definition are used
+    del dest.plans["test"]
+    result, msg, meas = dest.measurement_ordered("test", 2**32 * (start + 2), [9, 2.5])
+    assert result == 0
+    assert meas["key1"] == 9 and meas["key2"] == 2.5
+
+    dest.store_rows()
+    dest.flush(force=True)
+    time_stamps, key1, key2 = read(dest, start)
+    assert time_stamps == [2**32 * (start + i) for i in range(3)]
+    assert key1 == [7, 8, 9]
+    assert key2 == [0.5, 1.5, 2.5]
+
+
+def test_no_plan(dest, monkeypatch):
+    '''streams whose plan does not compile are still found and ingested'''
+    def fail(stream_obj):
+        raise ValueError("no plan")
+    monkeypatch.setattr(origin_destination, "DecodePlan", fail)
+    dest.build_decode_plans()
+    assert "test" not in dest.plans
+    assert dest.find_stream(dest.known_streams["test"]["id"]) == "test"
+
+    start = int(time.time())
+    binary = struct.pack("!Qid", 2**32 * start, 7, 0.5)
+    result, msg, meas = dest.measurement_binary("test", binary)
+    assert result == 0
+    assert meas == {TIMESTAMP: 2**32 * start, "key1": 7, "key2": 0.5}
+    assert dest.measurement_binary("test", binary[:-1])[0] == 1
+    frame = pack_batch(dest.known_streams["test"]["id"], "!Qid", [(2**32 * start, 8, 1.5)])
+    assert dest.measurement_batch("test", frame)[0] == 1
+
+    dest.store_rows()
+    dest.flush(force=True)
+    time_stamps, key1, key2 = read(dest, start)
+    assert key1 == [7]
@@ -0,0 +1,148 @@
+'''
+Unit tests for the Reader disk cache, against a stand-in for the server
+'''
+
+import sys
+from os import path, getcwd
+import logging
+import time
+import ConfigParser
+
+import numpy as np
+import pytest
+
+FULL_BASE_PATH = path.dirname(path.abspath(getcwd()))
+FULL_LIB_PATH = path.join(FULL_BASE_PATH, "lib")
+sys.path.append(FULL_LIB_PATH)
+
+from origin.client.origin_disk_cache import DiskCache
+from origin import TIMESTAMP, config_option
+
+logger = logging.getLogger()
+
+# a fixed clock, on a cache block boundary
+NOW = 1500001200
+START = NOW - 4 * 3600
+
+
+class FakeReader(object):
+    '''answers raw reads from arrays, like the server, and counts them'''
+
+    def __init__(self):
+        self.known_streams = {
+            "test": {"version": 1, "definition": {"key1": {}, "key2": {}}}
+        }
+        seconds = np.arange(START, NOW, 3)
+        self.data = {
+            TIMESTAMP: seconds.astype(np.uint64) * 2**32 + 5,
+            "key1": seconds.astype(np.int32),
+            "key2": seconds / 2.,
+        }
+        self.reads = []
+        self.error = None
+
+    def get_many_stream_data(self, requests, errors=None, **kwargs):
+        if errors is None:
+            errors = []
+        replies = []
+        for request in requests:
+            self.reads.append((request['start'], request['stop']))
+            stop = request['stop'] if request['stop'] is not None else NOW
+            time_stamps = self.data[TIMESTAMP]
+            rows = (time_stamps >= request['start'] * 2**32) & (time_stamps <= stop * 2**32)
+            if self.error or not rows.any():
+                replies.append({})
+                errors.append(self.error or "No data in requested time window.")
+                continue
+            fields = [TIMESTAMP] + request['fields']
+            replies.append(dict((f, self.data[f][rows]) for f in fields))
+            errors.append(None)
+        return replies
+
+
+@pytest.fixture
+def cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(time, "time", lambda: float(NOW))
+    config = ConfigParser.ConfigParser()
+    config.read(path.join(FULL_BASE_PATH, "config", "origin-server-test.cfg"))
+    config.set("Reader", "cache_path", str(tmpdir))
+    config.set("Reader", "cache_block", "600")
+    config.set("Reader", "cache_settle", "60")
+    return DiskCache(logger, config)
+
+
+def expected(reader, start, stop, fields):
+    return reader.get_many_stream_data([
+        {'start': start, 'stop': stop, 'fields': fields}
+    ])[0]
+
+
+def test_read(cache):
+    '''cached reads match the server, and only missing blocks are read'''
+    reader = FakeReader()
+    windows = [
+        (START + 1000, START + 5000, ["key1"]),
+        (START + 100, START + 9000, ["key1"]),
+        (START + 3000, NOW - 30, ["key2", "key1"]),
+    ]
+    for start, stop, fields in windows:
+        data = cache.read(reader, "test", start, stop, fields)
+        truth = expected(FakeReader(), start, stop, fields)
+        assert sorted(data) == sorted(truth)
+        for field in truth:
+            assert (data[field] == truth[field]).all()
+
+    # the blocks of the first window were reused by the second one
+    assert reader.reads[1] == (START, START + 600)
+    del reader.reads[:]
+    data = cache.read(reader, "test", START + 200, START + 8000, ["key1"])
+    assert reader.reads == []
+    assert len(data["key1"]) == len(expected(reader, START + 200, START + 8000, ["key1"])["key1"])
+    # a field that was not cached yet is read again, up to where it was
+    del reader.reads[:]
+    cache.read(reader, "test", START + 200, START + 8000, ["key2"])
+    assert reader.reads == [(START, START + 3000)]
+
+
+def test_evict(cache):
+    '''the cache stays under its size limit'''
+    reader = FakeReader()
+    cache.max_bytes = 20000
+    data = cache.read(reader, "test", START, NOW - 600, ["key1"])
+    assert len(data["key1"]) == len(expected(reader, START, NOW - 600, ["key1"])["key1"])
+    assert 0 < cache.size <= 20000
+    assert len(cache.blocks) < 4 * 3600 // 600
+
+
+def test_empty_blocks(cache):
+    '''blocks without data are cached, blocks of failed reads are not'''
+    reader = FakeReader()
+    # no data in the second hour
+    time_stamps = reader.data[TIMESTAMP]
+    gap = (time_stamps >= (START + 3600) * 2**32) & (time_stamps < (START + 7200) * 2**32)
+    for field in reader.data:
+        reader.data[field] = reader.data[field][~gap]
+    data = cache.read(reader, "test", START + 3700, START + 7000, ["key1"])
+    assert data == {}
+    data = cache.read(reader, "test", START + 3000, START + 8000, ["key1"])
+    assert len(data["key1"]) == len(expected(reader, START + 3000, START + 8000, ["key1"])["key1"])
+    assert data["key1"].dtype == np.int32
+    del reader.reads[:]
+    assert cache.read(reader, "test", START + 3700, START + 7000, ["key1"]) == {}
+    assert reader.reads == []
+
+    reader.error = "Server encountered an error."
+    assert cache.read(reader, "test", START + 9000, START + 9500, ["key1"]) == {}
+    reader.error = None
+    del reader.reads[:]
+    data = cache.read(reader, "test", START + 9000, START + 9500, ["key1"])
+    assert reader.reads == [(START + 9000, START + 9600)]
+    assert len(data["key1"]) == len(expected(reader, START + 9000, START + 9500, ["key1"])["key1"])
+
+
+@pytest.mark.parametrize("name", ["origin-server.cfg", "origin-server-test.cfg"])
+def test_shipped_config(name):
+    '''the shipped configs leave the disk cache off'''
+    config = ConfigParser.ConfigParser()
+    config.read(path.join(FULL_BASE_PATH, "config", name))
+    assert config_option(config, "Reader", "cache_path", "") == ""
@@ -0,0 +1,91 @@
+'''
+Unit tests for the min/max and LTTB downsampling of raw reads
+'''
+
+import sys
+from os import path, getcwd
+
+import numpy as np
+import pytest
+
+FULL_BASE_PATH = path.dirname(path.abspath(getcwd()))
+FULL_LIB_PATH = path.join(FULL_BASE_PATH, "lib")
+sys.path.append(FULL_LIB_PATH)
+
+from origin.server.origin_downsample import (
+    downsample, minmax_indices, lttb_indices
+)
+from origin import TIMESTAMP
+
+COUNT = 10000
+TYPES = {TIMESTAMP: "uint64", "key1": "double", "key2": "int", "key3": "string"}
+
+
+def make_data():
+    time_stamps = (1500000000 + np.arange(COUNT, dtype=np.uint64)) * 2**32
+    key1 = np.sin(np.arange(COUNT) / 500.)
+    key1[1234] = 10.
+    key1[8765] = -10.
+    return {
+        TIMESTAMP: time_stamps,
+        "key1": key1,
+        "key2": np.arange(COUNT, dtype=np.int32),
+        "key3": np.array(["s"] * COUNT),
+    }
+
+
+def test_minmax_keeps_extremes():
+    '''the spikes should survive decimation'''
+    data = make_data()
+    picked = minmax_indices(data[TIMESTAMP], data["key1"], 100)
+    assert len(picked) <= 100
+    assert (np.diff(picked) > 0).all()
+    assert 1234 in picked and 8765 in picked
+
+
+def test_lttb():
+    '''lttb keeps the ends and the spikes, with one point per bucket'''
+    data = make_data()
+    picked = lttb_indices(data[TIMESTAMP], data["key1"], 100)
+    assert len(picked) == 100
+    assert picked[0] == 0 and picked[-1] == COUNT - 1
+    assert (np.diff(picked) > 0).all()
+    assert 1234 in picked and 8765 in picked
+
+
+@pytest.mark.parametrize("method", ["minmax", "lttb"])
+def test_downsample(method):
+    '''all fields should stay aligned on the picked timestamps'''
+    data = make_data()
+    result = downsample(data, TYPES, 500, method)
+    assert set(result) == set(data)
+    assert 0 < len(result[TIMESTAMP]) <= 500
+    for field in result:
+        assert len(result[field]) == len(result[TIMESTAMP])
+    # key2 is the row number, so it shows which rows were picked
+    rows = result["key2"]
+    assert (result[TIMESTAMP] == data[TIMESTAMP][rows]).all()
+    assert (result["key1"] == data["key1"][rows]).all()
+
+
+def test_small_windows_unchanged():
+    '''windows with fewer measurements than max_points are not decimated'''
+    data = make_data()
+    assert downsample(data, TYPES, COUNT) is data
+    with pytest.raises(ValueError):
+        downsample(data, TYPES, 10, "median")
+
+
+@pytest.mark.parametrize("method,least", [("minmax", 4), ("lttb", 6)])
+def test_too_few_points(method, least):
+    '''every numeric field needs a share of the points, the reply is never
+    larger than max_points'''
+    data = make_data()
+    for max_points in range(1, least):
+        with pytest.raises(ValueError):
+            downsample(data, TYPES, max_points, method)
+    for max_points in range(least, least + 5):
+        result = downsample(data, TYPES, max_points, method)
+        assert 0 < len(result[TIMESTAMP]) <= max_points
+    del data["key1"], data["key2"]
+    assert len(downsample(data, TYPES, 1, method)[TIMESTAMP]) == 1
@@ -0,0 +1,106 @@
+'''
+Unit tests for the time bucketed mongodb storage, run against mongomock
+'''
+
+import sys
+from os import path, getcwd
+import logging
+import ConfigParser
+
+import numpy as np
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+FULL_BASE_PATH = path.dirname(path.abspath(getcwd()))
+FULL_LIB_PATH = path.join(FULL_BASE_PATH, "lib")
+sys.path.append(FULL_LIB_PATH)
+
+import pymongo
+from origin.server import RecordBatch
+from origin.server.origin_mongodb_destination import (
+    MongoDBDestination, encode_column, decode_column
+)
+from origin import TIMESTAMP
+
+logger = logging.getLogger()
+
+START = 1500000000
+TEMPLATE = {"big": "uint64", "value": "double", "label": "string"}
+
+
+@pytest.fixture
+def dest(monkeypatch):
+    monkeypatch.setattr(pymongo, "MongoClient", mongomock.MongoClient)
+    config = ConfigParser.ConfigParser()
+    config.read(path.join(FULL_BASE_PATH, "config", "origin-server-test.cfg"))
+    config.set("MongoDB", "bucket_seconds", "60")
+    config.set("MongoDB", "bucket_size", "50")
+    dest = MongoDBDestination(logger, config)
+    dest.register_stream("test", TEMPLATE, ["big", "value", "label"])
+    return dest
+
+
+def make_batch(seconds):
+    timestamps = np.array([s * 2**32 for s in seconds], dtype=np.uint64)
+    return RecordBatch(timestamps, {
+        "big": np.array([2**64 - 1 - s for s in seconds], dtype=np.uint64),
+        "value": np.array(seconds, dtype=np.float64) / 2,
+        "label": np.array(["s{}".format(s) for s in seconds], dtype=object),
+    })
+
+
+def test_uint64_order():
+    '''encoded uint64 values should sort like the original values'''
+    values = np.array([0, 1, 2**63 - 1, 2**63, 2**64 - 1], dtype=np.uint64)
+    encoded = encode_column(values, "uint64")
+    assert encoded == sorted(encoded)
+    assert max(encoded) < 2**63 and min(encoded) >= -2**63
+    assert (decode_column(encoded, "uint64") == values).all()
+
+
+def test_buckets(dest):
+    '''samples are grouped by bucket time and split at the bucket size'''
+    seconds = range(START, START + 300)
+    dest.insert_measurements("test", make_batch(seconds[:120]))
+    dest.insert_measurements("test", make_batch(seconds[120:]))
+    docs = list(dest.collection("test").find())
+    assert sum(doc["n"] for doc in docs) == 300
+    assert all(doc["n"] <= 2 * 50 for doc in docs)
+    for doc in docs:
+        assert doc["tmin"] <= doc["tmax"]
+        assert set(s >> 32 for s in decode_column(doc[TIMESTAMP], "uint64").tolist()) <= \
+            set(range(doc["bucket"], doc["bucket"] + 60))
+
+
+def test_read_window(dest):
+    '''reads return native values for just the requested window'''
+    seconds = range(START, START + 300)
+    dest.insert_measurements("test", make_batch(seconds))
+    result, data, _ = dest.get_raw_stream_data("test", start=START + 55, stop=START + 125)
+    assert result == 0
+    assert [t >> 32 for t in data[TIMESTAMP].tolist()] == range(START + 55, START + 126)
+    assert data["big"][0] == 2**64 - 1 - (START + 55)
+    assert data["value"][-1] == (START + 125) / 2.
+    assert data["label"][0] == "s{}".format(START + 55)
+
+    result, data, _ = dest.get_raw_stream_data("test", start=START - 100, stop=START - 10)
+    assert result == 1
+
+
+def test_pages(dest):
+    '''pages should hold every sample once, in order'''
+    seconds = range(START, START + 300)
+    dest.insert_measurements("test", make_batch(seconds))
+    cursor = None
+    values = []
+    while True:
+        result, data, _, cursor = dest.get_raw_stream_page(
+            "test", START, START + 300, page_rows=70, cursor=cursor
+        )
+        assert result == 0
+        assert len(data["value"]) <= 70
+        values.extend(data["value"].tolist())
+        if cursor is None:
+            break
+    assert values == [s / 2. for s in seconds]
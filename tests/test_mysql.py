@@ -0,0 +1,245 @@
+'''
+Unit tests for the MySQL destination, against a stand-in for the connector
+'''
+
+import sys
+from os import path, getcwd
+import logging
+import time
+import json
+import threading
+import ConfigParser
+from decimal import Decimal
+
+import numpy as np
+import pytest
+
+FULL_BASE_PATH = path.dirname(path.abspath(getcwd()))
+FULL_LIB_PATH = path.join(FULL_BASE_PATH, "lib")
+sys.path.append(FULL_LIB_PATH)
+
+connector = pytest.importorskip("mysql.connector")
+
+from origin.server import RecordBatch
+from origin.server import origin_mysql_destination
+from origin.server.origin_mysql_destination import MySQLDestination
+from origin.server.origin_destination import Destination
+
+logger = logging.getLogger()
+
+START = 1500000000
+
+
+class FakeCursor(object):
+    '''records the queries and returns the rows the connection has for them'''
+
+    def __init__(self, cnx):
+        self.cnx = cnx
+        self.rows = []
+        self.rowcount = -1
+
+    def execute(self, query, params=None):
+        self.cnx.queries.append((query, params))
+        self.rows = list(self.cnx.results(query, params))
+        self.rowcount = len(self.rows)
+
+    def executemany(self, query, rows):
+        if self.cnx.fail_inserts:
+            raise connector.Error("insert failed")
+        self.cnx.inserts.append((query, list(rows)))
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+
+    def __init__(self, pool=None):
+        self.pool = pool
+        self.queries = []
+        self.inserts = []
+        self.commits = 0
+        self.fail_inserts = False
+        self.results = lambda query, params: []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def close(self):
+        if self.pool is not None:
+            # back to the pool
+            self.pool.free.append(self)
+
+
+class FakePool(object):
+
+    def __init__(self, pool_size, **kwargs):
+        self.pool_size = pool_size
+        self.free = [FakeConnection(self) for i in range(pool_size)]
+
+    def get_connection(self):
+        if not self.free:
+            raise connector.errors.PoolError("pool exhausted")
+        return self.free.pop()
+
+
+@pytest.fixture
+def dest(monkeypatch):
+    monkeypatch.setattr(connector, "connect", lambda **kwargs: FakeConnection())
+    monkeypatch.setattr(origin_mysql_destination.pooling, "MySQLConnectionPool", FakePool)
+    config = ConfigParser.ConfigParser()
+    config.read(path.join(FULL_BASE_PATH, "config", "origin-server-test.cfg"))
+    config.set("MySQL", "commit_interval", "100")
+    config.set("MySQL", "commit_rows", "10")
+    config.set("ReadPool", "workers", "3")
+    dest = MySQLDestination(logger, config)
+    # reading the stream tables commits once
+    dest.cnx.commits = 0
+    dest.known_streams["test"] = {"stream": "test", "id": 1, "version": 1}
+    dest.known_stream_versions["test"] = {
+        "key1": {"type": "int", "key_index": 0},
+        "key2": {"type": "double", "key_index": 1},
+    }
+    return dest
+
+
+def batch(start, rows):
+    time_stamps = (start + np.arange(rows, dtype=np.uint64)) * 2**32
+    return RecordBatch(time_stamps, {
+        "key1": np.arange(rows, dtype=np.int32),
+        "key2": np.arange(rows) / 2.,
+    })
+
+
+def test_grouped_commits(dest):
+    '''each batch is one multi-row insert, commits wait for enough rows'''
+    for i in range(2):
+        dest.insert_measurements("test", batch(START + 4 * i, 4))
+    assert dest.cnx.commits == 0
+    query, rows = dest.cnx.inserts[0]
+    assert query.startswith("INSERT INTO measurements_test_1 (measurement_time,key1,key2)")
+    assert rows[1] == (2**32 * (START + 1), 1, 0.5)
+    assert len(dest.cnx.inserts) == 2
+
+    dest.insert_measurements("test", batch(START + 8, 4))
+    assert dest.cnx.commits == 1
+    assert not dest.uncommitted and dest.uncommitted_rows == 0
+    dest.insert_measurements("test", batch(START + 12, 4))
+    # the commit interval is not up
+    dest.flush()
+    assert dest.cnx.commits == 1
+    dest.flush(force=True)
+    assert dest.cnx.commits == 2
+
+
+def test_failed_insert(dest):
+    '''failed inserts are sent again on flush, until they are dropped'''
+    dest.cnx.fail_inserts = True
+    dest.insert_measurements("test", batch(START, 4))
+    assert [tries for _, _, tries in dest.retries] == [1]
+    assert not dest.uncommitted
+    dest.flush(force=True)
+    assert [tries for _, _, tries in dest.retries] == [2]
+    dest.flush(force=True)
+    assert not dest.retries
+    assert dest.cnx.commits == 0
+
+    dest.insert_measurements("test", batch(START, 4))
+    dest.cnx.fail_inserts = False
+    dest.flush(force=True)
+    assert not dest.retries
+    assert len(dest.cnx.inserts) == 1
+    assert dest.cnx.commits == 1
+
+
+def test_read_pool(dest):
+    '''the pool has a connection per read worker, reads wait for a free one'''
+    assert dest.read_pool.pool_size == 3
+    held = [dest.read_connection() for i in range(3)]
+    dest.read_pool_wait = 0.05
+    with pytest.raises(connector.errors.PoolError):
+        dest.read_connection()
+    dest.read_pool_wait = 2
+    release = threading.Timer(0.1, held.pop().close)
+    release.start()
+    before = time.time()
+    assert dest.read_connection() is not None
+    assert time.time() - before >= 0.05
+    release.join()
+
+
+def aggregate(data, query, params):
+    '''answer the stats queries from arrays, like the database would'''
+    columns = query[len("SELECT "):query.index(" FROM")].split(",")
+    time_stamps = data["measurement_time"]
+    rows = (time_stamps >= params[0]) & (time_stamps <= params[1])
+    functions = {
+        "COUNT": lambda values: len(values),
+        "AVG": lambda values: Decimal(repr(values.mean())) if len(values) else None,
+        "STDDEV_POP": lambda values: float(values.std()) if len(values) else None,
+        # python types, as the connector returns them
+        "MIN": lambda values: values.min().item() if len(values) else None,
+        "MAX": lambda values: values.max().item() if len(values) else None,
+    }
+    if columns[0] != "COUNT(*)":
+        # the string query
+        return zip(*[data[column][rows].tolist() for column in columns])
+    row = [len(time_stamps[rows])]
+    for column in columns[1:]:
+        function, field = column[:-1].split("(")
+        row.append(functions[function](data[field][rows]))
+    return [tuple(row)]
+
+
+def test_stats(dest):
+    '''the stats query gives the same stats as computing them from the raw
+    data'''
+    dest.known_stream_versions["test"]["key3"] = {"type": "string", "key_index": 2}
+    time_stamps = (START + np.arange(100, dtype=np.uint64)) * 2**32
+    data = {
+        "measurement_time": time_stamps,
+        "key1": (np.arange(100) % 7).astype(np.int32),
+        "key2": np.sin(np.arange(100)),
+        "key3": np.array(["s{}".format(i) for i in range(100)]),
+    }
+    for cnx in dest.read_pool.free:
+        cnx.results = lambda query, params: aggregate(data, query, params)
+
+    result, stats, msg = dest.get_stat_stream_data("test", START + 10, START + 49)
+    assert result == 0, msg
+    cnx, = [c for c in dest.read_pool.free if c.queries]
+    query, params = cnx.queries[0]
+    assert query.startswith("SELECT COUNT(*),MIN(measurement_time),MAX(measurement_time),")
+    assert " FROM measurements_test_1 WHERE measurement_time BETWEEN %s AND %s" in query
+    assert params == ((START + 10) * 2**32, (START + 49) * 2**32)
+
+    rows = slice(10, 50)
+    raw = dict((field, data[field][rows]) for field in data)
+    dest.get_raw_stream_data = lambda *args, **kwargs: (0, raw, "")
+    result, expected, msg = Destination.get_stat_stream_data(dest, "test", START + 10, START + 49)
+    assert sorted(stats) == sorted(expected)
+    assert stats["measurement_time"] == {"start": time_stamps[10], "stop": time_stamps[49]}
+    for field in ("key1", "key2"):
+        for stat in ("average", "standard_deviation", "min", "max"):
+            assert stats[field][stat] == pytest.approx(expected[field][stat])
+        assert type(stats[field]["min"]) == type(expected[field]["min"])
+    assert stats["key3"] == data["key3"][rows].tolist()
+    # the reply goes out as JSON
+    json.dumps(stats)
+
+    result, stats, msg = dest.get_stat_stream_data("test", START + 200, START + 300)
+    assert result == 1
+    assert msg == "Stream declared, but no data saved."
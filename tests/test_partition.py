@@ -0,0 +1,130 @@
+'''
+Unit tests for the partitioned HDF5 destination: the catalog and roll-over
+'''
+
+import sys
+from os import path, getcwd
+import logging
+import time
+import json
+import ConfigParser
+
+import numpy as np
+import pytest
+
+FULL_BASE_PATH = path.dirname(path.abspath(getcwd()))
+FULL_LIB_PATH = path.join(FULL_BASE_PATH, "lib")
+sys.path.append(FULL_LIB_PATH)
+
+from origin.server import RecordBatch, HDF5Destination
+from origin import TIMESTAMP
+
+logger = logging.getLogger()
+
+DAY = 24 * 3600
+# the middle of a day, the partitions are cut at midnight UTC
+START = 1500000000 - 1500000000 % DAY + DAY / 2
+
+NAME = "/test/test_1"
+
+
+class Clock(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return float(self.now)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(START)
+    monkeypatch.setattr(time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def dest(tmpdir, clock):
+    config = ConfigParser.ConfigParser()
+    config.read(path.join(FULL_BASE_PATH, "config", "origin-server-test.cfg"))
+    config.set("Server", "var_path", str(tmpdir))
+    config.set("HDF5", "partition", "day")
+    dest = HDF5Destination(logger, config)
+    dest.register_stream("test", {"key1": "int"}, ["key1"])
+    yield dest
+    dest.close()
+
+
+def write(dest, start, rows):
+    '''write one measurement per second from start'''
+    time_stamps = (start + np.arange(rows, dtype=np.uint64)) * 2**32
+    dest.insert_measurements("test", RecordBatch(time_stamps, {
+        "key1": (start - START + np.arange(rows)).astype(np.int32)
+    }))
+
+
+def read(dest, start, stop):
+    result, data, msg = dest.read_stream_window("test", start * 2**32, stop * 2**32)
+    assert result == 0, msg
+    assert len(data[TIMESTAMP]) == len(data["key1"])
+    return data["key1"].tolist()
+
+
+def test_catalog(dest, clock):
+    '''the catalog lists the partitions and the time range of each stream'''
+    write(dest, START, 100)
+    dest.flush(force=True)
+    with open(dest.catalog_path()) as f:
+        catalog = json.load(f)
+    entry, = catalog["partitions"]
+    assert entry["start"] == START - DAY / 2
+    assert entry["stop"] == START + DAY / 2
+    assert not entry["closed"]
+    assert entry["streams"][NAME] == [START * 2**32, (START + 99) * 2**32]
+    assert "test" in catalog["knownStreams"]
+
+
+def test_roll_over(dest, clock):
+    '''reads span the partitions, and only open the ones in the window'''
+    write(dest, START, 100)
+    dest.flush(force=True)
+    first = dest.hdf5_file
+    clock.now = START + DAY
+    dest.flush()
+    assert dest.hdf5_file is not first
+    assert not first
+    write(dest, START + DAY - 50, 100)
+    dest.flush(force=True)
+
+    partitions = dest.catalog["partitions"]
+    assert [p["closed"] for p in partitions] == [True, False]
+    assert partitions[1]["file"] != partitions[0]["file"]
+    assert read(dest, START + DAY, START + DAY + 5) == range(DAY, DAY + 6)
+    assert not dest.closed_files
+    # rows from both files, and the ones still in the write buffer
+    write(dest, START + DAY + 50, 10)
+    assert read(dest, START + 50, START + DAY + 55) == (
+        range(50, 100) + range(DAY - 50, DAY + 56)
+    )
+    assert dest.closed_files.keys() == [partitions[0]["file"]]
+    assert not dest.pins
+
+
+def test_roll_while_reading(dest, clock):
+    '''a file rolled over while it is read is closed after the read'''
+    write(dest, START, 100)
+    dest.flush(force=True)
+    files = dest.read_files(NAME, START * 2**32, (START + 100) * 2**32)
+    first = dest.hdf5_file
+    dest.pin_files(files)
+    clock.now = START + DAY
+    dest.flush()
+    assert dest.hdf5_file is not first
+    # still open for the running read
+    assert first
+    part = dest.read_group("test", first[NAME], ["key1"], START * 2**32, (START + 100) * 2**32, True)
+    assert part[1]["key1"].tolist() == range(100)
+    dest.unpin_files(files)
+    assert not first
+    assert not dest.pins and not dest.retired
@@ -0,0 +1,73 @@
+'''
+Unit tests for the pipelined reader
+'''
+
+import sys
+from os import path, getcwd
+import logging
+import time
+import json
+import threading
+import ConfigParser
+
+import zmq
+
+FULL_BASE_PATH = path.dirname(path.abspath(getcwd()))
+FULL_LIB_PATH = path.join(FULL_BASE_PATH, "lib")
+sys.path.append(FULL_LIB_PATH)
+
+from origin.client.origin_reader import Reader
+
+logger = logging.getLogger()
+
+STREAMS = json.dumps((0, dict(
+    streams={name: {"id": i + 1, "key_order": ["value"]} for i, name in enumerate("abcde")}
+)))
+
+
+def read_server(router, rounds):
+    '''answer the stream list, then each round of reads in the given order,
+    None waits a while'''
+    for count, order in rounds:
+        requests = []
+        while len(requests) < count:
+            frames = router.recv_multipart()
+            i = frames.index(b'')
+            if frames[i + 1] == '{}':
+                router.send_multipart(frames[:i + 1] + [STREAMS])
+            else:
+                requests.append((frames[:i + 1], json.loads(frames[i + 1])))
+        for index in order:
+            if index is None:
+                time.sleep(0.4)
+                continue
+            envelope, request = requests[index]
+            router.send_multipart(envelope + [json.dumps((0, {"stream": request["stream"]}))])
+
+
+def test_out_of_order():
+    '''replies are matched to their requests, late replies are dropped'''
+    router = zmq.Context.instance().socket(zmq.ROUTER)
+    config = ConfigParser.ConfigParser()
+    config.read(path.join(FULL_BASE_PATH, "config", "origin-server-test.cfg"))
+    config.set("Server", "read_port", str(router.bind_to_random_port("tcp://127.0.0.1")))
+    config.set("Reader", "timeout", "200")
+    rounds = [(3, [2, 0, 1]), (2, [1, None, 0]), (1, [0])]
+    server = threading.Thread(target=read_server, args=(router, rounds))
+    server.start()
+
+    reader = Reader(config, logger, pipeline=True)
+    try:
+        results = reader.get_many_stream_data(["a", "b", "c"], raw=True)
+        assert results == [{"stream": s} for s in "abc"]
+        # the reply to d comes in after d timed out, e is kept until asked for
+        errors = []
+        assert reader.get_many_stream_data(["d", "e"], errors=errors, raw=True) == [{}, {"stream": "e"}]
+        assert errors[0] and errors[1] is None
+        reader.read_sock.setsockopt(zmq.RCVTIMEO, 2000)
+        assert reader.get_many_stream_data(["a"], raw=True) == [{"stream": "a"}]
+        assert not reader.pending and not reader.replies
+    finally:
+        server.join()
+        reader.close()
+        router.close(linger=0)
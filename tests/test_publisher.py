@@ -0,0 +1,108 @@
+'''
+Unit tests for the publisher thread
+'''
+
+import sys
+from os import path, getcwd
+import logging
+import time
+import json
+import ConfigParser
+
+import pytest
+import zmq
+
+FULL_BASE_PATH = path.dirname(path.abspath(getcwd()))
+FULL_LIB_PATH = path.join(FULL_BASE_PATH, "lib")
+sys.path.append(FULL_LIB_PATH)
+
+from origin.server import HDF5Destination, Publisher
+from origin.server.origin_publisher import PUBLISH_FORMATS
+from origin.origin_batch import pack_batch, unpack_batch
+from origin import TIMESTAMP
+
+logger = logging.getLogger()
+
+RECORDS = [(2**32 * 1500000000 + i, i, i / 2.) for i in range(5)]
+
+
+@pytest.fixture(params=PUBLISH_FORMATS)
+def publisher(request, tmpdir):
+    config = ConfigParser.ConfigParser()
+    config.read(path.join(FULL_BASE_PATH, "config", "origin-server-test.cfg"))
+    config.set("Server", "var_path", str(tmpdir))
+    config.set("Server", "publish_format", request.param)
+    # a port per format, the previous socket may not be closed yet
+    port = config.getint("Server", "pub_port") + 100 + PUBLISH_FORMATS.index(request.param)
+    config.set("Server", "pub_port", str(port))
+    dest = HDF5Destination(logger, config)
+    dest.register_stream("test", {"key1": "int", "key2": "double"}, ["key1", "key2"])
+    publisher = Publisher(logger, config, dest)
+    sub = zmq.Context.instance().socket(zmq.SUB)
+    sub.setsockopt(zmq.RCVTIMEO, 2000)
+    sub.connect("tcp://127.0.0.1:{}".format(config.getint("Server", "pub_port")))
+    yield (publisher, sub)
+    sub.close(linger=0)
+    publisher.close()
+    dest.close()
+
+
+def subscribe(publisher, sub, stream_id):
+    sub.setsockopt(zmq.SUBSCRIBE, publisher.topic(stream_id))
+    deadline = time.time() + 2
+    while not publisher.has_subscribers(stream_id):
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_publish(publisher):
+    '''measurements are only handed off with subscribers, and arrive in order'''
+    publisher, sub = publisher
+    stream_id = publisher.dest.known_streams["test"]["id"]
+    dtype = publisher.dest.plans["test"].dtype
+    frame = pack_batch(stream_id, "!Qid", RECORDS)
+    records = unpack_batch(frame, dtype)
+    publisher.publish_batch(stream_id, "test", frame, records)
+    assert publisher.stats()["queued"] == 0
+
+    subscribe(publisher, sub, stream_id)
+    publisher.publish_batch(stream_id, "test", frame, records)
+    publisher.publish(stream_id, "test", {TIMESTAMP: 2**32, "key1": 7, "key2": 0.5})
+
+    received = []
+    while len(received) < len(RECORDS) + 1:
+        topic, payload = sub.recv_multipart()
+        assert topic == publisher.topic(stream_id)
+        if publisher.publish_format == "binary":
+            received.extend(unpack_batch(payload, dtype).tolist())
+        else:
+            row = json.loads(payload)
+            received.append((row[TIMESTAMP], row["key1"], row["key2"]))
+    assert received == RECORDS + [(2**32, 7, 0.5)]
+    assert publisher.stats()["queued"] == len(RECORDS) + 1
+
+
+def test_order(publisher):
+    '''records and measurement dictionaries are sent in hand-off order'''
+    publisher, sub = publisher
+    stream_id = publisher.dest.known_streams["test"]["id"]
+    subscribe(publisher, sub, stream_id)
+    measurements = [
+        {TIMESTAMP: 2**32 * (1500000000 + i), "key1": i, "key2": i / 2.} for i in range(6)
+    ]
+    # a value that does not fit the stream format is handed off as a dictionary
+    measurements[2]["key1"] = 2**40
+    for meas in measurements:
+        publisher.publish(stream_id, "test", meas)
+
+    received = []
+    while len(received) < len(measurements):
+        topic, payload = sub.recv_multipart()
+        try:
+            row = json.loads(payload)
+        except ValueError:
+            dtype = publisher.dest.plans["test"].dtype
+            received.extend(row[1] for row in unpack_batch(payload, dtype).tolist())
+        else:
+            received.append(row["key1"])
+    assert received == [meas["key1"] for meas in measurements]
@@ -0,0 +1,112 @@
+'''
+Unit tests for the read reply cache
+'''
+
+import sys
+from os import path, getcwd
+import logging
+import json
+import time
+import ConfigParser
+
+import numpy as np
+import pytest
+
+FULL_BASE_PATH = path.dirname(path.abspath(getcwd()))
+FULL_LIB_PATH = path.join(FULL_BASE_PATH, "lib")
+sys.path.append(FULL_LIB_PATH)
+
+from origin.server import ReadCache
+
+logger = logging.getLogger()
+
+START = 1500000000
+REPLY = ['[0, {"value": [1, 2, 3]}]']
+
+
+@pytest.fixture
+def cache():
+    config = ConfigParser.ConfigParser()
+    config.read(path.join(FULL_BASE_PATH, "config", "origin-server-test.cfg"))
+    config.set("ReadCache", "quantum", "10")
+    config.set("ReadCache", "max_entries", "3")
+    return ReadCache(logger, config)
+
+
+def request(start, stop, **kwargs):
+    kwargs.update(stream="test", start=start, stop=stop)
+    kwargs = dict((k, v) for k, v in kwargs.items() if v is not None)
+    return json.dumps(kwargs)
+
+
+def store(cache, msg):
+    '''read and store a request, return its key'''
+    key, _, stream, window = cache.normalize(msg)
+    assert not cache.wait(key, ["client"])
+    cache.finish(key, stream, window, REPLY, cache.sequence_number())
+    return key
+
+
+def test_normalize(cache, monkeypatch):
+    '''polls up to now share a key, explicit windows are read as requested'''
+    key, msg, stream, window = cache.normalize(request(START + 1.5, START + 19, raw=True))
+    assert window == (START + 1, START + 19)
+    assert (json.loads(msg)["start"], json.loads(msg)["stop"]) == (START + 1.5, START + 19)
+    assert cache.normalize(request(START + 1.5, START + 19.0, raw=True))[0] == key
+    assert cache.normalize(request(START + 1, START + 19, raw=True))[0] != key
+    assert cache.normalize(request(START + 1.5, START + 19, raw=False))[0] != key
+
+    monkeypatch.setattr(time, "time", lambda: START + 1.0)
+    key, msg, stream, window = cache.normalize(request(START - 100, None))
+    assert window == (START - 100, START + 10)
+    monkeypatch.setattr(time, "time", lambda: START + 9.0)
+    assert cache.normalize(request(START - 100, None))[0] == key
+    key, msg, stream, window = cache.normalize(request(None, None))
+    assert window == (START + 10 - 300, START + 10)
+    assert "start" not in json.loads(msg)
+    # paged and malformed requests are not cached
+    assert cache.normalize(request(START, START + 10, page_rows=10))[0] is None
+    assert cache.normalize('{}')[0] is None
+
+
+def test_invalidate(cache):
+    '''only entries overlapping the written measurements are dropped'''
+    old = store(cache, request(START, START + 100))
+    new = store(cache, request(START + 200, START + 300))
+    assert cache.get(old) == REPLY
+    cache.invalidate("test", np.array([START + 250, START + 260], dtype=np.uint64) * 2**32)
+    assert cache.get(old) == REPLY
+    assert cache.get(new) is None
+    cache.invalidate("other", np.array([START + 50], dtype=np.uint64) * 2**32)
+    assert cache.get(old) == REPLY
+
+
+def test_coalesce(cache):
+    '''identical requests wait for the first reply, which is not stored if
+    overlapping measurements were written during the read'''
+    key, _, stream, window = cache.normalize(request(START, START + 100))
+    assert not cache.wait(key, ["first"])
+    sequence = cache.sequence_number()
+    assert cache.wait(key, ["second"])
+    assert cache.wait(key, ["third"])
+    cache.invalidate("test", np.array([START + 50], dtype=np.uint64) * 2**32)
+    assert cache.finish(key, stream, window, REPLY, sequence) == [["second"], ["third"]]
+    assert cache.get(key) is None
+    # errors are not stored either
+    assert not cache.wait(key, ["first"])
+    cache.finish(key, stream, window, ['[1, {"error": "x"}]'], cache.sequence_number())
+    assert cache.get(key) is None
+    # a read that timed out hands back its waiters, the next one reads again
+    assert not cache.wait(key, ["first"])
+    assert cache.wait(key, ["second"])
+    assert cache.abandon(key) == [["second"]]
+    assert not cache.wait(key, ["third"])
+
+
+def test_evict(cache):
+    '''the least recently used entries are evicted first'''
+    keys = [store(cache, request(START + 100 * i, START + 100 * i + 50)) for i in range(3)]
+    assert cache.get(keys[0]) == REPLY
+    store(cache, request(START + 1000, START + 1050))
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == REPLY
@@ -0,0 +1,169 @@
+'''
+Unit tests for paged raw reads with the file based destinations
+'''
+
+import sys
+from os import path, getcwd
+import logging
+import time
+import ConfigParser
+
+import numpy as np
+import pytest
+
+FULL_BASE_PATH = path.dirname(path.abspath(getcwd()))
+FULL_LIB_PATH = path.join(FULL_BASE_PATH, "lib")
+sys.path.append(FULL_LIB_PATH)
+
+from origin.server import RecordBatch, HDF5Destination
+from origin.server.origin_filesystem_destination import FilesystemDestination
+from origin import TIMESTAMP
+
+logger = logging.getLogger()
+
+ROWS = 3000
+
+
+@pytest.fixture(params=["hdf5", "filesystem"])
+def dest(request, tmpdir):
+    config = ConfigParser.ConfigParser()
+    config.read(path.join(FULL_BASE_PATH, "config", "origin-server-test.cfg"))
+    config.set("Server", "var_path", str(tmpdir))
+    if request.param == "hdf5":
+        dest = HDF5Destination(logger, config)
+    else:
+        dest = FilesystemDestination(logger, config)
+    dest.register_stream("test", {"key1": "int"}, ["key1"])
+    yield dest
+    dest.close()
+
+
+def write(dest):
+    '''write one measurement per second ending now, with a run of repeated
+    timestamps, and return the start of the window'''
+    start = int(time.time()) - ROWS
+    time_stamps = (start + np.arange(ROWS, dtype=np.uint64)) * 2**32
+    time_stamps[100:400] = time_stamps[100]
+    dest.insert_measurements("test", RecordBatch(time_stamps, {
+        "key1": np.arange(ROWS, dtype=np.int32)
+    }))
+    return start
+
+
+@pytest.mark.parametrize("page_rows", [1, 64, 1024, 5000])
+def test_pages(dest, page_rows):
+    '''pages should hold every measurement once, in order'''
+    start = write(dest)
+    cursor = None
+    values = []
+    while True:
+        result, data, msg, cursor = dest.get_raw_stream_page(
+            "test", start, start + ROWS, page_rows=page_rows, cursor=cursor
+        )
+        assert result == 0, msg
+        assert len(data["key1"]) <= page_rows
+        assert len(data[TIMESTAMP]) == len(data["key1"])
+        values.extend(data["key1"].tolist())
+        if cursor is None:
+            break
+    assert values == range(ROWS)
+
+
+def test_limit(dest):
+    '''a limited window read should return the earliest measurements'''
+    start = write(dest)
+    result, data, _ = dest.read_stream_window(
+        "test", (start + 1000) * 2**32, (start + ROWS) * 2**32, limit=10
+    )
+    assert result == 0
+    assert data["key1"].tolist() == range(1000, 1010)
+
+
+def test_buffered(dest):
+    '''measurements still buffered in memory are read without writing them'''
+    start = write(dest)
+    time_stamps = (start + ROWS + np.arange(5, dtype=np.uint64)) * 2**32
+    dest.insert_measurements("test", RecordBatch(time_stamps, {
+        "key1": ROWS + np.arange(5, dtype=np.int32)
+    }))
+    buffers = getattr(dest, "append_buffers", {})
+    if buffers:
+        assert buffers["test"].pending_rows == 5
+    result, data, _ = dest.read_stream_window(
+        "test", (start + ROWS - 5) * 2**32, (start + ROWS + 5) * 2**32
+    )
+    assert result == 0
+    assert data["key1"].tolist() == range(ROWS - 5, ROWS + 5)
+    if buffers:
+        assert buffers["test"].pending_rows == 5
+
+
+def test_upgraded_stream(tmpdir):
+    '''filesystem streams written in the old text format are read together
+    with the binary columns written since'''
+    config = ConfigParser.ConfigParser()
+    config.read(path.join(FULL_BASE_PATH, "config", "origin-server-test.cfg"))
+    config.set("Server", "var_path", str(tmpdir))
+    dest = FilesystemDestination(logger, config)
+    dest.register_stream("test", {"key1": "int"}, ["key1"])
+    start = int(time.time()) - 100
+    # one text file per field, one value per line
+    version_path = dest.version_path("test")
+    with open(path.join(version_path, TIMESTAMP), 'w') as f:
+        f.write(''.join("{}\n".format((start + i) * 2**32) for i in range(3)))
+    with open(path.join(version_path, "key1"), 'w') as f:
+        f.write("0\n1\n2\n")
+    dest.insert_measurements("test", RecordBatch(
+        (start + 3 + np.arange(2, dtype=np.uint64)) * 2**32,
+        {"key1": np.array([3, 4], dtype=np.int32)}
+    ))
+    try:
+        result, data, msg = dest.get_raw_stream_data("test", start=start, stop=start + 10)
+        assert result == 0, msg
+        assert data["key1"].tolist() == range(5)
+        assert data[TIMESTAMP].tolist() == [(start + i) * 2**32 for i in range(5)]
+        result, data, _ = dest.read_stream_window(
+            "test", (start + 1) * 2**32, (start + 10) * 2**32, limit=3
+        )
+        assert data["key1"].tolist() == [1, 2, 3]
+        # only new measurements in the window
+        result, data, _ = dest.get_raw_stream_data("test", start=start + 4, stop=start + 10)
+        assert data["key1"].tolist() == [4]
+    finally:
+        dest.close()
+
+
+def test_day_columns(tmpdir):
+    '''filesystem reads find the window in every day directory it overlaps'''
+    config = ConfigParser.ConfigParser()
+    config.read(path.join(FULL_BASE_PATH, "config", "origin-server-test.cfg"))
+    config.set("Server", "var_path", str(tmpdir))
+    dest = FilesystemDestination(logger, config)
+    dest.register_stream("test", {"key1": "int"}, ["key1"])
+    # one measurement per hour over three days, starting at midnight
+    day = 86400
+    start = (int(time.time()) // day - 5) * day
+    rows = 3 * 24
+    dest.insert_measurements("test", RecordBatch(
+        (start + 3600 * np.arange(rows, dtype=np.uint64)) * 2**32,
+        {"key1": np.arange(rows, dtype=np.int32)}
+    ))
+    try:
+        assert len(dest.day_paths("test", start * 2**32, (start + 3 * day) * 2**32)) == 3
+        # the window edges fall on measurements, both are included
+        result, data, _ = dest.get_raw_stream_data("test", start=start + 20 * 3600, stop=start + 50 * 3600)
+        assert data["key1"].tolist() == range(20, 51)
+        # a single day is read straight from the mapped file
+        result, data, _ = dest.get_raw_stream_data("test", start=start + 3600, stop=start + 2 * 3600)
+        assert isinstance(data["key1"], np.memmap)
+        assert data["key1"].tolist() == [1, 2]
+
+        # a column cut short by a crash only hides the incomplete rows
+        dest.close()
+        last_day = dest.day_paths("test", (start + 2 * day) * 2**32, (start + 3 * day) * 2**32)[0]
+        with open(path.join(last_day, "key1.bin"), 'r+b') as f:
+            f.truncate(24 * 4 - 3)
+        result, data, _ = dest.get_raw_stream_data("test", start=start + 2 * day, stop=start + 3 * day)
+        assert data["key1"].tolist() == range(48, 71)
+    finally:
+        dest.close()
@@ -0,0 +1,172 @@
+'''
+Unit tests for the read pool: heavy read slots and the read timeout
+'''
+
+import sys
+from os import path, getcwd
+import imp
+import logging
+import time
+import json
+import threading
+import multiprocessing
+import ConfigParser
+
+import zmq
+import pytest
+
+FULL_BASE_PATH = path.dirname(path.abspath(getcwd()))
+FULL_LIB_PATH = path.join(FULL_BASE_PATH, "lib")
+BIN_PATH = path.join(FULL_BASE_PATH, "bin", "origin-server")
+sys.path.append(FULL_LIB_PATH)
+
+from origin.server import HDF5Destination, ReadCache
+
+logger = logging.getLogger()
+
+
+def load_server():
+    '''import the server script as a module'''
+    argv, sys.argv = sys.argv, [BIN_PATH, "test"]
+    dont_write_bytecode, sys.dont_write_bytecode = sys.dont_write_bytecode, True
+    try:
+        return imp.load_source("origin_server", BIN_PATH)
+    finally:
+        sys.argv = argv
+        sys.dont_write_bytecode = dont_write_bytecode
+
+server = load_server()
+
+
+@pytest.fixture
+def dest(tmpdir):
+    config = ConfigParser.ConfigParser()
+    config.read(path.join(FULL_BASE_PATH, "config", "origin-server-test.cfg"))
+    config.set("Server", "var_path", str(tmpdir))
+    config.set("ReadPool", "heavy_timeout", "0.1")
+    dest = HDF5Destination(logger, config)
+    yield dest
+    dest.close()
+
+
+def test_heavy_slots(dest):
+    '''long reads wait for a free slot, short reads do not'''
+    handler = server.ReadHandler(logger, dest, heavy_slots=multiprocessing.BoundedSemaphore(1))
+    now = time.time()
+    heavy = (now - 2 * handler.heavy_window, now)
+    assert handler.isHeavy(*heavy)
+    assert not handler.isHeavy(now - 60, None)
+    assert not handler.isHeavy(None, None)
+
+    read = lambda: (0, {}, "")
+    assert handler.limitRead(heavy, read) == (0, {}, "")
+    handler.heavy_slots.acquire()
+    try:
+        assert handler.limitRead(heavy, read)[0] == 1
+        assert handler.limitRead((now - 60, now), read) == (0, {}, "")
+    finally:
+        handler.heavy_slots.release()
+    assert handler.limitRead(heavy, read) == (0, {}, "")
+
+
+def worker(context, stopped, delay=0):
+    '''read worker that echoes the request'''
+    sock = context.socket(zmq.REQ)
+    sock.connect("inproc://read_workers")
+    sock.send(server.READY)
+    while True:
+        envelope, body = server.split_envelope(sock.recv_multipart())
+        if not body:
+            break
+        time.sleep(delay)
+        sock.send_multipart(envelope + [json.dumps((0, body[0]))])
+    sock.close()
+    stopped.set()
+
+
+def start_pool(cache=None):
+    '''start a read broker, returns the context, the broker and a function
+    to start workers'''
+    context = zmq.Context()
+    frontend = context.socket(zmq.ROUTER)
+    frontend.bind("inproc://read_port")
+    backend = context.socket(zmq.ROUTER)
+    backend.bind("inproc://read_workers")
+
+    def start_worker(stopped=None, delay=0):
+        t = threading.Thread(target=worker, args=(context, stopped or threading.Event(), delay))
+        t.daemon = True
+        t.start()
+    broker = server.ReadBroker(frontend, backend, logger, 0.2, cache=cache, startWorker=start_worker)
+    t = threading.Thread(target=broker.run)
+    t.daemon = True
+    t.start()
+    return (context, broker, start_worker)
+
+
+def client(context):
+    sock = context.socket(zmq.REQ)
+    sock.connect("inproc://read_port")
+    sock.setsockopt(zmq.RCVTIMEO, 2000)
+    return sock
+
+
+def test_read_timeout():
+    '''a hung read is answered with an error and its worker is replaced'''
+    context, broker, start_worker = start_pool()
+    slow_stopped = threading.Event()
+    start_worker(slow_stopped, 0.5)
+
+    sock = client(context)
+    before = time.time()
+    sock.send(b"slow")
+    assert json.loads(sock.recv())[0] == 1
+    assert time.time() - before < 0.45
+
+    # the replacement answers while the slow read is still running
+    sock.send(b"fast")
+    assert json.loads(sock.recv()) == [0, "fast"]
+    # the slow worker is stopped once its read is done
+    assert slow_stopped.wait(2)
+    assert not broker.busy and not broker.late
+    sock.send(b"again")
+    assert json.loads(sock.recv()) == [0, "again"]
+    sock.close()
+
+
+def test_waiters_timeout(dest):
+    '''identical requests waiting for a hung read get the error too'''
+    cache = ReadCache(logger, dest.config)
+    context, broker, start_worker = start_pool(cache)
+    start_worker(delay=0.5)
+
+    msg = json.dumps(dict(stream="test", start=1500000000, stop=1500000100))
+    socks = [client(context) for i in range(2)]
+    for sock in socks:
+        sock.send(msg)
+    for sock in socks:
+        assert json.loads(sock.recv())[0] == 1
+    assert not cache.waiting
+    # the next request is read again, by the replacement worker
+    socks[0].send(msg)
+    assert json.loads(socks[0].recv())[0] == 0
+    for sock in socks:
+        sock.close()
+
+
+def test_malformed_request():
+    '''requests without a delimiter or a body do not stop the broker'''
+    context, broker, start_worker = start_pool()
+    start_worker()
+    dealer = context.socket(zmq.DEALER)
+    dealer.connect("inproc://read_port")
+    dealer.setsockopt(zmq.RCVTIMEO, 2000)
+    dealer.send(b"no delimiter")
+    dealer.send(b"")
+    delimiter, reply = dealer.recv_multipart()
+    assert json.loads(reply)[0] == 1
+    sock = client(context)
+    sock.send(b"fine")
+    assert json.loads(sock.recv()) == [0, "fine"]
+    dealer.close()
+    sock.close()
@@ -0,0 +1,137 @@
+'''
+Unit tests for RecordBatch and the single measurement ingest path
+'''
+
+import sys
+from os import path, getcwd
+import logging
+import time
+import struct
+import ConfigParser
+
+import numpy as np
+import pytest
+
+FULL_BASE_PATH = path.dirname(path.abspath(getcwd()))
+FULL_LIB_PATH = path.join(FULL_BASE_PATH, "lib")
+sys.path.append(FULL_LIB_PATH)
+
+from origin.server import RecordBatch, Destination
+from origin.origin_batch import pack_batch
+from origin import TIMESTAMP
+
+logger = logging.getLogger()
+
+DEFINITION = {
+    "key1": {"type": "int", "key_index": 0},
+    "key2": {"type": "double", "key_index": 1},
+    "key3": {"type": "string", "key_index": 2},
+}
+MEASUREMENTS = [
+    {TIMESTAMP: 2**32 * 1500000000 + i, "key1": i, "key2": i / 2., "key3": "s" * i}
+    for i in range(5)
+]
+
+
+def test_from_measurements():
+    '''columns are typed by the definition, strings are kept whole'''
+    batch = RecordBatch.from_measurements(MEASUREMENTS, DEFINITION, "uint64")
+    assert len(batch) == 5
+    assert sorted(batch.fields) == ["key1", "key2", "key3"]
+    assert batch.timestamps.dtype == np.uint64
+    assert batch.column("key1").dtype == np.int32
+    assert batch.column("key2").dtype == np.float64
+    assert batch.column("key3").tolist() == ["s" * i for i in range(5)]
+    assert batch.column(TIMESTAMP) is batch.timestamps
+    assert list(batch.rows()) == MEASUREMENTS
+
+
+def test_from_records():
+    '''structured records are wrapped without copying'''
+    records = np.zeros(3, dtype=[(TIMESTAMP, ">u8"), ("key1", ">i4")])
+    records["key1"] = [1, 2, 3]
+    batch = RecordBatch.from_records(records)
+    assert batch.fields == ["key1"]
+    batch.columns["key1"][0] = 7
+    assert records["key1"][0] == 7
+
+
+def test_length_mismatch():
+    with pytest.raises(ValueError):
+        RecordBatch(np.arange(3), {"key1": np.arange(2)})
+
+
+def test_concatenate_and_slice():
+    '''batches join in order, slices are views'''
+    batch = RecordBatch.from_measurements(MEASUREMENTS, DEFINITION, "uint64")
+    parts = [batch.slice(0, 2), batch.slice(2, 3), batch.slice(3, 5)]
+    assert RecordBatch.concatenate(parts[:1]) is parts[0]
+    joined = RecordBatch.concatenate(parts)
+    assert list(joined.rows()) == MEASUREMENTS
+    assert joined.column("key1").dtype == np.int32
+    with pytest.raises(KeyError):
+        RecordBatch.concatenate([batch, RecordBatch(batch.timestamps, {"other": batch.timestamps})])
+
+
+class FakeDestination(Destination):
+    '''keeps the stored batches'''
+
+    def connect(self):
+        self.batches = []
+
+    def read_stream_def_table(self):
+        pass
+
+    def insert_measurements(self, stream, batch):
+        self.batches.append((stream, batch))
+
+
+@pytest.fixture
+def dest():
+    config = ConfigParser.ConfigParser()
+    config.read(path.join(FULL_BASE_PATH, "config", "origin-server-test.cfg"))
+    config.set("Server", "row_batch", "3")
+    config.set("Server", "row_interval", "100")
+    dest = FakeDestination(logger, config)
+    dest.known_streams["test"] = {
+        "stream": "test", "id": 1, "version": 1, "key_order": ["key1", "key2"],
+        "format_str": "!Qid", "definition": DEFINITION,
+    }
+    dest.known_stream_versions["test"] = {"key1": DEFINITION["key1"], "key2": DEFINITION["key2"]}
+    dest.build_decode_plans()
+    return dest
+
+
+def stored(dest):
+    return [(stream, batch.column("key1").tolist()) for stream, batch in dest.batches]
+
+
+def test_rows(dest):
+    '''single measurements are stored together, in order'''
+    for i in range(4):
+        dest.measurement_binary("test", struct.pack("!Qid", 2**32 * 1500000000 + i, i, 0.5))
+    assert stored(dest) == [("test", [0, 1, 2])]
+    assert dest.batches[0][1].column("key1").dtype == np.int32
+    dest.store_rows()
+    assert stored(dest) == [("test", [0, 1, 2]), ("test", [3])]
+    assert not dest.rows
+    dest.store_rows()
+    assert len(dest.batches) == 2
+
+
+def test_row_interval(dest):
+    '''rows are not held longer than the row interval while data comes in'''
+    dest.row_interval = 0.05
+    dest.measurement_ordered("test", 2**32 * 1500000000, [1, 0.5])
+    assert not dest.batches
+    time.sleep(0.06)
+    dest.measurement_ordered("test", 2**32 * 1500000001, [2, 0.5])
+    assert stored(dest) == [("test", [1, 2])]
+
+
+def test_rows_before_batch(dest):
+    '''queued rows are stored before a batched frame of the same stream'''
+    dest.measurement_ordered("test", 2**32 * 1500000000, [1, 0.5])
+    frame = pack_batch(1, "!Qid", [(2**32 * 1500000001, 2, 1.5)])
+    assert dest.measurement_batch("test", frame)[0] == 0
+    assert stored(dest) == [("test", [1]), ("test", [2])]
@@ -0,0 +1,108 @@
+'''
+Unit tests for the rollup tiers with the file based destinations
+'''
+
+import sys
+from os import path, getcwd
+import logging
+import time
+import ConfigParser
+
+import numpy as np
+import pytest
+
+FULL_BASE_PATH = path.dirname(path.abspath(getcwd()))
+FULL_LIB_PATH = path.join(FULL_BASE_PATH, "lib")
+sys.path.append(FULL_LIB_PATH)
+
+from origin.server import RecordBatch, HDF5Destination, Rollups
+from origin.server.origin_filesystem_destination import FilesystemDestination
+from origin.server.origin_rollup import rollup_stream_name
+from origin import TIMESTAMP
+
+logger = logging.getLogger()
+
+ROWS = 4 * 3600
+
+
+@pytest.fixture(params=["hdf5", "filesystem"])
+def dest(request, tmpdir):
+    config = ConfigParser.ConfigParser()
+    config.read(path.join(FULL_BASE_PATH, "config", "origin-server-test.cfg"))
+    config.set("Server", "var_path", str(tmpdir))
+    if request.param == "hdf5":
+        dest = HDF5Destination(logger, config)
+    else:
+        dest = FilesystemDestination(logger, config)
+    dest.rollups = Rollups(logger, config, dest)
+    dest.register_stream("test", {"key1": "int", "key2": "double"}, ["key1", "key2"])
+    yield dest
+    dest.close()
+
+
+def write(dest):
+    '''write one measurement per second, in batches, up to a minute ago, and
+    return (start, values)'''
+    start = int(time.time()) - ROWS - 60
+    time_stamps = (start + np.arange(ROWS, dtype=np.uint64)) * 2**32
+    values = {
+        "key1": np.random.randint(-1000, 1000, ROWS).astype(np.int32),
+        "key2": 1e6 + np.random.random(ROWS),
+    }
+    for i in range(0, ROWS, 700):
+        dest.store_measurements("test", RecordBatch(
+            time_stamps[i:i + 700],
+            dict((field, values[field][i:i + 700]) for field in values)
+        ))
+    dest.rollups.flush()
+    return (start, values)
+
+
+def test_stats(dest):
+    '''stats from the tiers should match the raw data'''
+    start, values = write(dest)
+    for first, last in [(start + 17, start + ROWS - 3), (start + 3599, start + 7201)]:
+        result, data, _ = dest.rollups.get_stat_stream_data("test", first, last)
+        assert result == 0
+        rows = slice(first - start, last - start + 1)
+        assert data[TIMESTAMP]['start'] == first * 2**32
+        assert data[TIMESTAMP]['stop'] == last * 2**32
+        for field in values:
+            assert data[field]['min'] == values[field][rows].min()
+            assert data[field]['max'] == values[field][rows].max()
+            assert np.isclose(data[field]['average'], values[field][rows].mean())
+            assert np.isclose(data[field]['standard_deviation'], values[field][rows].std())
+
+    # the tiers were written as the measurements arrived
+    dest.rollups.flush(force=True)
+    tier = rollup_stream_name("test", 3600)
+    result, data, _ = dest.read_stream_window(tier, 0, 2**64 - 1, ["count"])
+    assert result == 0
+    assert data["count"].sum() == ROWS
+
+
+def test_buckets(dest):
+    '''bucketed reads should match the raw data'''
+    start, values = write(dest)
+    # a late measurement for a bucket that was already written is skipped
+    late = start + 2 * 3600 + 1
+    dest.rollups.update("test", RecordBatch(
+        np.array([late * 2**32], dtype=np.uint64),
+        {"key1": np.array([5000], dtype=np.int32), "key2": np.array([0.])}
+    ))
+    dest.rollups.flush(force=True)
+
+    result, data, _ = dest.rollups.get_bucket_stream_data(
+        "test", start, start + ROWS, fields=["key1"], bucket_seconds=600
+    )
+    assert result == 0
+    key1 = values["key1"]
+    buckets = (start + np.arange(ROWS)) // 600 * 600
+    assert (data[TIMESTAMP] >> 32).tolist() == np.unique(buckets).tolist()
+    for i, bucket in enumerate(np.unique(buckets)):
+        rows = buckets == bucket
+        assert data["count"][i] == rows.sum()
+        assert data["key1_max"][i] == key1[rows].max()
+        assert np.isclose(data["key1_average"][i], key1[rows].mean())
+    assert data["key1_first"][0] == values["key1"][0]
+    assert data["key1_last"][-1] == values["key1"][-1]
@@ -0,0 +1,65 @@
+'''
+Unit tests for the subscriber poller loop
+'''
+
+import sys
+from os import path, getcwd
+import logging
+import time
+import json
+import threading
+import multiprocessing
+
+import zmq
+
+FULL_BASE_PATH = path.dirname(path.abspath(getcwd()))
+FULL_LIB_PATH = path.join(FULL_BASE_PATH, "lib")
+sys.path.append(FULL_LIB_PATH)
+
+from origin.client.origin_subscriber import poller_loop
+
+logger = logging.getLogger()
+
+received = []
+
+
+def collect(stream_id, data, log):
+    received.append((stream_id, data))
+
+
+def wait_for(check, timeout=2):
+    deadline = time.time() + timeout
+    while not check():
+        assert time.time() < deadline
+        time.sleep(0.005)
+
+
+def test_poller_loop():
+    '''commands apply right away and every message reaches the callback'''
+    pub = zmq.Context.instance().socket(zmq.XPUB)
+    port = pub.bind_to_random_port("tcp://127.0.0.1")
+    commands, child = multiprocessing.Pipe()
+    loop = threading.Thread(
+        target=poller_loop, args=("tcp://127.0.0.1:{}".format(port), child, logger)
+    )
+    loop.start()
+    try:
+        commands.send({
+            'action': 'SUBSCRIBE', 'stream_filter': u'0001', 'callback': collect
+        })
+        pub.setsockopt(zmq.RCVTIMEO, 2000)
+        assert pub.recv() == b'\x010001'
+        for i in range(2000):
+            pub.send_multipart([b'0001', json.dumps({'i': i})])
+            pub.send_multipart([b'0002', json.dumps({'i': i})])
+        wait_for(lambda: len(received) == 2000)
+        assert [data['i'] for _, data in received] == range(2000)
+        assert all(stream_id == '0001' for stream_id, _ in received)
+
+        commands.send({'action': 'UNSUBSCRIBE', 'stream_filter': u'0001'})
+        assert pub.recv() == b'\x000001'
+    finally:
+        commands.send({'action': 'SHUTDOWN'})
+        loop.join(2)
+        pub.close(linger=0)
+    assert not loop.is_alive()
@@ -0,0 +1,88 @@
+'''
+Unit tests for the HDF5 SWMR writer and readers
+'''
+
+import sys
+from os import path, getcwd
+import logging
+import time
+import ConfigParser
+
+import numpy as np
+import pytest
+
+FULL_BASE_PATH = path.dirname(path.abspath(getcwd()))
+FULL_LIB_PATH = path.join(FULL_BASE_PATH, "lib")
+sys.path.append(FULL_LIB_PATH)
+
+from origin.server import RecordBatch, HDF5Destination, LayoutLock
+
+logger = logging.getLogger()
+
+
+@pytest.fixture
+def dest(tmpdir):
+    config = ConfigParser.ConfigParser()
+    config.read(path.join(FULL_BASE_PATH, "config", "origin-server-test.cfg"))
+    config.set("Server", "var_path", str(tmpdir))
+    config.set("HDF5", "swmr", "True")
+    dest = HDF5Destination(logger, config)
+    dest.register_stream("old", {"key1": "int"}, ["key1"])
+    dest.start_swmr(LayoutLock())
+    yield dest
+    dest.close()
+
+
+def batch(start, rows):
+    time_stamps = (start + np.arange(rows, dtype=np.uint64)) * 2**32
+    return RecordBatch(time_stamps, {"key1": np.arange(rows, dtype=np.int32)})
+
+
+def test_register_during_read(dest):
+    '''registering a stream does not wait for a running read'''
+    start = int(time.time())
+    reading = dest.layout_lock.reading()
+    reading.__enter__()
+    try:
+        before = time.time()
+        result, stream_ver = dest.register_stream("new", {"key1": "int"}, ["key1"])
+        assert result == 0
+        assert time.time() - before < 0.5
+        dest.insert_measurements("new", batch(start, 10))
+        dest.insert_measurements("old", batch(start, 10))
+        dest.flush(force=True)
+        # the new groups wait for the read, the old stream is written
+        assert "new" not in dest.hdf5_file
+        assert len(dest.waiting["new"]) == 1
+        assert dest.group_pointers(dest.hdf5_file["/old/old_1"]) == (0, 9)
+    finally:
+        reading.__exit__(None, None, None)
+
+    dest.flush()
+    assert not dest.layout_changes and not dest.waiting
+    assert dest.hdf5_file.swmr_mode
+    dest.flush(force=True)
+    result, data, msg = dest.read_stream_window("new", start * 2**32, (start + 10) * 2**32)
+    assert result == 0
+    assert data["key1"].tolist() == range(10)
+
+
+def test_read_head_retry(dest, monkeypatch):
+    '''a reader starts over if the writer moved the ring buffer'''
+    dest.insert_measurements("old", batch(int(time.time()), 10))
+    dest.flush(force=True)
+    group = dest.hdf5_file["/old/old_1"]
+    dest.swmr_reader = True
+    pointers = [(0, 5), (0, 9), (0, 9), (0, 9)]
+    monkeypatch.setattr(dest, "dataset", lambda group, name: group[name])
+    monkeypatch.setattr(dest, "group_pointers", lambda group: pointers.pop(0))
+    row_count, chunk_min, chunk_max, buffer_data = dest.read_head(group, ["key1"])
+    assert not pointers
+    assert buffer_data["key1"].tolist() == range(10)
+
+    # the ring buffer was archived and reused on every try
+    moving = iter(range(100))
+    monkeypatch.setattr(dest, "group_pointers", lambda group: (1024 * next(moving), 9))
+    with pytest.raises(IOError):
+        dest.read_head(group, ["key1"])
+    dest.swmr_reader = False
@@ -0,0 +1,156 @@
+'''
+Unit tests for the write-behind queue, against a stand-in destination
+'''
+
+import sys
+from os import path, getcwd
+import logging
+import time
+import threading
+import ConfigParser
+
+import numpy as np
+import pytest
+
+FULL_BASE_PATH = path.dirname(path.abspath(getcwd()))
+FULL_LIB_PATH = path.join(FULL_BASE_PATH, "lib")
+sys.path.append(FULL_LIB_PATH)
+
+from origin.server import RecordBatch
+from origin.server.origin_write_behind import WriteBehind
+
+logger = logging.getLogger()
+
+
+class FakeDestination(object):
+    '''records the writes, can be held up or made to fail'''
+
+    def __init__(self):
+        self.write_lock = threading.RLock()
+        self.writes = []
+        self.open = threading.Event()
+        self.open.set()
+
+    def insert_measurements(self, stream, batch):
+        self.open.wait()
+        if stream == "fail":
+            raise IOError("write failed")
+        self.writes.append((stream, batch.column("key1").tolist(), time.time()))
+
+    def inserted(self, stream, batch):
+        pass
+
+
+def batch(values, field="key1"):
+    values = np.array(values, dtype=np.int32)
+    return RecordBatch(values.astype(np.uint64), {field: values})
+
+
+def wait_for(check, timeout=2):
+    deadline = time.time() + timeout
+    while not check():
+        assert time.time() < deadline
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def writer(request):
+    '''a write-behind stage, the test parameters override the config'''
+    config = ConfigParser.ConfigParser()
+    config.read(path.join(FULL_BASE_PATH, "config", "origin-server-test.cfg"))
+    for key, value in getattr(request, "param", {}).items():
+        config.set("WriteBehind", key, str(value))
+    writer = WriteBehind(logger, config, FakeDestination())
+    yield writer
+    writer.dest.open.set()
+    writer.close()
+
+
+@pytest.mark.parametrize("writer", [dict(batch_size=10, flush_interval=1)], indirect=True)
+def test_batch_size(writer):
+    '''a full batch is written without waiting for the flush interval'''
+    before = time.time()
+    for i in range(10):
+        writer.put("test", batch([i]))
+    wait_for(lambda: writer.dest.writes)
+    stream, values, when = writer.dest.writes[0]
+    assert values == range(10)
+    assert when - before < 0.5
+
+
+@pytest.mark.parametrize("writer", [dict(batch_size=1000, flush_interval=0.2)], indirect=True)
+def test_flush_interval(writer):
+    '''a partial batch is written once the flush interval is up, grouped by
+    stream'''
+    before = time.time()
+    writer.put("a", batch([1]))
+    writer.put("b", batch([2]))
+    writer.put("a", batch([3, 4]))
+    wait_for(lambda: len(writer.dest.writes) == 2)
+    assert [w[:2] for w in writer.dest.writes] == [("a", [1, 3, 4]), ("b", [2])]
+    assert writer.dest.writes[0][2] - before >= 0.15
+    assert writer.stats()["batches"] == 1
+
+
+@pytest.mark.parametrize("writer", [dict(queue_size=2, policy="drop", flush_interval=0.01)], indirect=True)
+def test_drop(writer):
+    '''with the drop policy, measurements that do not fit are dropped'''
+    writer.dest.open.clear()
+    writer.put("test", batch([0]))
+    # the writer thread is held up writing the first item
+    wait_for(lambda: writer.queue.qsize() == 0)
+    time.sleep(0.05)
+    assert writer.put("test", batch([1]))
+    assert writer.put("test", batch([2]))
+    assert not writer.put("test", batch([3, 4]))
+    assert writer.stats()["dropped"] == 2
+    writer.dest.open.set()
+    writer.drain()
+    assert sum(len(w[1]) for w in writer.dest.writes) == 3
+
+
+@pytest.mark.parametrize("writer", [dict(queue_size=1, policy="block", flush_interval=0.01)], indirect=True)
+def test_block(writer):
+    '''with the block policy, put waits for room in the queue'''
+    writer.dest.open.clear()
+    writer.put("test", batch([0]))
+    wait_for(lambda: writer.queue.qsize() == 0)
+    time.sleep(0.05)
+    writer.put("test", batch([1]))
+    blocked = threading.Thread(target=writer.put, args=("test", batch([2])))
+    blocked.start()
+    time.sleep(0.1)
+    assert blocked.is_alive()
+    writer.dest.open.set()
+    blocked.join(2)
+    assert not blocked.is_alive()
+    writer.drain()
+    assert [v for w in writer.dest.writes for v in w[1]] == [0, 1, 2]
+
+
+def test_close(writer):
+    '''close writes everything still queued, then stops the thread'''
+    writer.dest.open.clear()
+    for i in range(5):
+        writer.put("test", batch([i]))
+    writer.dest.open.set()
+    writer.close()
+    assert not writer.thread.is_alive()
+    assert [v for w in writer.dest.writes for v in w[1]] == range(5)
+
+
+@pytest.mark.parametrize("writer", [dict(flush_interval=0.05)], indirect=True)
+def test_failures(writer):
+    '''failed writes are counted, the other streams and drain carry on'''
+    writer.put("fail", batch([1]))
+    writer.put("mixed", batch([2]))
+    # batches of one stream with different fields can not be joined
+    writer.put("mixed", batch([3], field="other"))
+    writer.put("test", batch([4]))
+    writer.drain()
+    assert [w[:2] for w in writer.dest.writes] == [("test", [4])]
+    assert writer.stats()["failed"] == 3
+    assert writer.thread.is_alive()
+    writer.put("test", batch([5]))
+    writer.drain()
+    assert writer.dest.writes[-1][:2] == ("test", [5])